@@ -7,27 +7,634 @@ Author: M. Verboom
 """
 
 # Basic import
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 
-# HRV toolbox
-import pyhrv
-
 # Import HRV modules
 import HRV_preprocessing as preproc
 import HRV_calculations as hrvcalc
+import HRV_recordstore as recstore
+import HRV_export as export
+import HRV_cache as cache
+import HRV_streaming as streaming
+import HRV_trace as tracer
+import HRV_prefetch as prefetcher
+
+#%% Options
+class PatientOptions:
+    """
+    Options of the analysis of a patient (workflow_patient). Options that
+    are not given have the value of DEFAULTS, an unknown option raises a
+    TypeError. validate checks the options and their combinations.
+
+    OPTIONS:
+        windows: list of (start, end) tuples of analysis windows [s] within
+                 starttime and endtime (default: None, one window)
+        engine: engine for sample entropy and DFA: 'pyhrv' (default) or
+                'fast' (HRV_nonlinear.py, for long NNI series)
+        retain: retention policy 'all' (default), 'results' or 'disk', see
+                workflow_batch
+        spill_dir: directory for spilled signals if retain = 'disk'
+        cache_dir: path of the result cache, see HRV_cache.py (default:
+                   None, no cache)
+        chunk: length of chunks for streaming R-peak detection [s], see
+               HRV_streaming.py (default: None, whole signal at once)
+        margin: overlap margin of the chunks [s]
+        parameters: list with names of HRV parameters to calculate, see
+                    hrvcalc.PARAMETERS (default: None, all parameters)
+        trace: .jsonl file for the records of all stages, see HRV_trace.py
+               (default: None, no tracing unless enabled with
+               HRV_trace.enable). Tracing is enabled for the duration of
+               workflow_patient (or workflow_batch), unless it is already
+               enabled
+        trace_memory: if True, the trace includes tracemalloc peaks (slows
+                      down the analysis)
+        lead_mode: with several leads, 'select' (default, R-peak detection
+                   on the lead with the best quality score) or 'fusion'
+                   (R-peak detection on all leads, fused by quality score)
+        lead_workers: number of worker processes for the leads in fusion
+        gate: quality gate, False (default, no gating), True (thresholds of
+              preproc.GATE_THRESHOLDS) or a dictionary with thresholds
+        prefetch: number of chunks read ahead in streaming mode
+    """
+    DEFAULTS = {'windows': None, 'engine': 'pyhrv', 'retain': 'all',
+                'spill_dir': None, 'cache_dir': None, 'chunk': None,
+                'margin': 10, 'parameters': None, 'trace': None,
+                'trace_memory': False, 'lead_mode': 'select',
+                'lead_workers': 1, 'gate': False, 'prefetch': 0}
+
+    def __init__(self, **options):
+        unknown = sorted(set(options) - set(self.DEFAULTS))
+        if unknown:
+            raise TypeError('Unknown option(s) %s, see %s.DEFAULTS.'
+                            % (unknown, type(self).__name__))
+        for key, default in self.DEFAULTS.items():
+            setattr(self, key, options.get(key, default))
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % item for item in self.as_dict().items()))
+
+    @classmethod
+    def create(cls, options=None, **kwargs):
+        """
+        Function that creates options from other options (e.g. BatchOptions
+        for workflow_patient, options that do not apply are left out),
+        updated with keyword arguments.
+        """
+        base = dict() if options is None else {
+            key: value for key, value in options.as_dict().items()
+            if key in cls.DEFAULTS}
+        return cls(**dict(base, **kwargs))
+
+    def as_dict(self):
+        """
+        Function that returns the options as a dictionary of keyword
+        arguments.
+        """
+        return {key: getattr(self, key) for key in self.DEFAULTS}
+
+    def replace(self, **changes):
+        """
+        Function that returns a copy of the options with changes.
+        """
+        return type(self)(**dict(self.as_dict(), **changes))
+
+    def validate(self, lead):
+        """
+        Function that checks the options before an analysis starts. An
+        invalid option, or combination of options, raises a ValueError.
+
+        INPUT:
+            lead: ECG lead(s) of the analysis, see workflow_patient
+
+        OUTPUT:
+            options: the options themselves
+        """
+        if self.retain not in ('all', 'results', 'disk'):
+            raise ValueError("Unknown retain '%s', use 'all', 'results' or "
+                             "'disk'." % self.retain)
+        if self.retain == 'disk' and self.spill_dir is None:
+            raise ValueError("A spill_dir is required for retain = 'disk'.")
+        if self.parameters is not None:
+            hrvcalc.parameter_plan(self.parameters)                             # Unknown parameter names raise a ValueError
+        if self.lead_mode not in ('select', 'fusion'):
+            raise ValueError("Unknown lead_mode '%s', use 'select' or "
+                             "'fusion'." % self.lead_mode)
+        preproc.gate_thresholds(self.gate)                                      # Unknown thresholds raise a ValueError
+        if _multilead(lead) and self.chunk is not None:
+            raise ValueError('Several leads require chunk = None, streaming '
+                             'R-peak detection reads one lead.')
+        return self
+
+class BatchOptions(PatientOptions):
+    """
+    Options of the analysis of a batch (workflow_batch): the options of
+    PatientOptions and the options below. See PatientOptions for the use.
+
+    OPTIONS:
+        window: length of analysis windows [s], windows are created between
+                starttime and endtime (only if windows is None)
+        step: step between the start of consecutive windows [s]
+              (default: None, step = window)
+        n_workers: number of worker processes (default: 1, no parallel
+                   processing)
+        chunksize: number of patients sent to a worker process at once
+        export_path: .csv or .parquet file for the HRV parameters
+                     (default: None, only return export_all)
+        chunk_rows: number of rows per chunk written to export_path
+        array_fields: 'drop' (default) or 'bounds' (minimum and maximum)
+                      for array valued parameters such as dfa_alpha1_beats
+        prefetch: number of records (or chunks in streaming mode) loaded
+                  ahead of the computation (default: 0, no prefetching)
+        io_threads: number of I/O threads for prefetching
+        queue_dir: directory of a work queue shared by several nodes
+                   (default: None, no sharding), requires retain = 'results'
+        task_size: number of patients per task of the work queue
+        lease_timeout: time after which a task of a node that stopped is
+                       retried [s]
+        progress: if True, the ID of every patient is printed when its
+                  result arrives (default: False)
+    """
+    DEFAULTS = dict(PatientOptions.DEFAULTS, window=None, step=None,
+                    n_workers=1, chunksize=1, export_path=None,
+                    chunk_rows=100000, array_fields='drop', io_threads=2,
+                    queue_dir=None, task_size=10, lease_timeout=600,
+                    progress=False)
+
+    def validate(self, lead):
+        """
+        Function that checks the options before a batch starts, see
+        PatientOptions.validate.
+        """
+        super().validate(lead)
+        if self.windows is not None and self.window is not None:
+            raise ValueError('Give windows or window, not both.')
+        if self.step is not None and self.window is None:
+            raise ValueError('A step requires a window length.')
+        if self.n_workers < 1:
+            raise ValueError('n_workers must be at least 1.')
+        if self.queue_dir is not None:
+            if self.retain != 'results':
+                raise ValueError("Signals are not returned from the nodes of "
+                                 "queue_dir, use retain = 'results'.")
+            if self.trace is not None:
+                raise ValueError('Traces are not collected from the nodes of '
+                                 'queue_dir, use trace = None.')
+            if self.prefetch > 0 and self.chunk is None:
+                raise ValueError('Records are not loaded ahead with '
+                                 'queue_dir, use prefetch = 0 (or chunk).')
+        return self
+
+def _multilead(lead):
+    # True for a list of leads, or 'all'
+    return not isinstance(lead, str) or lead == 'all'
+
+#%% Single patient
+def workflow_patient(patient_id, sampfreq, lead, starttime, endtime, 
+                     store=None, offline=False, options=None, record=None,
+                     **kwargs):
+    """
+    Function for the HRV calculation of a single patient. Errors are caught
+    and returned together with the stage in which they occurred, so that a 
+    single bad record does not abort a batch.
+    
+    With cache_dir, windows that are in the cache are not recomputed and 
+    new results are written to the cache per window. If all windows are 
+    cached, the record is not loaded at all.
+    
+    INPUT:
+        patient_id: ID number of patient from MIMIC-III database
+        sampfreq: sampling frequency of recording [Hz]
+        lead: ECG lead for analysis: 'I', "II", "V", or a list of leads 
+              (or 'all') that are read at once, see lead_mode
+        starttime: starting time of ECG analysis [s]
+        endtime: ending time of ECG analysis [s]
+        store: path of local record store, see HRV_recordstore.py
+        offline: if True, only load records from the record store
+        options: PatientOptions (or BatchOptions) of the analysis (default:
+                 None, PatientOptions.DEFAULTS)
+        record: record that was loaded ahead (see _load_record), or a future
+                of it (default: None, the record is loaded here)
+        kwargs: options that replace those of options, e.g. windows, engine
+                or cache_dir, see PatientOptions
+    
+    OUTPUT:
+        result: dictionary with keys
+            'patient': patient ID
+            'ecg_df': dataframe with raw ecg, filtered ecg and time
+            'r_peaks_first', 'nni_first': R-peaks [s] and nni [ms] before 
+                                          ectopic beat- and outlier removal
+            'r_peaks', 'nni': R-peaks [s] and nni [ms] after ectopic beat- 
+                              and outlier removal
+            'hrv': list with a dictionary of HRV parameters per window
+            'failures': list with a dictionary per failure, with keys 
+                        'patient', 'window', 'stage', 'error' and 'reason'
+                        (reason code of the quality gate, else None)
+            'cached': number of windows read from the cache
+            'lead': analysed lead, or fused leads joined by '+'
+            'lead_quality': dictionary with quality score per lead (only 
+                            with several leads)
+            'gated': True if all windows failed the signal gate, so that 
+                     filtering and R-peak detection were skipped
+        With retain = 'results' the dataframe, R-peaks and nni are None, with 
+        retain = 'disk' they are lazy handles to the spilled data (see 
+        HRV_recordstore.spill_patient). If all windows are cached, they are
+        None as well. In streaming mode (chunk) the dataframe is never 
+        created and always None.
+    """
+    options = PatientOptions.create(options, **kwargs).validate(lead)
+    traced = options.trace is not None and tracer.enabled() is None
+    if traced:
+        tracer.enable(options.trace, options.trace_memory)                      # Only for this patient, e.g. a job of HRV_worker
+    try:
+        return _workflow_patient(patient_id, sampfreq, lead, starttime,
+                                 endtime, store, offline, options, record)
+    finally:
+        if traced:
+            tracer.disable()
+
+def _workflow_patient(patient_id, sampfreq, lead, starttime, endtime, store,
+                      offline, options, record):
+    # Analysis of a patient with validated options, see workflow_patient
+    windows = options.windows
+    result = {'patient': patient_id, 'ecg_df': None, 'r_peaks_first': None,
+              'nni_first': None, 'r_peaks': None, 'nni': None, 'hrv': list(),
+              'failures': list(), 'cached': 0, 'lead': lead, 
+              'lead_quality': None, 'gated': False}
+    gated = dict()                                                              # Window start: (reason code, description)
+    
+    # Cached results per window
+    starts = [None] if windows is None else [start for start, end in windows]
+    cached = dict()
+    if options.cache_dir is not None:
+        keys = _cache_keys(patient_id, sampfreq, lead, starttime, endtime, 
+                           options)
+        with tracer.stage('cache_read', patient=patient_id):
+            for start in starts:
+                row = cache.read_entry(options.cache_dir, keys[start])
+                if row is not None:
+                    cached[start] = row
+        result['cached'] = len(cached)
+        if len(cached) == len(starts):                                          # Nothing to compute
+            result['hrv'] = [cached[start] for start in starts]
+            return result
+    
+    driver = _signal_rpeaks if options.chunk is None else _stream_rpeaks
+    signals = driver(result, sampfreq, lead, starttime, endtime, store,         # R-peaks of the whole signal, or streamed in chunks
+                     offline, options, record, cached, gated)
+    if signals is None:                                                         # Failed, or all windows failed the signal gate
+        return result
+    ecg_df, r_peaks, nni, first_valid = signals
+    try:
+        with tracer.stage('ectopic', patient=patient_id, beats=len(nni)):
+            r_peaks_ect, nni_ect = preproc.ecg_ectopic_removal(r_peaks, nni)    # Ectopic beat removal 
+    except Exception as error:
+        result['failures'].append(_failure(patient_id, None, 'ectopic', error))
+        return result
+    
+    if windows is None:
+        segments = [(None, nni_ect)]
+        segments_first = [nni]
+        durations = [endtime - starttime]
+    else:
+        offset = starttime + first_valid                                        # R-peaks [s] relative to first valid sample
+        segments = preproc.nni_windows(r_peaks_ect + offset, nni_ect, windows)
+        segments = [(start, nni_window) for (start, end), (_, nni_window) 
+                    in zip(windows, segments)]
+        segments_first = [nni_window for _, nni_window in 
+                          preproc.nni_windows(r_peaks[:-1] + offset, nni, 
+                                              windows)]
+        durations = [end - start for start, end in windows]
+    thresholds = preproc.gate_thresholds(options.gate)
+    if thresholds is not None:
+        for (start, nni_window), nni_first, duration in zip(segments, 
+                                                            segments_first, 
+                                                            durations):
+            if start not in gated and start not in cached:
+                reason = preproc.beat_gate(nni_window, nni_first, duration,     # Number of beats, coverage and plausibility
+                                           thresholds)
+                if reason is not None:
+                    gated[start] = reason
+        result['failures'] += _gate_failures(patient_id, gated)
+    
+    if options.retain == 'all':
+        result.update({'ecg_df': ecg_df, 'r_peaks_first': r_peaks, 
+                       'nni_first': nni, 'r_peaks': r_peaks_ect, 
+                       'nni': nni_ect})
+    elif options.retain == 'disk':
+        with tracer.stage('spill', patient=patient_id):
+            ecg_handle, handles = recstore.spill_patient(                       # Write signals to disk, keep lazy handles
+                options.spill_dir, patient_id, ecg_df,
+                {'r_peaks_first': r_peaks, 'nni_first': nni,
+                 'r_peaks': r_peaks_ect, 'nni': nni_ect})
+        result['ecg_df'] = ecg_handle
+        result.update(handles)
+    del ecg_df                                                                  # Release signals before the HRV calculations
+    
+    for start, nni_window in segments:                                          # HRV calculations per window
+        if start in cached:
+            result['hrv'].append(cached[start])
+            continue
+        if start in gated:                                                      # Failed the quality gate, no HRV calculations
+            continue
+        try:
+            with tracer.stage('hrv', patient=patient_id, window=start, 
+                              beats=len(nni_window)):
+                if options.parameters is None:
+                    import pyhrv
+                    hrv_td, hrv_fd, hrv_nl = hrvcalc.hrv_results(               # HRV calculations for td: timedomain, fd: frequency domain, nl: nonlinear
+                        nni=nni_window, sampfreq=sampfreq,
+                        engine=options.engine)
+                    hrv_all = pyhrv.utils.join_tuples(hrv_td, hrv_fd, hrv_nl)   # Join tuples of td, fd and nl
+                else:
+                    hrv_all = hrvcalc.hrv_parameters(nni_window,                # Only the selected HRV parameters
+                                                     options.parameters,
+                                                     options.engine)
+        except Exception as error:
+            result['failures'].append(_failure(patient_id, start, 'hrv',
+                                               error))
+            continue
+        row = export.hrv_row(hrv_all)                                           # Exportable fields, figures closed
+        if _multilead(lead):
+            row['lead'] = result['lead']
+        if start is not None:
+            row = {'time [min]': start/60, **row, 'patientID': patient_id}
+        if options.cache_dir is not None:
+            with tracer.stage('cache_write', patient=patient_id, window=start):
+                cache.write_entry(options.cache_dir, keys[start], row)          # Written per window, a rerun resumes here
+        result['hrv'].append(row)
+    return result
+
+def _signal_rpeaks(result, sampfreq, lead, starttime, endtime, store, offline,
+                   options, record, cached, gated):
+    """
+    Function that loads the whole signal of a patient, selects the lead,
+    applies the signal gate, filters the signal and detects the R-peaks.
+    Failures and gated windows are added to result and gated. Returns None
+    if the patient failed, or if all windows failed the signal gate.
+
+    OUTPUT:
+        ecg_df: dataframe with raw ecg, filtered ecg and time
+        r_peaks: R-peaks [s] relative to the first valid sample
+        nni: nni [ms]
+        first_valid: time of the first valid sample [s]
+    """
+    patient_id = result['patient']
+    multilead = _multilead(lead)
+    n_samples = int((endtime - starttime) * sampfreq)
+    windows = options.windows
+    stage = 'load'
+    try:
+        with tracer.stage(stage, patient=patient_id, samples=n_samples):
+            ecg = record.result() if hasattr(record, 'result') else record      # Wait for the record that is loaded ahead
+            if isinstance(ecg, Exception):
+                raise ecg
+            if ecg is None:
+                ecg = preproc.load_data(patient_id, sampfreq, starttime,        # Load data, all requested leads at once
+                                        endtime, lead, store, offline)
+        if multilead:
+            stage = 'lead'
+            with tracer.stage(stage, patient=patient_id, samples=n_samples):
+                scores = preproc.lead_scores(ecg, sampfreq)                     # Quality score per lead
+            best = max(scores, key=scores.get)                                  # First lead in order of preference if equal
+            if scores[best] < preproc.QUALITY['minimum']:
+                raise ValueError('No lead of %s with ECG of sufficient '
+                                 'quality.' % list(scores))
+            result.update({'lead': best, 'lead_quality': scores})
+        thresholds = preproc.gate_thresholds(options.gate)
+        if thresholds is not None:
+            stage = 'gate'
+            with tracer.stage(stage, patient=patient_id, samples=n_samples):
+                signal = (preproc.record_lead(ecg, best) if multilead
+                          else ecg).p_signal[:, 0]
+                bounds = [(0, len(signal))] if windows is None else \
+                    [(int((start - starttime) * sampfreq),
+                      int((end - starttime) * sampfreq))
+                     for start, end in windows]
+                reasons = preproc.signal_gate(signal, sampfreq, bounds,         # Missing samples, flatline and saturation per window
+                                              thresholds)
+            starts = [None] if windows is None else [start for start, end
+                                                     in windows]
+            gated.update({start: reason for start, reason
+                          in zip(starts, reasons) if reason is not None})
+            if all(start in gated or start in cached for start in starts):     # Skip filtering and R-peak detection
+                result['gated'] = True
+                result['hrv'] = [cached[start] for start in starts
+                                 if start in cached]
+                result['failures'] += _gate_failures(patient_id, gated)
+                return None
+        stage = 'dataframe'
+        with tracer.stage(stage, patient=patient_id, samples=n_samples):
+            ecg_df = preproc.ecg_dataframe(                                     # Preprocessing
+                preproc.record_lead(ecg, best) if multilead else ecg,
+                sampfreq)
+        stage = 'rpeak'
+        with tracer.stage(stage, patient=patient_id, samples=len(ecg_df)):
+            if multilead and options.lead_mode == 'fusion':
+                ecg_df, r_peaks, nni, fused = preproc.ecg_rpeak_fusion(         # R-peaks of all leads, fused
+                    ecg_df, ecg, scores, sampfreq, options.lead_workers)
+                result['lead'] = '+'.join(fused)
+            else:
+                ecg_df, r_peaks, nni = preproc.ecg_rpeak(ecg_df, sampfreq)      # R_peak detection and nni calculation
+            first_valid = ecg_df.Time.iloc[0]
+    except Exception as error:
+        result['failures'].append(_failure(patient_id, None, stage, error))
+        return None
+    return ecg_df, r_peaks, nni, first_valid
+
+def _stream_rpeaks(result, sampfreq, lead, starttime, endtime, store, offline,
+                   options, record, cached, gated):
+    """
+    Function that streams the signal of a patient in chunks and detects the
+    R-peaks per chunk (HRV_streaming.py), as _signal_rpeaks. The dataframe
+    is not created, the raw signal is not kept for the signal gate.
+    """
+    patient_id = result['patient']
+    try:
+        with tracer.stage('stream', patient=patient_id,
+                          samples=int((endtime - starttime) * sampfreq)):
+            r_peaks, nni, first_valid = streaming.stream_rpeaks(                # Chunked loading and R-peak detection
+                patient_id, sampfreq, starttime, endtime, lead, store,
+                offline, options.chunk, options.margin,
+                prefetch=options.prefetch)
+    except Exception as error:
+        result['failures'].append(_failure(patient_id, None, 'stream', error))
+        return None
+    return None, r_peaks, nni, first_valid
+
+def _cache_keys(patient_id, sampfreq, lead, starttime, endtime, options):
+    # Cache keys of all windows of a patient, with window start as key
+    stream = None if options.chunk is None else (options.chunk,
+                                                 options.margin)
+    config = cache.analysis_config(options.engine, stream, options.parameters,
+                                   options.lead_mode if _multilead(lead)
+                                   else None, options.gate)
+    windows = [None] if options.windows is None else options.windows
+    return {None if window is None else window[0]: 
+            cache.cache_key(patient_id, lead, sampfreq, (starttime, endtime),
+                            window, config) for window in windows}
+
+def _load_record(patient_id, sampfreq, lead, starttime, endtime, store=None,
+                 offline=False, options=None):
+    """
+    Function that loads the record of a patient on a prefetch thread. 
+    Windows of the record store are read into memory here, so that the 
+    computation does not wait for the memory map. Returns None if all 
+    windows are cached (nothing to load).
+    """
+    options = PatientOptions.create(options)
+    if options.cache_dir is not None:
+        keys = _cache_keys(patient_id, sampfreq, lead, starttime, endtime, 
+                           options)
+        if all(cache.read_entry(options.cache_dir, key) is not None
+               for key in keys.values()):
+            return None
+    record = preproc.load_data(patient_id, sampfreq, starttime, endtime, lead,
+                               store, offline)
+    if isinstance(record.p_signal, np.memmap):
+        record.p_signal = np.array(record.p_signal)                             # Read from disk now
+    return record
+
+def _patient_record(patient, patient_id, record):
+    # workflow_patient with a prefetched record, on a worker process
+    return patient(patient_id, record=record)
+
+def _failure(patient_id, window, stage, error):
+    # Failure of a patient (window None) or window in a stage
+    return {'patient': patient_id, 'window': window, 'stage': stage,
+            'error': repr(error), 'reason': None}
+
+def _gate_failures(patient_id, gated):
+    # Failures of the windows that did not pass the quality gate
+    return [{'patient': patient_id, 'window': start, 'stage': 'gate', 
+             'error': description, 'reason': code} 
+            for start, (code, description) in gated.items()]
 
 #%% Batchmode 
-def workflow_batch(patient_ids, sampfreq, lead, starttime, endtime):
+def workflow_batch(patient_ids, sampfreq, lead, starttime, endtime, store=None,
+                   offline=False, options=None, return_failures=False,
+                   **kwargs):
     """
     Function for the HRV calculation in batchmode (multiple patients).
     
+    If windows (or window) is given, HRV parameters are calculated per 
+    analysis window. Per patient the full span of all windows is loaded, 
+    filtered and corrected for ectopic beats only once, after which the 
+    corrected NNI series is cut per window (see preproc.nni_windows). Note
+    that R-peaks within the first seconds of a window can differ slightly
+    from an analysis of that window alone, as the filter and R-peak detector
+    now also see the signal before the window.
+    
+    With n_workers > 1 patients are processed in parallel on a pool of 
+    worker processes. Results are returned in the order of patient_ids (in 
+    window mode, export_all is sorted by patient ID, see export_path). A
+    patient (or window) that fails is left out of the results and recorded 
+    in failures, the batch continues with the other patients.
+    
+    The HRV parameters are collected per column in a 
+    HRV_export.ResultsAccumulator. With export_path, rows are written to a
+    .csv or .parquet file in chunks of chunk_rows while the batch is 
+    running. In window mode the windows are processed in order of time, and
+    the rows of a patient are held until those of all patients with a 
+    smaller ID have been written, so that the file is sorted by patient and
+    time, as export_all (and as per5min.csv before).
+    
+    With cache_dir, the result of every patient-window is stored in a 
+    persistent cache (HRV_cache.py). A rerun, or a run that continues after
+    an interruption, only computes the windows that are not in the cache, 
+    e.g. after a changed parameter. Patients of which all windows are cached
+    are not loaded, their signals are left out of the returned lists.
+    
+    With chunk, the ECG signal is read, filtered and segmented in chunks of
+    chunk seconds (HRV_streaming.py), so that memory use does not grow with 
+    the length of the recording. The dataframes are then not created and 
+    batch_dataframes contains None per patient.
+    
+    With parameters, only the selected HRV parameters are calculated 
+    (hrvcalc.hrv_parameters, e.g. ['rmssd', 'sdnn', 'ratio_lf_hf']) and 
+    export_all only contains these columns.
+    
+    With prefetch > 0, records are loaded ahead on io_threads I/O threads 
+    (HRV_prefetch.py) while the current patients are computed, with at most
+    prefetch records loaded ahead of the computation. This hides the 
+    latency of the MIMIC-III database (and of the record store on slow 
+    disks). In streaming mode (chunk), prefetch chunks are read ahead 
+    within every patient instead.
+    
+    With trace, wall time, CPU time, memory and input size of every stage 
+    (load, dataframe, rpeak, ectopic, hrv and the pyhrv calls within it) are
+    appended per patient and window to a .jsonl file (HRV_trace.py). 
+    HRV_trace.summary(trace) gives the slowest stages and patients. The
+    worker processes of n_workers append to the same file.
+    
+    With a list of leads (or 'all', preproc.ECG_LEADS), all available leads
+    of a record are read at once and scored on signal quality 
+    (preproc.lead_quality). With lead_mode 'select' the R-peaks are detected
+    on the best lead, with 'fusion' on all leads with a sufficient score, 
+    after which the detections are fused (preproc.fuse_rpeaks). A patient
+    without the first lead is then analysed on another lead instead of 
+    failing. The analysed lead is added to export_all as column 'lead'.
+    
+    With gate, every window is screened before the costly stages 
+    (preproc.signal_gate and preproc.beat_gate): windows with too many 
+    missing samples, a flat run or amplitude saturation are skipped before
+    filtering (if all windows of a patient are skipped, the R-peak detection
+    is skipped as well), windows with too few beats, too little coverage, an
+    implausible heart rate or too many ectopic beats are skipped before the 
+    HRV calculations. Skipped windows are recorded in failures with stage 
+    'gate' and a reason code, and the number of skipped windows per reason 
+    is printed at the end of the batch. In streaming mode (chunk) the raw 
+    signal is not kept, so only the beats are screened.
+    
+    With queue_dir, the batch is sharded over several nodes that share a 
+    filesystem (HRV_queue.py): the patients are split in tasks of task_size
+    patients in a work queue in queue_dir, which this call creates (or joins
+    if another node created it) and works on with n_workers processes. 
+    Other nodes join with 'python HRV_queue.py work queue_dir'. Every task 
+    is leased by one node, a task of which the lease is not renewed within
+    lease_timeout seconds is retried by another node. When all tasks are 
+    finished, the results of all nodes are merged in the order of 
+    patient_ids. Signals are not returned in this case, which requires
+    retain = 'results'.
+    
+    For large cohorts, retain limits the memory use of the batch:
+        'all': keep dataframes, R-peaks and nni of all patients in memory
+        'results': only keep the HRV parameters (returned lists are empty)
+        'disk': write dataframes (signals as float32), R-peaks and nni per 
+                patient to spill_dir and return lazy handles in the lists
+                (HRV_recordstore.SpilledDataFrame and SpilledArray), which 
+                can be passed to the visual evaluation functions
+
+    The options are given as BatchOptions, as keyword arguments, or both
+    (keyword arguments replace the options), e.g.:
+        options = BatchOptions(window=300, parameters=['rmssd'])
+        workflow_batch(patient_ids, 125, 'II', 0, 3600, options=options)
+        workflow_batch(patient_ids, 125, 'II', 0, 3600, window=300,
+                       parameters=['rmssd'])
+    Invalid combinations of options raise a ValueError before the batch
+    starts (BatchOptions.validate).
+    
     INPUT:
         patient_ids: .txt file of patient ID from MIMIC-III database
         sampfreq: sampling frequency of recording [Hz]
-        lead: ECG lead for analysis: 'I', "II", "V"
+        lead: ECG lead for analysis: 'I', "II", "V", or a list of leads 
+              (or 'all') from which the lead is chosen per patient
         starttime: starting time of ECG analysis
         endtime: ending time of ECG analysis
+        store: path of local record store, see HRV_recordstore.py
+               (default: None, load from MIMIC-III database)
+        offline: if True, only load records from the record store
+        options: BatchOptions of the batch (default: None,
+                 BatchOptions.DEFAULTS)
+        return_failures: if True, failures is returned as well (default:
+                         False, the number of failures is printed)
+        kwargs: options that replace those of options, see BatchOptions and
+                PatientOptions (windows, window, step, n_workers, engine,
+                retain, cache_dir, chunk, parameters, lead_mode, gate, ...)
     
     OUTPUT:
         batch_dataframes: list containing dataframes with raw ecg,
@@ -39,66 +646,213 @@ def workflow_batch(patient_ids, sampfreq, lead, starttime, endtime):
         batch_nni: list containing arrays with nni per included patient [ms]
         batch_nni_first: list containing arrays with nni per included patient 
                          [ms], before ectopic beat- and outlier removal
-        export_all: dataframe with rows = patients, columns = HRV parameters  
+        export_all: dataframe with rows = patients, columns = HRV parameters.
+                    In window mode: rows = patient per window, columns = 
+                    'time [min]' (start of window), HRV parameters and 
+                    'patientID', sorted by patient and time. None if
+                    export_path is given
+        failures: only with return_failures, dataframe with rows = failed
+                  patients (or windows), columns = 'patient', 'window'
+                  (start of window [s]), 'stage' ('load', 'lead', 'gate',
+                  'dataframe', 'rpeak', 'stream', 'ectopic', 'hrv' or
+                  'queue'), 'error' and 'reason' (reason code of the
+                  quality gate, e.g. 'missing' or 'beats')
     """
+    options = BatchOptions.create(options, **kwargs).validate(lead)
     
-    pt_ids = patient_ids
-    sampling_rate = sampfreq
-    lead = lead
-    starttime = starttime
-    endtime = endtime
+    # Analysis windows
+    windows = options.windows
+    if windows is None and options.window is not None:
+        step = options.window if options.step is None else options.step
+        windows = [(start, start + options.window) for start in
+                   np.arange(starttime, endtime - options.window + 1e-9,
+                             step)]
+    if windows is not None:
+        starttime = min(start for start, end in windows)                        # Load full span of all windows once
+        endtime = max(end for start, end in windows)
     
+    # Read .txt file containing patient IDs
+    with open(patient_ids) as f:
+        lines = [x.strip() for x in list(f) if x.strip()]
+    if windows is not None:
+        windows = sorted(windows, key=lambda window: window[0])                 # Rows of a patient sorted by time
+
+    # For every patient ID calculate HRV parameters
+    patient_options = PatientOptions.create(
+        options, windows=windows,
+        prefetch=options.prefetch if options.chunk is not None else 0)          # Prefetch of chunks within a patient
+    patient = functools.partial(workflow_patient, sampfreq=sampfreq,
+                                lead=lead, starttime=starttime,
+                                endtime=endtime, store=store, offline=offline,
+                                options=patient_options)
+    traced = options.trace is not None and tracer.enabled() is None
+    if traced:
+        tracer.enable(options.trace, options.trace_memory)                      # Forked worker processes inherit the tracer
+    if options.queue_dir is not None:
+        results = _sharded_results(lines, patient, options)
+    else:
+        results = _local_results(lines, patient, options)
+    try:
+        output = collect_results(results, windows is not None, options.retain,
+                                 options.export_path, options.chunk_rows,
+                                 options.array_fields, options.progress,
+                                 lines)
+    finally:
+        results.close()                                                         # Cancel records and stop worker processes
+        if traced:
+            tracer.disable()
+    failures, n_gated = output[6:]
+    if preproc.gate_thresholds(options.gate) is not None:                       # gate={} gates with the default thresholds
+        skipped = failures.reason.value_counts()
+        print('Quality gate: %i windows skipped (%s), R-peak detection '
+              'skipped for %i of %i patients'
+              % (skipped.sum(), ', '.join('%s: %i' % item for item in
+                                          skipped.items()) or '-',
+                 n_gated, len(lines)))
+    if return_failures:
+        return output[:7]
+    if len(failures):
+        print('%i failures (patients or windows), see return_failures'
+              % len(failures))
+    return output[:6]
+
+def collect_results(results, window_mode=False, retain='all',
+                    export_path=None, chunk_rows=100000, array_fields='drop',
+                    progress=False, patients=None):
+    """
+    Function that collects the results of workflow_patient into the output
+    of workflow_batch, while the results arrive.
+
+    INPUT:
+        results: iterable of results of workflow_patient
+        window_mode: if True, export_all is sorted by patient and time
+        retain, export_path, chunk_rows, array_fields, progress: see
+            workflow_batch
+        patients: list with the patient IDs in the order of results. In 
+                  window mode the rows of the HRV parameters are then 
+                  added in order of patient ID, also to export_path
+                  (default: None, in order of results)
+
+    OUTPUT:
+        batch_dataframes, batch_nni_first, batch_rpeaks_first, batch_nni,
+        batch_rpeaks, export_all, failures: see workflow_batch
+        n_gated: number of patients of which all windows failed the signal
+                 gate
+    """
     # Create empty lists for storage of dataframes
     batch_dataframes = list()                                                   
     batch_rpeaks = list()
     batch_rpeaks_first = list()
     batch_nni = list()
     batch_nni_first = list()
-    batch_all = list()
-
-    # Read .txt file containing patient IDs
-    with open(pt_ids) as f:                                                     
-        lines = [x.strip() for x in list(f) if x]
-
-    # For every patient ID calculate HRV parameters
-    for line in lines:
-        print(line)
-        ecg = preproc.load_data(line, sampling_rate, starttime, endtime, lead)  # Load data
-        ecg_df = preproc.ecg_dataframe(ecg, sampling_rate)                      # Preprocessing
-        ecg_df, r_peaks, nni = preproc.ecg_rpeak(ecg_df, sampling_rate)         # R_peak detection and nni calculation
-        r_peaks_ect, nni_ect = preproc.ecg_ectopic_removal(r_peaks, nni)        # Ectopic beat removal 
-        hrv_td, hrv_fd, hrv_nl = hrvcalc.hrv_results(nni=nni_ect,                   # HRV calculations for td: timedomain, fd: frequency domain, nl: nonlinear
-                                                     sampfreq=sampling_rate)
-        hrv_all = pyhrv.utils.join_tuples(hrv_td, hrv_fd, hrv_nl)               # Join tuples of td, fd and nl
-        
-        # Store dataframes per patient in list
-        batch_dataframes.append(ecg_df)                                             
-        batch_rpeaks.append(r_peaks_ect)
-        batch_nni.append(nni_ect)
-        batch_all.append(hrv_all)
-        batch_nni_first.append(nni)
-        batch_rpeaks_first.append(r_peaks)
-        
-    # Exportfile
-    tuplekeys_all = batch_all[0].keys()                                         # Names of HRV parameters
-    matrix_all = []
-            
-    for key in tuplekeys_all:                                                   
-        matrix_all += [batch_all[0][key]]    
-         
-    matrix_all = np.array(matrix_all)                                           # Final matrix with HRV parameters of first patient
+    batch_all = export.ResultsAccumulator(export_path, chunk_rows,             # Columnar storage of HRV parameters
+                                          array_fields)
     
-    for i in range(1,len(batch_all)):                                           # Per patient
-        stack = []
-        
-        for key in tuplekeys_all:
-            stack += [batch_all[i][key]]                                         
-            
-        stack = np.array(stack)
-        matrix_all = np.vstack((matrix_all, stack))                             # Add HRV parameters for patient i to final matrix
+    ranks = None
+    if window_mode and patients is not None:
+        ranks = [0]*len(patients)                                               # Position of every result in order of patient ID
+        for rank, i in enumerate(sorted(range(len(patients)),
+                                        key=patients.__getitem__)):
+            ranks[i] = rank
+        ranks = iter(ranks)
+    pending = dict()                                                            # Rows of patients that are not yet in turn
+    next_rank = 0
+    
+    failures = list()
+    n_gated = 0                                                                 # Patients without R-peak detection
+    try:
+        for result in results:                                                  # Collect results while the batch is running
+            if progress:
+                print(result['patient'])
+            failures += result['failures']
+            n_gated += result['gated']
+            if ranks is None:
+                batch_all.extend(result['hrv'], 
+                                 index=[result['patient']]*len(result['hrv']))
+            else:
+                pending[next(ranks)] = (result['patient'], result['hrv'])       # Signals are not held
+                while next_rank in pending:
+                    patient_id, hrv = pending.pop(next_rank)
+                    batch_all.extend(hrv, index=[patient_id]*len(hrv))
+                    next_rank += 1
+            if not result['hrv']:                                               # Exclude patients without any result
+                continue
+            if retain == 'results' or result['r_peaks'] is None:               # No signals kept, or all windows cached
+                continue
             
-    export_all = pd.DataFrame(matrix_all, index=lines, columns=tuplekeys_all)   # Create dataframe for exportfile
-    export_all = export_all.drop(['dfa_alpha1_beats', 'dfa_alpha2_beats'], axis=1)
-    #export_all.to_csv('HRVparameters.csv')                                      # Write calculated parameters to .csv file
+            # Store dataframes per patient in list
+            batch_dataframes.append(result['ecg_df'])
+            batch_rpeaks.append(result['r_peaks'])
+            batch_nni.append(result['nni'])
+            batch_nni_first.append(result['nni_first'])
+            batch_rpeaks_first.append(result['r_peaks_first'])
+    finally:
+        batch_all.close()                                                       # Write remaining rows to export_path
+    failures = pd.DataFrame(failures, columns=['patient', 'window', 'stage', 
+                                               'error', 'reason'])
+    
+    if export_path is not None:
+        export_all = None                                                       # Parameters are written to export_path
+    else:
+        export_all = batch_all.to_dataframe()                                   # Rows = patients (per window)
+        if window_mode and len(export_all):
+            export_all = export_all.sort_values(['patientID', 'time [min]'],    # Sort by patient, by time
+                                                kind='stable')
         
-    return batch_dataframes, batch_nni_first, batch_rpeaks_first, batch_nni, batch_rpeaks, export_all
\ No newline at end of file
+    return batch_dataframes, batch_nni_first, batch_rpeaks_first, batch_nni, batch_rpeaks, export_all, failures, n_gated
+
+def _local_results(lines, patient, options):
+    # Results of the patients on this node in the order of lines, serially or
+    # on worker processes, with records loaded ahead if prefetch > 0
+    records = None
+    if options.prefetch > 0 and options.chunk is None:
+        loader = functools.partial(_load_record,
+                                   options=patient.keywords['options'],
+                                   **{key: patient.keywords[key] for key in
+                                      ('sampfreq', 'lead', 'starttime',
+                                       'endtime', 'store', 'offline')})
+        records = prefetcher.prefetch(loader, lines, options.prefetch,          # (patient ID, future of record), loaded ahead
+                                      options.io_threads)
+    executor = None
+    try:
+        if options.n_workers == 1 and records is None:
+            for line in lines:
+                yield patient(line)
+        elif options.n_workers == 1:
+            for line, future in records:
+                yield patient(line, record=future)
+        else:
+            executor = ProcessPoolExecutor(max_workers=options.n_workers)
+            if records is None:
+                yield from executor.map(patient, lines,                         # map keeps the order of the patients
+                                        chunksize=options.chunksize)
+            else:
+                yield from prefetcher.bounded_map(                              # Records are sent to the workers when loaded
+                    executor, _patient_record,
+                    ((patient, line, prefetcher.resolve(future))
+                     for line, future in records), 2*options.n_workers)
+    finally:
+        if records is not None:
+            records.close()                                                     # Cancel records that are still loaded ahead
+        if executor is not None:
+            executor.shutdown()
+
+def _sharded_results(lines, patient, options):
+    # Results of the patients on the work queue of HRV_queue.py, after all
+    # nodes finished, in the order of lines
+    import HRV_queue as queue
+    
+    kwargs = dict(patient.keywords, **patient.keywords['options'].as_dict())
+    del kwargs['options']
+    for key in ('retain', 'spill_dir', 'trace', 'trace_memory'):                # Signals and traces are not shared between nodes
+        del kwargs[key]
+    queue.create_queue(options.queue_dir, lines, options.task_size,
+                       options.lease_timeout, **kwargs)
+    if options.n_workers > 1:
+        with ProcessPoolExecutor(max_workers=options.n_workers) as executor:
+            list(executor.map(queue.work, [options.queue_dir]*options.n_workers,
+                              [None]*options.n_workers,
+                              [True]*options.n_workers))
+    else:
+        queue.work(options.queue_dir, wait=True)
+    yield from queue.results(options.queue_dir)
@@ -0,0 +1,787 @@
+# -*- coding: utf-8 -*-
+"""
+HRV benchmarks
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Throughput benchmarks of the HRV pipeline on synthetic data, so that no
+access to the MIMIC-III database is needed (HRV_synthetic.py). Run as script
+to print all benchmarks:
+    python HRV_benchmark.py
+or to run the benchmark suite and write its results to a .json file, which
+can be compared between commits:
+    python HRV_benchmark.py --suite results.json
+    python HRV_benchmark.py --compare old.json results.json
+"""
+#%% Required modules
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import HRV_preprocessing as preproc
+import HRV_nonlinear as nonlin
+import HRV_frequency as freq
+import HRV_export as export
+import HRV_sliding as sliding
+from HRV_synthetic import synthetic_nni, synthetic_ecg
+
+#%% Helpers
+def _timeit(func, *args, repeats=3, **kwargs):
+    # Best wall time of repeated calls [s] and the output of the last call
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, output
+
+#%% Benchmarks
+def benchmark_ectopic_removal(n_beats=(5000, 100000, 300000), repeats=3,
+                              reference=True):
+    """
+    Benchmark of ecg_ectopic_removal, vectorized against reference mode. The
+    output of both modes is tested to be identical in tests/test_ectopic.py.
+
+    INPUT:
+        n_beats: list with lengths of the NNI series
+        repeats: number of repeats per benchmark, best time is reported
+        reference: if True, the reference mode is timed as well
+
+    OUTPUT:
+        result: DataFrame with rows = lengths of NNI series, columns = time
+                [s] and throughput [beats/s] per mode
+    """
+    rows = list()
+    for n in n_beats:
+        r_peaks, nni = synthetic_nni(n)
+        t_vec, _ = _timeit(preproc.ecg_ectopic_removal, r_peaks, nni,
+                           repeats=repeats)
+        row = {'n_beats': n, 'vectorized [s]': t_vec,
+               'vectorized [beats/s]': n/t_vec}
+        if reference:
+            t_ref, _ = _timeit(preproc.ecg_ectopic_removal, r_peaks, nni,
+                               mode='reference', repeats=1)
+            row.update({'reference [s]': t_ref,
+                        'reference [beats/s]': n/t_ref,
+                        'speedup': t_ref/t_vec})
+        rows.append(row)
+    return pd.DataFrame(rows).set_index('n_beats')
+
+def benchmark_nonlinear(durations=(300, 3600, 21600, 86400), repeats=1,
+                        reference_max_beats=20000):
+    """
+    Benchmark of the fast sample entropy and DFA (HRV_nonlinear.py) against
+    pyhrv, for NNI series of 5 minutes up to 24 hours. The pyhrv reference
+    is only timed up to reference_max_beats, as its sample entropy scales
+    with O(n^2). The agreement of both engines is tested in 
+    tests/test_nonlinear.py.
+
+    INPUT:
+        durations: list with durations of the NNI series [s]
+        repeats: number of repeats per benchmark, best time is reported
+        reference_max_beats: longest NNI series for which pyhrv is timed
+
+    OUTPUT:
+        result: DataFrame with rows = durations, columns = time [s] per 
+                parameter and engine
+    """
+    import pyhrv
+    import matplotlib.pyplot as plt
+
+    rows = list()
+    for duration in durations:
+        r_peaks, nni = synthetic_nni(int(duration/0.8), ectopic_rate=0)         # Mean NNI of 800 ms
+        t_se, _ = _timeit(nonlin.sample_entropy, nni, repeats=repeats)
+        t_dfa, _ = _timeit(nonlin.dfa, nni, repeats=repeats)
+        row = {'duration [s]': duration, 'n_beats': len(nni),
+               'sampen fast [s]': t_se, 'dfa fast [s]': t_dfa}
+        if len(nni) <= reference_max_beats:
+            t_se_ref, _ = _timeit(pyhrv.nonlinear.sample_entropy, nni,
+                                  repeats=1)
+            t_dfa_ref, dfa_ref = _timeit(pyhrv.nonlinear.dfa, nni, show=False,
+                                         repeats=1)
+            plt.close(dfa_ref['dfa_plot'])
+            row.update({'sampen pyhrv [s]': t_se_ref,
+                        'dfa pyhrv [s]': t_dfa_ref})
+        rows.append(row)
+    return pd.DataFrame(rows).set_index('duration [s]')
+
+def benchmark_frequency_domain(n_series=(10, 100, 1000), duration=300,
+                               reference_max_series=100):
+    """
+    Benchmark of the batched Welch PSD (HRV_frequency.py) against one call
+    of pyhrv welch_psd per NNI series, as in hrv_results. The agreement of
+    both is tested in tests/test_frequency.py.
+
+    INPUT:
+        n_series: list with numbers of NNI series
+        duration: duration of every NNI series [s]
+        reference_max_series: largest number of series for which pyhrv is
+                              timed
+
+    OUTPUT:
+        result: DataFrame with rows = numbers of series, columns = time [s]
+                per engine
+    """
+    import pyhrv.frequency_domain as fd
+    import matplotlib.pyplot as plt
+    import HRV_calculations as hrvcalc
+
+    rows = list()
+    for n in n_series:
+        series = [synthetic_nni(int(duration/0.8), ectopic_rate=0, seed=i)[1]
+                  for i in range(n)]
+        t_batch, _ = _timeit(freq.welch_psd_batch, series, repeats=1)
+        row = {'n_series': n, 'batch [s]': t_batch}
+        if n <= reference_max_series:
+            start = time.perf_counter()
+            for nni in series:
+                results = fd.welch_psd(nni=nni, fbands=hrvcalc.FBANDS, 
+                                       show=False, mode='normal')
+                plt.close(results['fft_plot'])
+            row['pyhrv [s]'] = time.perf_counter() - start
+        rows.append(row)
+    return pd.DataFrame(rows).set_index('n_series')
+
+def benchmark_export(n_rows=(1000, 10000, 100000), n_parameters=45,
+                     reference_max_rows=10000):
+    """
+    Benchmark of the columnar ResultsAccumulator (HRV_export.py) against
+    stacking one row per patient with np.vstack, as the former export of 
+    workflow_batch. The accumulated rows are tested in tests/test_export.py.
+
+    INPUT:
+        n_rows: list with numbers of rows (patients or windows)
+        n_parameters: number of HRV parameters per row
+        reference_max_rows: largest number of rows for which np.vstack is 
+                            timed, as it scales with O(n^2)
+
+    OUTPUT:
+        result: DataFrame with rows = numbers of rows, columns = time [s] 
+                and throughput [rows/s] per method
+    """
+    rng = np.random.default_rng(0)
+    keys = ['parameter_%i' % i for i in range(n_parameters)]
+    rows = list()
+    for n in n_rows:
+        values = rng.random((n, n_parameters))
+        batch = [dict(zip(keys, row)) for row in values]
+        
+        def accumulate():
+            accumulator = export.ResultsAccumulator()
+            accumulator.extend(batch)
+            return accumulator.to_dataframe()
+        
+        t_acc, _ = _timeit(accumulate, repeats=1)
+        row = {'n_rows': n, 'accumulator [s]': t_acc, 
+               'accumulator [rows/s]': n/t_acc}
+        if n <= reference_max_rows:
+            
+            def stack():
+                matrix = np.array([batch[0][key] for key in keys])
+                for i in range(1, n):
+                    matrix = np.vstack((matrix, 
+                                        np.array([batch[i][key] 
+                                                  for key in keys])))
+                return matrix
+            
+            t_ref, _ = _timeit(stack, repeats=1)
+            row.update({'vstack [s]': t_ref, 'vstack [rows/s]': n/t_ref})
+        rows.append(row)
+    return pd.DataFrame(rows).set_index('n_rows')
+
+def benchmark_sliding(durations=(3600, 86400), window=300, step=30,
+                      reference_windows=50):
+    """
+    Benchmark of the sliding window time domain parameters (HRV_sliding.py)
+    against hrv_results per window. hrv_results is timed on the first 
+    reference_windows windows and extrapolated to all windows. The 
+    agreement of both is tested in tests/test_sliding.py.
+
+    INPUT:
+        durations: list with durations of the NNI series [s]
+        window: length of the windows [s]
+        step: step between the start of consecutive windows [s]
+        reference_windows: number of windows computed with hrv_results
+
+    OUTPUT:
+        result: DataFrame with rows = durations, columns = number of 
+                windows and time [s] per engine
+    """
+    import HRV_calculations as hrvcalc
+
+    rows = list()
+    for duration in durations:
+        r_peaks, nni = synthetic_nni(int(duration/0.8))
+        r_peaks, nni = preproc.ecg_ectopic_removal(r_peaks, nni)
+        t_slide, trend = _timeit(sliding.sliding_time_domain, r_peaks, nni,
+                                 window, step, repeats=1)
+        windows = [(start*60, start*60 + window) 
+                   for start in trend['time [min]'][:reference_windows]]
+        segments = preproc.nni_windows(r_peaks, nni, windows)
+        
+        start = time.perf_counter()
+        for _, nni_window in segments:
+            hrvcalc.hrv_results(nni_window, 125, engine='fast')
+        t_ref = (time.perf_counter() - start) / len(segments) * len(trend)
+        rows.append({'duration [s]': duration, 'n_windows': len(trend), 
+                     'sliding [s]': t_slide, 'hrv_results [s] (est.)': t_ref})
+    return pd.DataFrame(rows).set_index('duration [s]')
+
+def benchmark_rpeak(durations=(3600, 86400), sampfreq=125, chunk=600, 
+                    margin=10, n_workers=4):
+    """
+    Benchmark of R-peak detection: biosppy.signals.ecg.ecg against the 
+    dedicated detection path of ecg_rpeak, on the whole signal and in 
+    chunks on n_workers processes. That all paths find the same R-peaks is
+    tested in tests/test_rpeak.py.
+
+    INPUT:
+        durations: list with durations of the ECG signals [s]
+        sampfreq: sampling frequency [Hz]
+        chunk: length of chunks [s]
+        margin: overlap margin on both sides of a chunk [s]
+        n_workers: number of worker processes for the chunks
+
+    OUTPUT:
+        result: DataFrame with rows = durations, columns = time [s] per 
+                path
+    """
+    rows = list()
+    for duration in durations:
+        signal, _ = synthetic_ecg(duration, sampfreq)
+        ecg_df = pd.DataFrame({'ecg_signal': signal})
+        t_bio, _ = _timeit(preproc.ecg_rpeak, ecg_df, sampfreq, 
+                           method='biosppy', repeats=1)
+        t_fast, _ = _timeit(preproc.ecg_rpeak, ecg_df, sampfreq, repeats=1)
+        t_chunk, _ = _timeit(preproc.ecg_rpeak, ecg_df, sampfreq, chunk=chunk,
+                             margin=margin, n_workers=n_workers, repeats=1)
+        rows.append({'duration [s]': duration, 'biosppy [s]': t_bio,
+                     'fast [s]': t_fast, 
+                     'chunks, %i workers [s]' % n_workers: t_chunk})
+    return pd.DataFrame(rows).set_index('duration [s]')
+
+def benchmark_parameters(durations=(300, 3600, 86400), 
+                         parameters=('rmssd', 'sdnn', 'ratio_lf_hf')):
+    """
+    Benchmark of selective HRV parameters: hrv_results (all parameters) 
+    against hrv_parameters with all parameters and with a selection, with
+    the fast engine. That both give identical values is tested in 
+    tests/test_parameters.py.
+
+    INPUT:
+        durations: list with durations of the NNI series [s]
+        parameters: selection of HRV parameters
+
+    OUTPUT:
+        result: DataFrame with rows = durations, columns = time [s] per 
+                function
+    """
+    import HRV_calculations as hrvcalc
+
+    rows = list()
+    for duration in durations:
+        r_peaks, nni = synthetic_nni(int(duration/0.8))
+        r_peaks, nni = preproc.ecg_ectopic_removal(r_peaks, nni)
+        t_all, _ = _timeit(hrvcalc.hrv_results, nni, 125, engine='fast', 
+                           repeats=1)
+        t_plan, _ = _timeit(hrvcalc.hrv_parameters, nni, engine='fast', 
+                            repeats=1)
+        t_select, _ = _timeit(hrvcalc.hrv_parameters, nni, parameters, 
+                              engine='fast')
+        rows.append({'duration [s]': duration, 'hrv_results [s]': t_all,
+                     'hrv_parameters, all [s]': t_plan,
+                     'hrv_parameters, %s [s]' % ', '.join(parameters): 
+                         t_select})
+    return pd.DataFrame(rows).set_index('duration [s]')
+
+def benchmark_summary(n_rows=(10000, 100000, 1000000), n_parameters=44, 
+                      chunk_rows=100000, path='benchmark_summary.csv'):
+    """
+    Benchmark of the single-pass cohort statistics (HRV_summary.py) against
+    reading the complete export with pandas, with the largest relative 
+    error of the median. The statistics and the merge of partial summaries 
+    are tested in tests/test_summary.py.
+
+    INPUT:
+        n_rows: list with numbers of rows of the export
+        n_parameters: number of HRV parameters per row
+        chunk_rows: number of rows per chunk
+        path: temporary .csv file, removed afterwards
+
+    OUTPUT:
+        result: DataFrame with rows = numbers of rows, columns = time [s] 
+                per method and largest relative error of the quantiles
+    """
+    import HRV_calculations as hrvcalc
+    import HRV_summary as hrvsum
+
+    rng = np.random.default_rng(0)
+    keys = list(hrvcalc.PARAMETERS)[:n_parameters]
+    rows = list()
+    try:
+        for n in n_rows:
+            table = pd.DataFrame(rng.lognormal(3, 1, (n, len(keys))), 
+                                 columns=keys)
+            table.insert(0, 'time [min]', np.arange(n) % 1440)
+            table.to_csv(path)
+            t_sum, summary = _timeit(hrvsum.summarize, path, chunk_rows, 
+                                     repeats=1)
+            
+            def pandas_summary():
+                full = pd.read_csv(path)[keys]
+                return full.mean(), full.std(), full.quantile(0.5)
+            
+            t_ref, (mean, std, median) = _timeit(pandas_summary, repeats=1)
+            error = np.max(np.abs(summary.result().Q50[keys] / median - 1))
+            rows.append({'n_rows': n, 'summarize [s]': t_sum, 
+                         'pandas [s]': t_ref, 'median error [-]': error})
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return pd.DataFrame(rows).set_index('n_rows')
+
+def benchmark_prefetch(n_patients=4, duration=900, latency=0.3, 
+                       bandwidth=1e6, depths=(0, 1, 2, 4), 
+                       directory='benchmark_prefetch'):
+    """
+    Benchmark of prefetching records (HRV_prefetch.py) in workflow_batch, 
+    against a local slow file server that stands in for PhysioNet 
+    (HRV_prefetch.slow_server). The results with and without prefetching 
+    are tested to be identical in tests/test_prefetch.py.
+
+    INPUT:
+        n_patients: number of synthetic patients
+        duration: duration of every record [s]
+        latency: delay of every request to the server [s]
+        bandwidth: transfer rate of the server [bytes/s]
+        depths: list of prefetch depths, 0: no prefetching
+        directory: temporary directory of the server, removed afterwards
+
+    OUTPUT:
+        result: DataFrame with rows = depths, columns = time [s] and 
+                speedup against no prefetching
+    """
+    import shutil
+    import HRV_batchmode as workflow
+    import HRV_prefetch as prefetcher
+
+    patient_ids = os.path.join(directory, 'ids.txt')
+    rows = list()
+    try:
+        lines = list()
+        for i in range(n_patients):
+            patient_id = '30/30%05i' % i
+            signal, _ = synthetic_ecg(duration, 125, seed=i)
+            prefetcher.write_wfdb(directory, patient_id, {'II': signal}, 125)
+            lines.append(patient_id)
+        with open(patient_ids, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        
+        with prefetcher.slow_server(directory, latency, bandwidth):
+            for depth in depths:
+                t, _ = _timeit(workflow.workflow_batch, patient_ids, 125, 'II',
+                               0, duration, window=300, engine='fast', 
+                               retain='results', prefetch=depth, repeats=1)
+                rows.append({'prefetch': depth, 'time [s]': t})
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    result = pd.DataFrame(rows).set_index('prefetch')
+    result['speedup [-]'] = result['time [s]'].iloc[0] / result['time [s]']
+    return result
+
+def benchmark_imports(modules=('HRV_batchmode', 'HRV_preprocessing', 
+                                'HRV_calculations', 'HRV_evaluation', 
+                                'HRV_summary', 'HRV_worker'), 
+                      repeats=3, 
+                      forbidden=('matplotlib', 'pyhrv', 'biosppy', 'wfdb')):
+    """
+    Benchmark of the import time of the HRV modules, each in a new Python 
+    process, with the libraries of the compute path and of plotting 
+    (forbidden) that the import loads. These are imported by the functions
+    that use them, see tests/test_imports.py.
+
+    INPUT:
+        modules: list with names of modules
+        repeats: number of new processes per module, best time is reported
+        forbidden: names of libraries that should not be loaded by an import
+
+    OUTPUT:
+        result: DataFrame with rows = modules, columns = import time [s] 
+                and loaded (forbidden libraries that the import loads), 
+                with the import time of pyhrv for comparison
+    """
+    import subprocess
+    import sys
+    
+    code = ('import json, sys, time; start = time.perf_counter(); '
+            'import %s; print(json.dumps([time.perf_counter() - start, '
+            '[name for name in %r if name in sys.modules]]))')
+    rows = list()
+    for module in tuple(modules) + ('pyhrv', ):
+        best = np.inf
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, '-c', 
+                                     code % (module, tuple(forbidden))], 
+                                    capture_output=True, text=True, check=True,
+                                    cwd=os.path.dirname(os.path.abspath(
+                                        __file__))).stdout
+            seconds, loaded = json.loads(output.splitlines()[-1])
+            best = min(best, seconds)
+        rows.append({'module': module, 'import time [s]': best, 
+                     'loaded': ', '.join(loaded) if module != 'pyhrv' else ''})
+    return pd.DataFrame(rows).set_index('module')
+
+def benchmark_worker(n_requests=5, duration=600, window=300, 
+                     parameters=('rmssd', 'sdnn', 'sampen'), 
+                     directory='benchmark_worker'):
+    """
+    Benchmark of small requests (one patient, a few windows) to a warm 
+    worker (HRV_worker.py), over a socket and a spool directory, against a 
+    new Python process per request. The replies of the worker are tested 
+    in tests/test_worker.py.
+
+    INPUT:
+        n_requests: number of requests per mode
+        duration: duration of the synthetic record [s]
+        window: length of the analysis windows [s]
+        parameters: names of the HRV parameters of every request
+        directory: temporary directory of the record store and spool 
+                   directory, removed afterwards
+
+    OUTPUT:
+        result: DataFrame with rows = modes, columns = mean time per request
+                [s] and speedup against a new process
+    """
+    import shutil
+    import socket
+    import subprocess
+    import sys
+    import HRV_worker as worker
+    import HRV_synthetic as synth
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    store = os.path.join(directory, 'store')
+    spool = os.path.join(directory, 'spool')
+    patient_ids = synth.synthetic_store(store, 1, duration)
+    with open(patient_ids) as f:
+        patient_id = f.readline().strip()
+    job = {'patient_id': patient_id, 'sampfreq': 125, 'lead': 'II', 
+           'starttime': 0, 'endtime': duration, 'store': 
+           os.path.abspath(store), 'offline': True, 'engine': 'fast',
+           'windows': [[start, start + window] 
+                       for start in range(0, duration, window)],
+           'parameters': list(parameters)}
+    cold = ('import json, sys, HRV_worker; '
+            'print(json.dumps(HRV_worker.run_job(json.loads(sys.argv[1])), '
+            'default=float))')
+    with socket.socket() as s:                                                  # Free port for the worker
+        s.bind(('127.0.0.1', 0))
+        address = s.getsockname()
+    
+    def check(reply):
+        if 'error' in reply:                                                    # Invalid job, not a timing
+            raise RuntimeError('Job of the worker failed: %s' % reply['error'])
+    
+    times = {'new process': list(), 'worker (socket)': list(), 
+             'worker (spool)': list()}
+    processes = list()
+    try:
+        for _ in range(n_requests):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, '-c', cold, 
+                                     json.dumps(job)], capture_output=True, 
+                                    text=True, check=True, cwd=here).stdout
+            times['new process'].append(time.perf_counter() - start)
+            check(json.loads(output.splitlines()[-1]))
+        
+        for mode in ('--socket', '--spool'):
+            target = '%s:%i' % address if mode == '--socket' else \
+                os.path.abspath(spool)
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.join(here, 'HRV_worker.py'), mode, 
+                 target], stdout=subprocess.DEVNULL, cwd=here))
+        for _ in range(600):                                                    # Wait until the socket worker is ready
+            try:
+                worker.request(address, {'command': 'ping'})
+                break
+            except OSError:
+                time.sleep(0.1)
+        worker.result(spool, worker.submit(spool, {'command': 'ping'}))
+        
+        for _ in range(n_requests):
+            start = time.perf_counter()
+            reply = worker.request(address, job)
+            times['worker (socket)'].append(time.perf_counter() - start)
+            check(reply)
+            start = time.perf_counter()
+            reply = worker.result(spool, worker.submit(spool, job))
+            times['worker (spool)'].append(time.perf_counter() - start)
+            check(reply)
+        worker.request(address, {'command': 'stop'})
+        worker.result(spool, worker.submit(spool, {'command': 'stop'}))
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+            process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+    result = pd.DataFrame({'time per request [s]': 
+                           {mode: np.mean(t) for mode, t in times.items()}})
+    result['speedup [-]'] = result['time per request [s]'].iloc[0] / \
+        result['time per request [s]']
+    return result
+
+def benchmark_queue(n_patients=6, duration=600, n_processes=(1, 2, 3),
+                    task_size=1, lease_timeout=5, 
+                    directory='benchmark_queue'):
+    """
+    Benchmark of sharded execution on the work queue (HRV_queue.py) with 
+    several worker processes against one queue directory, as nodes of a 
+    cluster. With more than one process, the first worker is killed as 
+    soon as it leases a task, so that its lease expires and the task is 
+    retried by another worker. The merged results are tested in 
+    tests/test_queue.py.
+
+    INPUT:
+        n_patients: number of synthetic patients
+        duration: duration of every record [s]
+        n_processes: list with numbers of worker processes
+        task_size: number of patients per task
+        lease_timeout: lease timeout of the queue [s]
+        directory: temporary directory of the record store and queues, 
+                   removed afterwards
+
+    OUTPUT:
+        result: DataFrame with rows = numbers of worker processes, columns =
+                time [s], finished tasks per worker and retried tasks
+    """
+    import shutil
+    import subprocess
+    import sys
+    import HRV_queue as queue
+    import HRV_synthetic as synth
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    store = os.path.abspath(os.path.join(directory, 'store'))
+    kwargs = {'sampfreq': 125, 'lead': 'II', 'starttime': 0, 
+              'endtime': duration, 'store': store, 'offline': True,
+              'windows': [(start, start + 300) 
+                          for start in range(0, duration - 299, 300)],
+              'engine': 'fast', 
+              'parameters': ['rmssd', 'sdnn', 'sampen', 'sd1']}
+    rows = list()
+    try:
+        patient_ids = synth.synthetic_store(store, n_patients, duration)
+        for n in n_processes:
+            queue_dir = os.path.abspath(os.path.join(directory, 'queue%i' % n))
+            queue.create_queue(queue_dir, patient_ids, task_size, 
+                               lease_timeout, **kwargs)
+            start = time.perf_counter()
+            workers = [subprocess.Popen(
+                [sys.executable, os.path.join(here, 'HRV_queue.py'), 'work',
+                 queue_dir, '--node', 'node%i' % i, '--wait'], cwd=here,
+                stdout=subprocess.DEVNULL) for i in range(n)]
+            if n > 1:
+                while not any(name.endswith('@node0.json') for name in 
+                              os.listdir(os.path.join(queue_dir, 'leased'))):
+                    time.sleep(0.01)
+                workers[0].kill()                                               # Node that stops with a leased task
+            for worker in workers:
+                worker.wait()
+            seconds = time.perf_counter() - start
+            status = queue.status(queue_dir)
+            retried = 0
+            for name in os.listdir(os.path.join(queue_dir, 'done')):
+                with open(os.path.join(queue_dir, 'done', name)) as f:
+                    retried += json.load(f)['attempts'] > 0
+            rows.append({'processes': n, 'time [s]': seconds, 
+                         'tasks per worker': status['nodes'],
+                         'retried tasks': retried})
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return pd.DataFrame(rows).set_index('processes')
+
+#%% Benchmark suite
+def _environment():
+    # Versions, machine and git commit, to compare results between commits
+    import platform
+    import subprocess
+    import scipy
+    import pyhrv
+    import biosppy
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], 
+                                capture_output=True, text=True, 
+                                cwd=os.path.dirname(os.path.abspath(__file__))
+                                ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit,
+            'python': platform.python_version(), 
+            'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'numpy': np.__version__, 'scipy': scipy.__version__, 
+            'pandas': pd.__version__, 'pyhrv': pyhrv.__version__,
+            'biosppy': biosppy.__version__}
+
+def benchmark_suite(path=None, durations=(300, 3600), sampfreq=125, 
+                    ectopic_rate=0.02, gaps=((0, 2), ), n_patients=2, 
+                    engine='fast', repeats=1, seed=0):
+    """
+    Reproducible benchmark of the pipeline on deterministic synthetic data 
+    (HRV_synthetic.py). Per duration the following steps are timed: 
+    ecg_dataframe, ecg_rpeak, ecg_ectopic_removal, hrv_results and its 
+    blocks td, fd and nl (hrv_parameters with the parameters of one 
+    block), and workflow_batch end to end on n_patients synthetic records 
+    read from a temporary record store. 
+    
+    The results are written to a .json file, which can be compared with 
+    the results of another commit with compare_suites:
+        python HRV_benchmark.py --suite results.json
+        python HRV_benchmark.py --compare old.json new.json
+
+    INPUT:
+        path: .json file for the results (default: None, not written)
+        durations: list with durations of the records [s], e.g. 300 to 
+                   259200 (72 hours)
+        sampfreq: sampling frequency [Hz]
+        ectopic_rate: fraction of ectopic beats
+        gaps: list of (start, end) tuples of missing data [s]
+        n_patients: number of patients of workflow_batch
+        engine: engine for sample entropy and DFA, 'pyhrv' or 'fast'
+        repeats: number of repeats per step, the best time is reported
+        seed: seed of the synthetic data
+
+    OUTPUT:
+        suite: dictionary with keys 'environment' (versions, machine and 
+               git commit), 'config' (arguments) and 'results' (list with a
+               dictionary per duration and step, with keys 'duration', 
+               'step', 'time' [s], 'size' (samples or NN intervals) and 
+               'throughput' [size/s])
+    """
+    import tempfile
+    import HRV_calculations as hrvcalc
+    import HRV_batchmode as workflow
+    import HRV_recordstore as recstore
+    import HRV_synthetic as synth
+
+    blocks = {'td': ('time', 'segments', 'triangular'), 'fd': ('frequency', ),
+              'nl': ('poincare', 'entropy', 'dfa')}                             # Kernels of hrv_parameters per block of hrv_results
+    results = list()
+
+    def record(duration, step, seconds, size):
+        results.append({'duration': duration, 'step': step, 'time': seconds,
+                        'size': int(size), 'throughput': size / seconds})
+
+    for duration in durations:
+        signal, _ = synth.synthetic_ecg(duration, sampfreq, ectopic_rate, 
+                                        gaps, seed)
+        ecg = recstore.StoredRecord('%07i' % seed, sampfreq, ['II'], 
+                                    signal[:, np.newaxis])
+        t, ecg_df = _timeit(preproc.ecg_dataframe, ecg, sampfreq, 
+                            repeats=repeats)
+        record(duration, 'ecg_dataframe', t, len(signal))
+        t, (ecg_df, r_peaks, nni) = _timeit(preproc.ecg_rpeak, ecg_df, 
+                                            sampfreq, repeats=repeats)
+        record(duration, 'ecg_rpeak', t, len(signal))
+        t, (r_peaks, nni) = _timeit(preproc.ecg_ectopic_removal, r_peaks, nni,
+                                    repeats=repeats)
+        record(duration, 'ecg_ectopic_removal', t, len(nni))
+        t, _ = _timeit(hrvcalc.hrv_results, nni, sampfreq, engine=engine, 
+                       repeats=repeats)
+        record(duration, 'hrv_results', t, len(nni))
+        for block, kernels in blocks.items():
+            names = [name for name, (kernel, unit) in hrvcalc.PARAMETERS.items()
+                     if kernel in kernels]
+            t, _ = _timeit(hrvcalc.hrv_parameters, nni, names, engine=engine, 
+                           repeats=repeats)
+            record(duration, 'hrv_results_' + block, t, len(nni))
+        del signal, ecg, ecg_df
+        
+        with tempfile.TemporaryDirectory() as store:
+            patient_ids = synth.synthetic_store(store, n_patients, duration, 
+                                                sampfreq, 'II', ectopic_rate,
+                                                gaps, seed)
+            t, output = _timeit(workflow.workflow_batch, patient_ids, 
+                                sampfreq, 'II', 0, duration, store=store, 
+                                offline=True, engine=engine, 
+                                retain='results', return_failures=True, 
+                                repeats=repeats)
+            if len(output[6]) > 0:
+                raise AssertionError('workflow_batch failed for %i s: %s' 
+                                     % (duration, output[6].iloc[0].error))
+            record(duration, 'workflow_batch', t, 
+                   n_patients*int(duration*sampfreq))
+
+    suite = {'environment': _environment(), 
+             'config': {'durations': list(durations), 'sampfreq': sampfreq,
+                        'ectopic_rate': ectopic_rate, 
+                        'gaps': [list(gap) for gap in gaps],
+                        'n_patients': n_patients, 'engine': engine, 
+                        'repeats': repeats, 'seed': seed},
+             'results': results}
+    if path is not None:
+        with open(path, 'w') as f:
+            json.dump(suite, f, indent=1)
+    return suite
+
+def compare_suites(old, new):
+    """
+    Function that compares the results of two runs of benchmark_suite.
+
+    INPUT:
+        old: .json file or dictionary with results of benchmark_suite
+        new: .json file or dictionary with results of benchmark_suite
+
+    OUTPUT:
+        result: DataFrame with rows = (duration, step), columns = time [s] 
+                of old and new and ratio new / old (> 1: slower)
+    """
+    tables = list()
+    for suite in (old, new):
+        if isinstance(suite, str):
+            with open(suite) as f:
+                suite = json.load(f)
+        tables.append(pd.DataFrame(suite['results'])
+                      .set_index(['duration', 'step'])['time'])
+    result = pd.concat(tables, axis=1, keys=['old [s]', 'new [s]'])
+    result['ratio'] = result['new [s]'] / result['old [s]']
+    return result
+
+#%% Run all benchmarks
+if __name__ == '__main__':
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='HRV benchmarks, without '
+                                     'arguments all benchmarks are printed.')
+    parser.add_argument('--suite', metavar='JSON', 
+                        help='run benchmark_suite and write results to JSON')
+    parser.add_argument('--durations', type=int, nargs='+', 
+                        default=[300, 3600], help='durations of the suite [s]')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two results of benchmark_suite')
+    args = parser.parse_args()
+    
+    if args.suite is not None:
+        suite = benchmark_suite(args.suite, durations=args.durations)
+        print(pd.DataFrame(suite['results']).set_index(['duration', 'step']))
+    elif args.compare is not None:
+        print(compare_suites(*args.compare))
+    else:
+        print(benchmark_ectopic_removal())
+        print(benchmark_nonlinear())
+        print(benchmark_frequency_domain())
+        print(benchmark_export())
+        print(benchmark_sliding())
+        print(benchmark_rpeak())
+        print(benchmark_parameters())
+        print(benchmark_summary())
+        print(benchmark_prefetch())
+        print(benchmark_imports())
+        print(benchmark_worker())
+        print(benchmark_queue())
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+HRV cache
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Persistent cache of HRV results per patient and analysis window. Every entry
+is a small .json file named after the sha256 hash of everything the result
+depends on: patient ID, lead, sampling frequency, loaded span, analysis
+window, engine, selected parameters, frequency bands, ectopic beat
+thresholds and the code version
+(a hash of the source of the analysis modules and the pyhrv and biosppy
+versions). A changed parameter therefore gives a new key, and only the
+affected patient-windows are recomputed.
+
+Entries are written as soon as a window is analysed, so a batch that is
+interrupted resumes where it stopped. Failures are not cached, they are
+retried on the next run.
+
+Cache layout:
+    cache_dir/
+        3f/
+            3f2a...e1.json
+"""
+#%% Required modules
+import functools
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+ANALYSIS_MODULES = ('HRV_preprocessing', 'HRV_calculations', 'HRV_nonlinear',  # Modules that determine the HRV results
+                    'HRV_export', 'HRV_streaming', 'HRV_batchmode',             # Windowing, gating and NNI windows
+                    'HRV_sliding')
+
+#%% Keys
+@functools.lru_cache(maxsize=None)
+def code_version():
+    """
+    Function that returns a hash of the source code of the analysis modules
+    and the versions of pyhrv and biosppy.
+    """
+    import importlib
+    import pyhrv
+    import biosppy
+
+    digest = hashlib.sha256()
+    for name in ANALYSIS_MODULES:
+        with open(importlib.import_module(name).__file__, 'rb') as f:
+            digest.update(f.read())
+    digest.update(pyhrv.__version__.encode())
+    digest.update(biosppy.__version__.encode())
+    return digest.hexdigest()
+
+def analysis_config(engine='pyhrv', stream=None, parameters=None, 
+                    lead_mode=None, gate=None):
+    """
+    Function that returns the analysis configuration that is part of every
+    cache key.
+
+    INPUT:
+        engine: engine for sample entropy and DFA, 'pyhrv' or 'fast'
+        stream: (chunk, margin) of streaming R-peak detection [s], or None
+        parameters: list with names of the selected HRV parameters, or None
+                    (all parameters, hrv_results)
+        lead_mode: 'select' or 'fusion' with several leads, or None (one 
+                   lead)
+        gate: quality gate, see HRV_preprocessing.gate_thresholds (default:
+              None, no gating)
+
+    OUTPUT:
+        config: dictionary with engine, streaming chunks, selected 
+                parameters, lead selection, quality gate thresholds, 
+                frequency bands, ectopic beat thresholds and code version
+    """
+    import HRV_calculations as hrvcalc
+    import HRV_preprocessing as preproc
+
+    if parameters is not None:
+        parameters = hrvcalc.parameter_plan(parameters)[0]                      # Same key for any order of the names
+    if lead_mode is not None:
+        lead_mode = (lead_mode, preproc.QUALITY)                                # Quality score determines the lead
+    return {'engine': engine, 'stream': stream, 'parameters': parameters,
+            'lead_mode': lead_mode, 'gate': preproc.gate_thresholds(gate),      # A gated run does not reuse rows of an ungated run
+            'fbands': hrvcalc.FBANDS, 
+            'ectopic': preproc.ECTOPIC_THRESHOLDS, 'code': code_version()}
+
+def cache_key(patient_id, lead, sampfreq, span, window, config):
+    """
+    Function that computes the cache key of one patient-window.
+
+    INPUT:
+        patient_id: ID number of patient, as in files_id.txt
+        lead: ECG lead for analysis
+        sampfreq: sampling frequency of recording [Hz]
+        span: (starttime, endtime) of the loaded ECG signal [s]
+        window: (start, end) of the analysis window [s], or None
+        config: dictionary with the analysis configuration, see
+                analysis_config
+
+    OUTPUT:
+        key: sha256 hash (hexadecimal string)
+    """
+    content = {'patient': patient_id, 'lead': lead, 'fs': sampfreq,
+               'span': _to_json(span), 'window': _to_json(window),
+               'config': config}
+    text = json.dumps(content, sort_keys=True, default=_to_json)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def _to_json(value):
+    # numpy scalars, arrays and ranges as JSON types
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, (range, np.ndarray, list, tuple)):
+        return [_to_json(x) for x in value]
+    return value
+
+def _entry_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key + '.json')
+
+#%% Entries
+def read_entry(cache_dir, key):
+    """
+    Function that reads a cached row with HRV parameters. The modification
+    time of a read entry is updated, so that evict removes the least
+    recently used entries first.
+
+    INPUT:
+        cache_dir: path of the cache
+        key: cache key, see cache_key
+
+    OUTPUT:
+        row: dictionary with HRV parameters, or None if not cached
+    """
+    fname = _entry_path(cache_dir, key)
+    try:
+        with open(fname) as f:
+            row = json.load(f)['row']
+    except (OSError, ValueError, KeyError):                                     # Not cached or incomplete entry
+        return None
+    os.utime(fname)
+    return row
+
+def write_entry(cache_dir, key, row):
+    """
+    Function that writes a row with HRV parameters to the cache. The entry
+    is written to a temporary file first, so that an interrupted write never
+    leaves an incomplete entry.
+
+    INPUT:
+        cache_dir: path of the cache
+        key: cache key, see cache_key
+        row: dictionary with HRV parameters
+    """
+    fname = _entry_path(cache_dir, key)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp = '%s.%i.tmp' % (fname, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({'row': row}, f, default=_to_json)
+    os.replace(tmp, fname)
+
+def _entries(cache_dir):
+    # (path, modification time, size) of all entries
+    entries = list()
+    if not os.path.isdir(cache_dir):
+        return entries
+    for root, dirs, files in os.walk(cache_dir):
+        for fname in files:
+            if fname.endswith('.json'):
+                stat = os.stat(os.path.join(root, fname))
+                entries.append((os.path.join(root, fname), stat.st_mtime,
+                                stat.st_size))
+    return entries
+
+def cache_info(cache_dir):
+    """
+    Function that returns the number of entries and total size [bytes] of
+    the cache.
+    """
+    entries = _entries(cache_dir)
+    return {'entries': len(entries),
+            'size': sum(size for _, _, size in entries)}
+
+def evict(cache_dir, max_age=None, max_size=None):
+    """
+    Function that removes entries from the cache. Entries older than max_age
+    are removed first, after which the least recently used entries are
+    removed until the cache is not larger than max_size.
+
+    INPUT:
+        cache_dir: path of the cache
+        max_age: maximum time since the last use of an entry [s]
+                 (default: None, no limit)
+        max_size: maximum total size of the cache [bytes]
+                  (default: None, no limit)
+
+    OUTPUT:
+        removed: number of removed entries
+    """
+    entries = sorted(_entries(cache_dir), key=lambda entry: entry[1])           # Least recently used first
+    now = time.time()
+    size = sum(entry[2] for entry in entries)
+    removed = 0
+    for fname, mtime, fsize in entries:
+        too_old = max_age is not None and now - mtime > max_age
+        too_large = max_size is not None and size > max_size
+        if not (too_old or too_large):                                          # All remaining entries are more recent
+            break
+        os.remove(fname)
+        size -= fsize
+        removed += 1
+    return removed
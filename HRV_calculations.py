@@ -4,19 +4,37 @@ HRV calculations
 Created: 10/2021 - 02/2022
 Python v3.8
 Author: M. Verboom
+
+hrv_results computes all HRV parameters. hrv_parameters computes only a
+selection of named parameters (e.g. rmssd, sdnn and ratio_lf_hf for a
+dashboard): the requested parameters are planned onto kernels (PARAMETERS),
+only the required kernels run, and intermediates that pyhrv recomputes in
+every function (NN interval differences, heart rate series, 5-minute
+segments) are computed once and shared between the kernels.
 """
+import functools
+import warnings
+
+import numpy as np
+
+# The HRV toolbox (pyhrv), biosppy and matplotlib are imported in the
+# functions that use them, so that the parameter registry can be used 
+# without importing them (see HRV_worker.py)
 
-# HRV toolbox
-import pyhrv
-import pyhrv.time_domain as td
-import pyhrv.frequency_domain as fd
+# Fast nonlinear HRV parameters
+import HRV_nonlinear as nonlin
+import HRV_trace as tracer
 
-# biosppy
-import biosppy
+#%% Frequency bands and frequency domain parameters
+FBANDS = {'ulf': (0.00, 0.003), 'vlf': (0.003, 0.04), 'lf': (0.04, 0.15),
+          'hf': (0.15, 0.4)}                                                    # Frequency bands [Hz]
+FD_PARAMETERS = ('abs_ulf', 'abs_vlf', 'abs_lf', 'abs_hf', 'rel_ulf', 'rel_vlf',
+                 'rel_lf', 'rel_hf', 'log_ulf', 'log_vlf', 'log_lf', 'log_hf',
+                 'norm_lf', 'norm_hf', 'ratio_lf_hf', 'total_power')
 
 #%% Created functions
 
-def hrv_results(nni, sampfreq):
+def hrv_results(nni, sampfreq, engine='pyhrv'):
     """
     Function that uses pyHRV toolbox to calculate HRV parameters.
     Reference: https://github.com/PGomes92/pyhrv/tree/master/pyhrv
@@ -24,6 +42,8 @@ def hrv_results(nni, sampfreq):
     INPUT:
         nni: array with nni series of a patient [ms]
         sampfreq: sampling frequency of recording [Hz]
+        engine: engine for sample entropy and DFA: 'pyhrv' (default) or 
+                'fast' (HRV_nonlinear.py, for long NNI series)
     
     OUTPUT:
         results_td: ReturnTuple containing HRV parameters of Time Domain 
@@ -31,28 +51,45 @@ def hrv_results(nni, sampfreq):
         results_nl: ReturnTuple containing HRV parameters of Nonlinear analysis
         
     """
+    import pyhrv
+    import pyhrv.time_domain as td
+    import pyhrv.frequency_domain as fd
+    import pyhrv.nonlinear
+    import biosppy.utils
+    import matplotlib.pyplot as plt
     
     # Time domain parameters
-    nnpar = td.nni_parameters(nni=nni)                                           # n of intervals, mean, min and max nn interval
-    nndif = td.nni_differences_parameters(nni=nni)                               # n of interval differences, mean, min and max of nn interval differences
-    hr = td.hr_parameters(nni=nni)                                               # mean, min, max std of HR
-    sdnn = td.sdnn(nni=nni)                                                      # standard deviation of NN interval series
-    sdnni = td.sdnn_index(nni=nni, full=False, duration=300, warn=True)          # mean of std of all NN intervals within 5 minute intervals [ms]
-    sdann = td.sdann(nni=nni, full=False, overlap=False, duration=300,           # std of the mean nni value of each segment    
-                     warn=True)
-    rmssd = td.rmssd(nni=nni)                                                    # root mean of square differences of successive NN intervals
-    sdsd = td.sdsd(nni=nni)                                                      # std of differences of successive NN intervals
-    nn50 = td.nn50(nni=nni)                                                      # NN differences > 50 ms                                              
-    triang = td.triangular_index(nni=nni, binsize=7.8125, plot=False,            # triangular index bas on NN interval histogram
-                                 show=False)                        
+    with tracer.stage('hrv.nni_parameters'):
+        nnpar = td.nni_parameters(nni=nni)                                       # n of intervals, mean, min and max nn interval
+    with tracer.stage('hrv.nni_differences_parameters'):
+        nndif = td.nni_differences_parameters(nni=nni)                           # n of interval differences, mean, min and max of nn interval differences
+    with tracer.stage('hrv.hr_parameters'):
+        hr = td.hr_parameters(nni=nni)                                           # mean, min, max std of HR
+    with tracer.stage('hrv.sdnn'):
+        sdnn = td.sdnn(nni=nni)                                                  # standard deviation of NN interval series
+    with tracer.stage('hrv.sdnn_index'):
+        sdnni = td.sdnn_index(nni=nni, full=False, duration=300, warn=True)      # mean of std of all NN intervals within 5 minute intervals [ms]
+    with tracer.stage('hrv.sdann'):
+        sdann = td.sdann(nni=nni, full=False, overlap=False, duration=300,       # std of the mean nni value of each segment    
+                         warn=True)
+    with tracer.stage('hrv.rmssd'):
+        rmssd = td.rmssd(nni=nni)                                                # root mean of square differences of successive NN intervals
+    with tracer.stage('hrv.sdsd'):
+        sdsd = td.sdsd(nni=nni)                                                  # std of differences of successive NN intervals
+    with tracer.stage('hrv.nn50'):
+        nn50 = td.nn50(nni=nni)                                                  # NN differences > 50 ms                                              
+    with tracer.stage('hrv.triangular_index'):
+        triang = td.triangular_index(nni=nni, binsize=7.8125, plot=False,        # triangular index bas on NN interval histogram
+                                     show=False)                        
     results_td = pyhrv.utils.join_tuples(nnpar, nndif, hr, sdnn, sdnni, sdann,   # Create ReturnTuple containing all time domain parameters
                                          rmssd, sdsd, nn50, triang)
        
          
     # Frequency domain
-    fbands={'ulf': (0.00, 0.003), 'vlf': (0.003, 0.04), 'lf': (0.04, 0.15),
-            'hf': (0.15, 0.4)}
-    results = fd.welch_psd(nni=nni, fbands=fbands, show=False, mode='normal')
+    with tracer.stage('hrv.welch_psd'):
+        results = fd.welch_psd(nni=nni, fbands=FBANDS, show=False, 
+                               mode='normal')
+    plt.close(results['fft_plot'])                                              # Only the parameters are used
    
     # Unwrap ReturnTuple object results, only take desired paramaters 
     abs_ulf = results[2][0]
@@ -75,19 +112,235 @@ def hrv_results(nni, sampfreq):
                                            rel_ulf, rel_vlf, rel_lf, rel_hf,
                                            log_ulf, log_vlf, log_lf, log_hf,
                                            norm_lf, norm_hf, ratio_lf_hf, 
-                                           total_power), ('abs_ulf', 'abs_vlf',
-                                                          'abs_lf', 'abs_hf',
-                                                          'rel_ulf', 'rel_vlf',
-                                                          'rel_lf', 'rel_hf',
-                                                          'log_ulf', 'log_vlf',
-                                                          'log_lf', 'log_hf',
-                                                          'norm_lf', 'norm_hf',
-                                                          'ratio_lf_hf',
-                                                          'total_power'))
+                                           total_power), FD_PARAMETERS)
     
     # Nonlinear analysis
-    poincare = pyhrv.nonlinear.poincare(nni=nni, show=False)                    # Compute poincare plot and parameters
-    entropy = pyhrv.nonlinear.sample_entropy(nni)                               # Calculate sample entropy
-    dfa = pyhrv.nonlinear.dfa(nni, show=False)                                  # Perform DFA analysis
+    with tracer.stage('hrv.poincare'):
+        poincare = pyhrv.nonlinear.poincare(nni=nni, show=False)                # Compute poincare plot and parameters
+    if engine == 'fast':
+        with tracer.stage('hrv.sample_entropy'):
+            entropy = nonlin.sample_entropy(nni)                                # Calculate sample entropy
+        with tracer.stage('hrv.dfa'):
+            dfa = nonlin.dfa(nni)                                               # Perform DFA analysis
+    elif engine == 'pyhrv':
+        with tracer.stage('hrv.sample_entropy'):
+            entropy = pyhrv.nonlinear.sample_entropy(nni)                       # Calculate sample entropy
+        with tracer.stage('hrv.dfa'):
+            dfa = pyhrv.nonlinear.dfa(nni, show=False)                          # Perform DFA analysis
+    else:
+        raise ValueError("Unknown engine '%s', use 'pyhrv' or 'fast'." % engine)
     results_nl = pyhrv.utils.join_tuples(poincare, entropy, dfa)
-    return results_td, results_fd, results_nl
\ No newline at end of file
+    return results_td, results_fd, results_nl
+
+#%% Selective HRV parameters
+PARAMETERS = {                                                                  # Name: (kernel, unit), in the order of the joined results of hrv_results
+    'nni_counter': ('time', '[-]'),
+    'nni_mean': ('time', '[ms]'),
+    'nni_min': ('time', '[ms]'),
+    'nni_max': ('time', '[ms]'),
+    'nni_diff_mean': ('time', '[ms]'),
+    'nni_diff_min': ('time', '[ms]'),
+    'nni_diff_max': ('time', '[ms]'),
+    'hr_mean': ('time', '[bpm]'),
+    'hr_min': ('time', '[bpm]'),
+    'hr_max': ('time', '[bpm]'),
+    'hr_std': ('time', '[bpm]'),
+    'sdnn': ('time', '[ms]'),
+    'sdnn_index': ('segments', '[ms]'),
+    'sdann': ('segments', '[ms]'),
+    'rmssd': ('time', '[ms]'),
+    'sdsd': ('time', '[ms]'),
+    'nn50': ('time', '[-]'),
+    'pnn50': ('time', '[%]'),
+    'tri_index': ('triangular', '[-]'),
+    'abs_ulf': ('frequency', '[ms2]'),
+    'abs_vlf': ('frequency', '[ms2]'),
+    'abs_lf': ('frequency', '[ms2]'),
+    'abs_hf': ('frequency', '[ms2]'),
+    'rel_ulf': ('frequency', '[%]'),
+    'rel_vlf': ('frequency', '[%]'),
+    'rel_lf': ('frequency', '[%]'),
+    'rel_hf': ('frequency', '[%]'),
+    'log_ulf': ('frequency', '[-]'),
+    'log_vlf': ('frequency', '[-]'),
+    'log_lf': ('frequency', '[-]'),
+    'log_hf': ('frequency', '[-]'),
+    'norm_lf': ('frequency', '[n.u.]'),
+    'norm_hf': ('frequency', '[n.u.]'),
+    'ratio_lf_hf': ('frequency', '[-]'),
+    'total_power': ('frequency', '[ms2]'),
+    'sd1': ('poincare', '[ms]'),
+    'sd2': ('poincare', '[ms]'),
+    'sd_ratio': ('poincare', '[-]'),
+    'ellipse_area': ('poincare', '[ms2]'),
+    'sampen': ('entropy', '[-]'),
+    'dfa_alpha1': ('dfa', '[-]'),
+    'dfa_alpha2': ('dfa', '[-]'),
+    'dfa_alpha1_beats': ('dfa', '[beats]'),
+    'dfa_alpha2_beats': ('dfa', '[beats]')}
+
+class _Intermediates:
+    # Intermediates shared by the kernels, computed on first use
+    def __init__(self, nni):
+        self.nni = nni
+
+    @functools.cached_property
+    def nn(self):
+        import pyhrv
+        return pyhrv.utils.check_input(self.nni, None)                          # NN intervals [ms]
+
+    @functools.cached_property
+    def nnd(self):
+        return np.abs(np.diff(self.nn))                                         # Absolute NN interval differences, as pyhrv.tools.nni_diff
+
+    @functools.cached_property
+    def hr(self):
+        return 60000. / self.nn                                                 # Heart rate series [bpm]
+
+    @functools.cached_property
+    def segments(self):
+        import pyhrv
+        return pyhrv.utils.segmentation(self.nn, full=False, duration=300,      # 5-minute segments, for sdnn_index and sdann
+                                        warn=True)
+
+def _std(values):
+    # Standard deviation with ddof = 1, identical to pyhrv.utils.std
+    return np.sqrt(1. / (values.size - 1) * np.sum((values - values.mean())**2))
+
+def _time_kernel(shared, names, engine):
+    # Time domain parameters in one kernel: each of the NNI, their 
+    # differences and the heart rate is reduced once for all requested 
+    # parameters, and the means are shared by the standard deviations
+    values = dict()
+    if names & {'nni_counter', 'nni_mean', 'nni_min', 'nni_max', 'sdnn',
+                'hr_min', 'hr_max'}:
+        nn = shared.nn
+        nn_mean, nn_min, nn_max = nn.mean(), nn.min(), nn.max()
+        values.update(nni_counter=int(nn.size), nni_mean=nn_mean,
+                      nni_min=nn_min, nni_max=nn_max,
+                      sdnn=np.sqrt(1. / (nn.size - 1) * 
+                                   np.sum((nn - nn_mean)**2)),
+                      hr_min=60000. / nn_max, hr_max=60000. / nn_min)           # Division is monotonic, extremes of the heart rate series
+    if names & {'nni_diff_mean', 'nni_diff_min', 'nni_diff_max', 'rmssd',
+                'sdsd', 'nn50', 'pnn50'}:
+        nnd = shared.nnd
+        nnd_mean = nnd.mean()
+        nn50 = np.sum(nnd > 50)
+        values.update(nni_diff_mean=float(nnd_mean),
+                      nni_diff_min=int(nnd.min()), nni_diff_max=int(nnd.max()),
+                      rmssd=np.sqrt(1. / nnd.size * np.sum(nnd**2)),
+                      sdsd=np.sqrt(1. / (nnd.size - 1) * 
+                                   np.sum((nnd - nnd_mean)**2)),
+                      nn50=nn50, pnn50=nn50 / nnd.size * 100)
+    if names & {'hr_mean', 'hr_std'}:
+        hr = shared.hr
+        values.update(hr_mean=hr.mean(), hr_std=hr.std(ddof=1))
+    return values
+
+def _segment_kernel(shared, names, engine):
+    # sdnn_index and sdann of one segmentation, as pyhrv.time_domain
+    import pyhrv
+    segments, seg = shared.segments
+    if not seg:
+        if 'sdann' in names:
+            warnings.warn("Signal duration too short for SDANN computation.")
+        return {'sdnn_index': float('nan'), 'sdann': float('nan')}
+    segments = [np.asarray(segment, dtype=np.float64) for segment in segments]
+    return {'sdnn_index': np.mean([_std(segment) for segment in segments]),
+            'sdann': pyhrv.utils.std([np.mean(segment) 
+                                      for segment in segments])}
+
+def _triangular_kernel(shared, names, engine):
+    import pyhrv.time_domain as td
+    return td.triangular_index(nni=shared.nn, binsize=7.8125, plot=False,
+                               show=False).as_dict()
+
+def _frequency_kernel(shared, names, engine):
+    # Welch PSD without figure (mode 'dev'), parameters as hrv_results
+    import pyhrv.frequency_domain as fd
+    psd = fd.welch_psd(nni=shared.nn, fbands=FBANDS, show=False, 
+                       mode='dev')[0]
+    values = (tuple(psd['fft_abs']) + tuple(psd['fft_rel']) + 
+              tuple(psd['fft_log']) + tuple(psd['fft_norm']) + 
+              (psd['fft_ratio'], psd['fft_total']))
+    return dict(zip(FD_PARAMETERS, values))
+
+def _poincare_kernel(shared, names, engine):
+    import pyhrv.nonlinear
+    return pyhrv.nonlinear.poincare(nni=shared.nn, show=False, 
+                                    mode='dev').as_dict()
+
+def _entropy_kernel(shared, names, engine):
+    if engine == 'fast':
+        return nonlin.sample_entropy(shared.nn).as_dict()
+    import pyhrv.nonlinear
+    return pyhrv.nonlinear.sample_entropy(shared.nn).as_dict()
+
+def _dfa_kernel(shared, names, engine):
+    if engine == 'fast':
+        return nonlin.dfa(shared.nn).as_dict()
+    import pyhrv.nonlinear
+    return pyhrv.nonlinear.dfa(shared.nn, show=False, mode='dev').as_dict()
+
+KERNELS = {'time': _time_kernel, 'segments': _segment_kernel,
+           'triangular': _triangular_kernel, 'frequency': _frequency_kernel,
+           'poincare': _poincare_kernel, 'entropy': _entropy_kernel,
+           'dfa': _dfa_kernel}
+
+def parameter_plan(parameters=None):
+    """
+    Function that plans the computation of a selection of HRV parameters.
+    
+    INPUT:
+        parameters: list with names of HRV parameters, see PARAMETERS 
+                    (default: None, all parameters)
+    
+    OUTPUT:
+        names: tuple with the requested names, in the order of PARAMETERS
+        plan: dictionary with kernel as key and set of requested names of 
+              that kernel as value, in the order in which the kernels run
+    """
+    if parameters is None:
+        parameters = PARAMETERS
+    if isinstance(parameters, str):
+        parameters = [parameters]
+    unknown = [name for name in parameters if name not in PARAMETERS]
+    if unknown:
+        raise ValueError('Unknown HRV parameter(s) %s, see '
+                         'HRV_calculations.PARAMETERS.' % unknown)
+    names = tuple(name for name in PARAMETERS if name in set(parameters))
+    plan = dict()
+    for name in names:
+        plan.setdefault(PARAMETERS[name][0], set()).add(name)
+    return names, plan
+
+def hrv_parameters(nni, parameters=None, engine='pyhrv'):
+    """
+    Function that calculates a selection of HRV parameters. Only the 
+    kernels of the requested parameters run (see parameter_plan), and the 
+    intermediates they have in common are computed once. The values are 
+    identical to those of hrv_results, no figures are created.
+    
+    INPUT:
+        nni: array with nni series of a patient [ms]
+        parameters: list with names of HRV parameters, see PARAMETERS 
+                    (default: None, all parameters)
+        engine: engine for sample entropy and DFA: 'pyhrv' (default) or 
+                'fast' (HRV_nonlinear.py, for long NNI series)
+    
+    OUTPUT:
+        results: ReturnTuple containing the requested HRV parameters, with 
+                 the keys of the joined results of hrv_results
+    """
+    import biosppy.utils
+    
+    if engine not in ('pyhrv', 'fast'):
+        raise ValueError("Unknown engine '%s', use 'pyhrv' or 'fast'." % engine)
+    names, plan = parameter_plan(parameters)
+    shared = _Intermediates(nni)
+    values = dict()
+    for kernel, kernel_names in plan.items():
+        with tracer.stage('hrv.' + kernel):
+            values.update(KERNELS[kernel](shared, kernel_names, engine))
+    return biosppy.utils.ReturnTuple(tuple(values[name] for name in names),
+                                     names)
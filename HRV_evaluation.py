@@ -4,15 +4,30 @@ HRV analysis
 Created: 10/2021 - 02/2022
 Python v3.8
 Author: M. Verboom
+
+Visual evaluation of R-peak detection and NNI correction. By default the 
+plots are interactive pyplot figures. With qc_dir, the evaluation renders 
+QC images instead: one .png file per patient (or per patient-window), 
+rendered headless with the Agg backend and released as soon as it is saved.
+The ECG signal is decimated to the minimum and maximum per pixel column 
+(minmax_decimate), which looks the same as plotting all samples, and all 
+R-peaks are drawn as one collection. Patients can be rendered in parallel 
+on worker processes (n_workers).
 """
 
 #%% Required modules
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+
+# pyplot is imported in the interactive functions, so that importing this 
+# module (e.g. for the QC images on worker processes) does not load it
 
 #%% Visual evaluation of R peaks
-def visual_evaluation_rpeaks(batch_df, batch_rpeaks):
+def visual_evaluation_rpeaks(batch_df, batch_rpeaks, qc_dir=None, labels=None,
+                             windows=None, n_workers=1):
     """
     Function that creates a plot for the visual evaluation of R-peak detection.
     The plot that is created shows the raw ECG signal with all detected R-peaks
@@ -23,18 +38,32 @@ def visual_evaluation_rpeaks(batch_df, batch_rpeaks):
                           filtered ecg and time of all patients
         batch_rpeaks: list containing all locations of r-peaks for all 
                       patients [s]   
+        Both lists may also contain lazy handles to data spilled to disk 
+        (workflow_batch with retain = 'disk').
+        qc_dir: directory for QC images (default: None, interactive plots)
+        labels: list with a label (e.g. patient ID) per patient, used in the
+                file names of the QC images (default: None, index)
+        windows: list of (start, end) tuples [s], relative to the first 
+                 sample, with a QC image per window (default: None, one 
+                 image per patient)
+        n_workers: number of worker processes for the QC images
     
     OUTPUT:
-        plot with raw ECG signal and detected R-peaks
+        plot with raw ECG signal and detected R-peaks, or with qc_dir:
+        files: list with the paths of the QC images
     """
+    if qc_dir is not None:
+        return _qc_batch(_qc_rpeaks, (batch_df, batch_rpeaks), qc_dir, labels,
+                         windows, n_workers)
     
-    
+    import matplotlib.pyplot as plt
+
     for i in np.arange(0, len(batch_df), 1):
         dataset = batch_df[i]
         data = dataset.ecg_signal
         time = dataset.Time
         time = [x-time.iloc[0] for x in time]
-        rpiek = batch_rpeaks[i]
+        rpiek = np.asarray(batch_rpeaks[i])
     
         plt.figure()
         plt.plot(time, data, 'c', label='Raw ECG signal')
@@ -50,7 +79,8 @@ def visual_evaluation_rpeaks(batch_df, batch_rpeaks):
 #%% Visual evalation of NNI series
 
 def visual_evaluation_nni(batch_nni, batch_rpeaks, batch_nni_first,
-                          batch_rpeaks_first):
+                          batch_rpeaks_first, qc_dir=None, labels=None, 
+                          windows=None, n_workers=1):
     """
     Function that creates a plot for the visual evaluation of NNI correction.
     The plot that is created shows the NNI series before and after removal of
@@ -63,16 +93,28 @@ def visual_evaluation_nni(batch_nni, batch_rpeaks, batch_nni_first,
         batch_rpeaks: list containing arrays with rpeak locations [s]
         batch_rpeaks_first: list containing array with rpeak locations [s]-
                             before ectopic beat- and outlier removal
+        All lists may also contain lazy handles to data spilled to disk 
+        (workflow_batch with retain = 'disk').
+        qc_dir, labels, windows, n_workers: QC images, see 
+                                            visual_evaluation_rpeaks
     
     OUTPUT:
-        plot with NNI series before and after ectopic beat- and outlier removal
+        plot with NNI series before and after ectopic beat- and outlier 
+        removal, or with qc_dir:
+        files: list with the paths of the QC images
     """
+    if qc_dir is not None:
+        return _qc_batch(_qc_nni, (batch_nni, batch_rpeaks, batch_nni_first,
+                                   batch_rpeaks_first), qc_dir, labels, 
+                         windows, n_workers)
+    
+    import matplotlib.pyplot as plt
     
     for i in np.arange(0, len(batch_nni), 1):
-        rpeak = batch_rpeaks[i]
-        rpeak_first = batch_rpeaks_first[i]
-        nni = batch_nni[i]
-        nni_first = batch_nni_first[i]
+        rpeak = np.asarray(batch_rpeaks[i])
+        rpeak_first = np.asarray(batch_rpeaks_first[i])
+        nni = np.asarray(batch_nni[i])
+        nni_first = np.asarray(batch_nni_first[i])
         plt.figure()
         plt.plot(rpeak_first[:-1], nni_first, 'm-o',
                  label='Before ectopic beat removal')
@@ -81,59 +123,194 @@ def visual_evaluation_nni(batch_nni, batch_rpeaks, batch_nni_first,
         plt.ylabel('NNI [ms]', fontsize=20)
         plt.legend(loc=2, prop={'size': 20})
         
+#%% QC images
+def minmax_decimate(x, y, n_columns):
+    """
+    Function that decimates a line to the minimum and maximum of y per 
+    column of x (e.g. per pixel column of the figure). The decimated line 
+    covers the same pixels as the full line. NaN values are ignored.
+    
+    INPUT:
+        x: array with sorted x values (e.g. time [s])
+        y: array with y values
+        n_columns: number of columns
+        
+    OUTPUT:
+        x_dec: array with x value of every column, twice
+        y_dec: array with minimum and maximum of every column
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if len(y) <= 2 * n_columns:
+        return x, y
+    bounds = np.linspace(x[0], x[-1], n_columns + 1)[:-1]
+    starts = np.unique(np.searchsorted(x, bounds, side='left'))                 # First point of every non-empty column
+    y_min = np.fmin.reduceat(y, starts)
+    y_max = np.fmax.reduceat(y, starts)
+    return np.repeat(x[starts], 2), np.column_stack((y_min, y_max)).ravel()
+
+def _qc_figure(size, dpi):
+    # Figure that is not managed by pyplot, rendered with Agg (headless)
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    
+    fig = Figure(figsize=(size[0] / dpi, size[1] / dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    return fig, fig.add_subplot(111)
+
+def _qc_fname(qc_dir, label, kind, window):
+    # File name of a QC image, patient IDs contain '/'
+    name = str(label).strip('/').replace('/', '_') + '_' + kind
+    if window is not None:
+        name += '_%is' % window[0]
+    return os.path.join(qc_dir, name + '.png')
+
+def _in_window(x, window):
+    # Indices of the sorted x values within the window
+    if window is None:
+        return slice(0, len(x))
+    return slice(np.searchsorted(x, window[0]), 
+                 np.searchsorted(x, window[1]))
+
+def _qc_rpeaks(label, qc_dir, windows, size, dpi, dataset, rpiek):
+    # QC images of the R-peaks of one patient
+    time = np.asarray(dataset.Time, dtype=np.float64)
+    time = time - time[0]
+    data = np.asarray(dataset.ecg_signal, dtype=np.float64)
+    rpiek = np.asarray(rpiek, dtype=np.float64)
+    files = list()
+    for window in windows or [None]:
+        fig, ax = _qc_figure(size, dpi)
+        samples = _in_window(time, window)
+        peaks = rpiek[_in_window(rpiek, window)]
+        x, y = minmax_decimate(time[samples], data[samples], size[0])
+        ax.plot(x, y, 'c', linewidth=0.5, label='Raw ECG signal')
+        ax.vlines(peaks, 0, 1, transform=ax.get_xaxis_transform(),             # One collection for all R-peaks
+                  color='m', linewidth=0.5, label='Detected R-peaks')
+        if window is not None:
+            ax.set_xlim(window)
+        ax.set_title('%s, %i R-peaks' % (label, len(peaks)))
+        ax.set_xlabel('Time [s]')
+        ax.set_ylabel('Amplitude [mV]')
+        ax.legend(loc=2)
+        files.append(_qc_fname(qc_dir, label, 'rpeaks', window))
+        fig.savefig(files[-1])
+        del fig, ax                                                             # Not kept by pyplot, released here
+    return files
+
+def _qc_nni(label, qc_dir, windows, size, dpi, nni, rpeak, nni_first, 
+            rpeak_first):
+    # QC images of the NNI correction of one patient
+    nni = np.asarray(nni, dtype=np.float64)
+    rpeak = np.asarray(rpeak, dtype=np.float64)[:len(nni)]
+    nni_first = np.asarray(nni_first, dtype=np.float64)
+    rpeak_first = np.asarray(rpeak_first, dtype=np.float64)[:len(nni_first)]
+    files = list()
+    for window in windows or [None]:
+        fig, ax = _qc_figure(size, dpi)
+        for x, y, style, name in ((rpeak_first, nni_first, 'm', 
+                                   'Before ectopic beat removal'),
+                                  (rpeak, nni, 'c', 
+                                   'After ectopic beat removal')):
+            beats = _in_window(x, window)
+            x, y = minmax_decimate(x[beats], y[beats], size[0])
+            ax.plot(x, y, style, linewidth=0.5, label=name)
+        if window is not None:
+            ax.set_xlim(window)
+        ax.set_title(str(label))
+        ax.set_xlabel('Time of R-peak [s]')
+        ax.set_ylabel('NNI [ms]')
+        ax.legend(loc=2)
+        files.append(_qc_fname(qc_dir, label, 'nni', window))
+        fig.savefig(files[-1])
+        del fig, ax
+    return files
+
+def _qc_batch(render, batch, qc_dir, labels, windows, n_workers, 
+              size=(1600, 400), dpi=100):
+    # QC images of all patients, optionally on worker processes
+    os.makedirs(qc_dir, exist_ok=True)
+    labels = list(range(len(batch[0]))) if labels is None else labels
+    jobs = [(label, qc_dir, windows, size, dpi) + tuple(data) 
+            for label, data in zip(labels, zip(*batch))]
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(render, *zip(*jobs)))                   # map keeps the order of the patients
+    else:
+        results = [render(*job) for job in jobs]
+    return [fname for files in results for fname in files]
+
 #%% Histogram of all calculated HRV parameters        
         
-def hrv_distribution(dfhist):
+def hrv_distribution(dfhist, chunk_rows=100000, edges=None, out_dir=None):
     """
     Function that creates histograms of all calculated HRV parameters. Mean 
     value and standard deviation are illustrated on the computed histograms.
+    The export is read in chunks (HRV_summary.py), so it does not have to 
+    fit in memory; units are taken from HRV_calculations.PARAMETERS. The 
+    statistics are computed in one pass; for parameters without fixed 
+    edges, the bin edges follow from the minimum and maximum of this pass
+    and the values are counted exactly in a second pass.
     
     INPUT: 
-        dfhist: string of .csv file name with all HRV parameters
+        dfhist: string of .csv or .parquet file name with all HRV parameters,
+                or a HRV_summary.StreamingSummary (e.g. merged partial 
+                summaries of parallel workers), of which histograms without
+                fixed edges are filled from the quantile sketch
+        chunk_rows: number of rows read at once
+        edges: dictionary with fixed bin edges per HRV parameter (default: 
+               None, 20 bins between minimum and maximum)
+        out_dir: directory of the .png files (default: None, interactive 
+                 plots, saved in the working directory)
         
     OUTPUT: 
         histogram per HRV parameter
         result: DataFrame containing mean value and standard deviation per 
-                HRV parameters   
+                HRV parameters, followed by count, quantiles and unit   
     """
+    import HRV_summary as hrvsum
     
-    dfhist = pd.read_csv(dfhist)                                                # Read .csv file
-    col = list(dfhist.columns)                                                  # Take names of HRV parameters    
-    col = col[2:-1]
-    unit = ['test', 'time [ms]', 'time [ms]', 'time [ms]', 'x', 'x', 'x',       # Units per HRV parameter, for plotting purposes
-            '[bpm]', '[bpm]', '[bpm]', '[bpm]', '[ms]', '[ms]', '[ms]', '[ms]',
-            '[ms]','count', '[%]', '[-]', '[ms2]', '[ms2]', '[ms2]', '[ms2]',
-            '[ms2]', '[ms2]', '[ms2]', '[ms2]', '[-]', '[-]', '[-]', '[-]',
-            '[%]', '[%]', '-', '[ms2]', '[ms]', '[ms]', '[-]', '[-]', '[-]',
-            '[beats]', '[beats]' ]
-   
-    # Create empty lists for mean and standard deviation
-    mean = list()                           
-    std = list()
+    if isinstance(dfhist, hrvsum.StreamingSummary):
+        summary = dfhist
+    else:
+        summary = hrvsum.summarize(dfhist, chunk_rows, edges=edges)
+        result = summary.result()
+        default = dict()
+        for col in summary.columns:
+            if col in summary.edges or result.loc[col, 'Count'] == 0:
+                continue
+            default[col] = np.histogram_bin_edges(                              # 20 bins between minimum and maximum, as np.histogram
+                [], 20, (result.loc[col, 'Min'], result.loc[col, 'Max']))
+        if default:
+            summary = hrvsum.summarize(dfhist, chunk_rows,                      # Second pass: exact counts
+                                       edges=dict(summary.edges, **default))
+    result = summary.result()
     
-    for i in np.arange(0, dfhist.shape[1]-3, 1):
-        a = dfhist[col[i]].mean()
-        b = dfhist[col[i]].std()
-        mean.append(a)
-        std.append(b)
-        
-        # Create histogram per column of dfhist
-        plt.figure()
-        dfhist.iloc[:,i+2].hist(alpha=0.5, color = 'c', bins=20)
-        plt.title(col[i], fontsize=20)
-        plt.xlabel(unit[i], fontsize=12)
-        plt.ylabel('count [-]', fontsize=12)
-        plt.axvline(mean[i], color='m', alpha=0.7, label='mean value')
-        plt.axvspan((mean[i]-std[i]), (mean[i]+std[i]), alpha=0.2,
-                    color='plum', label='standard deviation')
-        plt.legend()
-        plt.savefig(col[i]+ '.png')
+    if out_dir is None:
+        import matplotlib.pyplot as plt
     
-    # Create DataFrame containing mean and standard deviation per HRV parameter
-    result = pd.DataFrame(data=[mean,std]) 
-    result = result.set_axis(col, 'columns') 
-    result = result.T 
-    result = result.set_axis(['Mean', 'Std'], 'columns')
+    for col in summary.columns:
+        if result.loc[col, 'Count'] == 0:
+            continue
+        mean, std = result.loc[col, 'Mean'], result.loc[col, 'Std']
+        counts, bins = summary.histogram(col)
+        
+        # Create histogram per HRV parameter
+        if out_dir is None:
+            fig, ax = plt.subplots()
+        else:
+            fig, ax = _qc_figure((640, 480), 100)
+        ax.hist(bins[:-1], bins=bins, weights=counts, alpha=0.5, color='c')
+        ax.grid(True)
+        ax.set_title(col, fontsize=20)
+        ax.set_xlabel(result.loc[col, 'Unit'], fontsize=12)
+        ax.set_ylabel('count [-]', fontsize=12)
+        ax.axvline(mean, color='m', alpha=0.7, label='mean value')
+        if np.isfinite(std):
+            ax.axvspan(mean - std, mean + std, alpha=0.2, color='plum', 
+                       label='standard deviation')
+        ax.legend()
+        fig.savefig(col + '.png' if out_dir is None else 
+                    os.path.join(out_dir, col + '.png'))
     
     return result
-        
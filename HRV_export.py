@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+HRV export
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Columnar accumulator for the HRV parameters of a batch. Every HRV parameter
+is stored in its own preallocated, typed numpy column. Rows are appended in
+amortized O(1) (the columns double in size when full), and with a path the
+rows are written to a .csv or .parquet file in chunks while the batch is
+still running, so that tables of millions of windows never have to be kept
+in memory.
+
+Not every field of the pyhrv results is a scalar:
+    - plot fields (matplotlib figures, e.g. 'poincare_plot') are closed and
+      dropped by hrv_row, before a row leaves the worker process
+    - array fields (e.g. 'dfa_alpha1_beats', the range of box sizes of the
+      DFA) are dropped, or stored as two columns '<name>_min' and
+      '<name>_max' with array_fields = 'bounds'
+"""
+#%% Required modules
+import os
+
+import numpy as np
+import pandas as pd
+
+PLOT_FIELDS = ('poincare_plot', 'dfa_plot', 'nni_histogram', 'fft_plot')      # Fields of pyhrv results containing a figure
+ARRAY_FIELDS = ('dfa_alpha1_beats', 'dfa_alpha2_beats')                       # Fields of pyhrv results containing an array
+
+#%% Rows
+def hrv_row(hrv_all):
+    """
+    Function that converts the joined ReturnTuple of hrv_results into a
+    dictionary of exportable fields. Figures are closed and left out, array
+    fields are kept and handled by the ResultsAccumulator.
+
+    INPUT:
+        hrv_all: ReturnTuple with HRV parameters of td, fd and nl
+
+    OUTPUT:
+        row: dictionary with name as key and value of every HRV parameter
+    """
+    row = dict()
+    for key in hrv_all.keys():
+        value = hrv_all[key]
+        if key in PLOT_FIELDS:
+            if value is not None:
+                import matplotlib.pyplot as plt
+                plt.close(value)                                                # pyplot keeps figures open until closed
+            continue
+        row[key] = value
+    return row
+
+#%% Accumulator
+class ResultsAccumulator:
+    """
+    Accumulator of rows with HRV parameters, stored per column. The columns
+    and their types are taken from the first row: integers as int64, other
+    numbers as float64 and all other values (e.g. patient IDs) as object.
+    An integer column is converted to float64 when a non-integer value (or
+    a missing value) arrives. For .parquet files integers are stored as
+    float64 from the start, so that all chunks have the same schema. Fields
+    that are not in the first row raise a ValueError, fields that are
+    missing in a row are stored as NaN.
+
+    INPUT:
+        path: .csv or .parquet file to which rows are written in chunks
+              (default: None, all rows are kept in memory)
+        chunk_rows: number of rows after which a chunk is written to path
+        array_fields: 'drop' (default) or 'bounds', see module docstring
+        index: name of the index of the exported table (default: None)
+        capacity: initial number of rows of the columns
+    """
+
+    def __init__(self, path=None, chunk_rows=100000, array_fields='drop',
+                 index=None, capacity=1024):
+        if array_fields not in ('drop', 'bounds'):
+            raise ValueError("Unknown array_fields '%s', use 'drop' or "
+                             "'bounds'." % array_fields)
+        if path is not None and not path.endswith(('.csv', '.parquet')):
+            raise ValueError("Unknown file type of '%s', use .csv or "
+                             ".parquet." % path)
+        self.path = path
+        self._parquet = path is not None and path.endswith('.parquet')
+        self.chunk_rows = chunk_rows
+        self.array_fields = array_fields
+        self.index_name = index
+        self.capacity = capacity
+        self.columns = None                                                     # Names of columns, fixed by first row
+        self._data = dict()                                                     # Column name: preallocated array
+        self._array_keys = None                                                 # Array fields of first row
+        self._int_keys = set()                                                  # Integer and bool columns
+        self._index = np.empty(capacity, dtype=object)
+        self._n = 0                                                             # Rows in memory
+        self.n_written = 0                                                      # Rows written to path
+        self._writer = None                                                     # Parquet writer
+
+    def __len__(self):
+        return self.n_written + self._n
+
+    def _fields(self, row):
+        # Scalar fields of a row, array fields dropped or split in bounds
+        if self._array_keys is not None and not any(
+                key in row for key in self._array_keys):
+            return row
+        fields = dict()
+        for key, value in row.items():
+            if key in ARRAY_FIELDS or isinstance(value, (range, np.ndarray,
+                                                         list, tuple)):
+                if self.array_fields == 'bounds':
+                    value = np.asarray(value)
+                    empty = value.size == 0
+                    fields[key + '_min'] = np.nan if empty else value.min()
+                    fields[key + '_max'] = np.nan if empty else value.max()
+                continue
+            fields[key] = value
+        return fields
+
+    def _create_columns(self, row, fields):
+        # Typed columns from the first row
+        self.columns = list(fields)
+        self._array_keys = [key for key in row if key not in fields]
+        for key, value in fields.items():
+            if isinstance(value, (bool, np.bool_)):
+                dtype = bool
+            elif isinstance(value, (int, np.integer)):
+                dtype = np.float64 if self._parquet else np.int64
+            elif isinstance(value, (float, np.floating)):
+                dtype = np.float64
+            else:
+                dtype = object
+            self._data[key] = np.empty(self.capacity, dtype=dtype)
+        self._int_keys = {key for key, column in self._data.items()
+                          if column.dtype.kind in 'bi'}
+
+    def _grow(self):
+        # Double the capacity of all columns
+        self.capacity *= 2
+        for key, column in self._data.items():
+            grown = np.empty(self.capacity, dtype=column.dtype)
+            grown[:self._n] = column[:self._n]
+            self._data[key] = grown
+        grown = np.empty(self.capacity, dtype=object)
+        grown[:self._n] = self._index[:self._n]
+        self._index = grown
+
+    def _to_float(self, key):
+        # Integer column receives a missing or non-integer value
+        self._data[key] = self._data[key].astype(np.float64)
+        self._int_keys.discard(key)
+
+    def append(self, row, index=None):
+        """
+        Function that appends one row.
+
+        INPUT:
+            row: dictionary with name as key and value of HRV parameters
+            index: index label of the row (e.g. patient ID)
+        """
+        fields = self._fields(row)
+        if self.columns is None:
+            self._create_columns(row, fields)
+        if fields.keys() != self._data.keys():
+            unknown = [key for key in fields if key not in self._data]
+            if unknown:
+                raise ValueError('Field(s) %s not in the columns of the first '
+                                 'row.' % unknown)
+            fields = {key: fields.get(key, np.nan) for key in self.columns}     # Missing fields
+        if self._n == self.capacity:
+            self._grow()
+        n = self._n
+        data = self._data
+        for key, value in fields.items():
+            if key in self._int_keys and not isinstance(value, (int, 
+                                                                np.integer)):   # bool is a subclass of int
+                self._to_float(key)
+            data[key][n] = value
+        self._index[n] = index
+        self._n += 1
+        if self.path is not None and self._n >= self.chunk_rows:
+            self.flush()
+
+    def extend(self, rows, index=None):
+        """
+        Function that appends several rows, index is a list with an index
+        label per row (default: None).
+        """
+        index = [None]*len(rows) if index is None else index
+        for row, label in zip(rows, index):
+            self.append(row, label)
+
+    def to_dataframe(self):
+        """
+        Function that returns the rows in memory (all rows if no path is
+        given) as a DataFrame with typed columns.
+        """
+        if self.columns is None:
+            return pd.DataFrame()
+        data = {key: self._data[key][:self._n] for key in self.columns}
+        index = pd.Index(self._index[:self._n], name=self.index_name)
+        if all(label is None for label in self._index[:self._n]):
+            index = pd.RangeIndex(self.n_written, self.n_written + self._n,
+                                  name=self.index_name)
+        return pd.DataFrame(data, index=index, copy=True)
+
+    def flush(self):
+        """
+        Function that writes the rows in memory to path and empties the
+        columns, the allocated capacity is reused for the next chunk.
+        """
+        if self.path is None or self._n == 0:
+            return
+        chunk = self.to_dataframe()
+        if not self._parquet:
+            chunk.to_csv(self.path, mode='w' if self.n_written == 0 else 'a',
+                         header=self.n_written == 0)
+        else:
+            self._write_parquet(chunk)
+        self.n_written += self._n
+        self._n = 0
+        self._index[:] = None
+
+    def _write_parquet(self, chunk):
+        # Append chunk as a row group to the parquet file (requires pyarrow)
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('pyarrow is required to write .parquet files, '
+                              'use a .csv file instead.')
+        table = pa.Table.from_pandas(chunk, preserve_index=True)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, table.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        """
+        Function that writes the remaining rows to path and closes the file.
+        """
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        elif self.path is not None and self.n_written == 0 and \
+                not os.path.exists(self.path):
+            open(self.path, 'w').close()                                        # Empty export, no rows
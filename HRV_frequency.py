@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+HRV frequency domain
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Batched frequency domain analysis of many NNI series (e.g. all windows of all
+patients). hrv_results calls pyhrv.frequency_domain.welch_psd once per NNI
+series. Here all series are resampled first, after which the Welch PSDs of
+all series are computed with one stacked FFT and the frequency bands are
+integrated with one matrix product. The parameters are the same as the
+frequency domain parameters of hrv_results (HRV_calculations.FD_PARAMETERS).
+"""
+#%% Required modules
+import numpy as np
+
+# pyhrv and scipy are imported in the functions that use them, so that an
+# import of this module stays fast (see tests/test_imports.py)
+import HRV_calculations as hrvcalc
+
+#%% Resampling
+def resample_nni(nni, fs=4):
+    """
+    Function that resamples an NNI series on a uniform time grid with cubic
+    interpolation and removes the mean, as pyhrv.frequency_domain.welch_psd.
+
+    INPUT:
+        nni: array with nni series [ms]
+        fs: resampling frequency [Hz]
+
+    OUTPUT:
+        t: time of every NN interval [ms], starting at 0
+        nn_interpol: resampled and detrended nni series [ms]
+    """
+    import pyhrv
+    import scipy.interpolate
+
+    nn = pyhrv.utils.check_input(nni, None)
+    t = np.cumsum(nn)
+    t -= t[0]
+    f_interpol = scipy.interpolate.interp1d(t, nn, 'cubic')
+    t_interpol = np.arange(t[0], t[-1], 1000./fs)
+    nn_interpol = f_interpol(t_interpol)
+    return t, nn_interpol - np.mean(nn_interpol)
+
+#%% Frequency parameters
+def band_parameters(frequencies, powers, fbands=None):
+    """
+    Function that integrates the PSDs of many series over the frequency bands
+    and computes the frequency domain parameters of hrv_results.
+
+    INPUT:
+        frequencies: array with frequencies of the PSDs [Hz], equally spaced
+        powers: 2D array with rows = series, columns = PSD [ms^2/Hz]
+        fbands: dictionary with 'ulf', 'vlf', 'lf' and 'hf' frequency bands
+                (default: HRV_calculations.FBANDS)
+
+    OUTPUT:
+        parameters: 2D array with rows = series, columns =
+                    HRV_calculations.FD_PARAMETERS
+    """
+    fbands = hrvcalc.FBANDS if fbands is None else fbands
+    df = frequencies[1] - frequencies[0]
+    bands = np.array([(fbands[key][0] <= frequencies) &
+                      (frequencies <= fbands[key][1])                           # Band limits included, as pyhrv
+                      for key in ('ulf', 'vlf', 'lf', 'hf')], dtype=float)
+
+    abs_power = powers @ bands.T * df                                           # Absolute power per band [ms^2]
+    total_power = abs_power.sum(axis=1, keepdims=True)
+    lf, hf = abs_power[:, 2:3], abs_power[:, 3:4]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rel_power = abs_power / total_power * 100                               # Relative power [%]
+        log_power = np.log(abs_power)
+        norm_power = 100 * np.hstack((lf, hf)) / (lf + hf)                      # Normalized LF and HF power
+        ratio = lf / hf
+    return np.hstack((abs_power, rel_power, log_power, norm_power, ratio,
+                      total_power))
+
+#%% Welch's method
+def welch_psd_batch(nni_series, fbands=None, nfft=2**12, window='hamming',
+                    fs=4, max_segments=4096):
+    """
+    Function that computes the frequency domain parameters of many NNI series
+    with Welch's method, identical (up to floating point rounding) to
+    fd.welch_psd in hrv_results.
+
+    The series are resampled on a uniform 4 Hz grid. As in pyhrv, series
+    shorter than 300 s are analysed as one segment, longer series in
+    segments of 300 samples with 50% overlap. The (detrended and windowed)
+    segments of all series are stacked in one array, so that one FFT call
+    computes the periodograms of all segments. The PSD per series is the
+    mean of its segments.
+
+    INPUT:
+        nni_series: list of arrays with nni series [ms]
+        fbands: dictionary with frequency bands (default:
+                HRV_calculations.FBANDS)
+        nfft: number of points of the FFT
+        window: spectral window of the segments
+        fs: resampling frequency [Hz]
+        max_segments: maximum number of segments per FFT call, limits memory
+                      use to about max_segments * nfft * 24 bytes
+
+    OUTPUT:
+        parameters: 2D array with rows = series, columns =
+                    HRV_calculations.FD_PARAMETERS
+    """
+    import scipy.signal
+
+    frequencies = np.fft.rfftfreq(nfft, 1./fs)
+    psd = np.zeros((len(nni_series), len(frequencies)))
+
+    # Detrended and windowed segments of all series, with their scaling
+    segments, scales, owners = list(), list(), list()
+
+    def flush():
+        # Periodograms of all collected segments with one FFT
+        stack = np.zeros((len(segments), nfft))
+        for i, segment in enumerate(segments):
+            stack[i, :len(segment)] = segment
+        power = np.abs(np.fft.rfft(stack, n=nfft, axis=1))**2
+        power *= np.array(scales)[:, np.newaxis]
+        power[:, 1:-1 if nfft % 2 == 0 else None] *= 2                          # One-sided PSD, Nyquist frequency not doubled
+        np.add.at(psd, np.array(owners), power)
+        segments.clear(), scales.clear(), owners.clear()
+
+    counts = np.zeros(len(nni_series))
+    for i, nni in enumerate(nni_series):
+        t, nn_interpol = resample_nni(nni, fs)
+        nperseg = nfft if t.max() < 300000 else 300                             # As pyhrv
+        nperseg = min(nperseg, len(nn_interpol))                                # As scipy.signal.welch
+        step = nperseg - nperseg//2
+        win = scipy.signal.get_window(window, nperseg)
+        scale = 1.0 / (fs * (win*win).sum())
+        n_segments = (len(nn_interpol) - nperseg//2) // step
+        for start in np.arange(n_segments) * step:
+            segment = nn_interpol[start:start + nperseg]
+            segments.append((segment - segment.mean()) * win)                   # Constant detrending per segment
+            scales.append(scale)
+            owners.append(i)
+        counts[i] = n_segments
+        if len(segments) >= max_segments:
+            flush()
+    if segments:
+        flush()
+
+    psd /= counts[:, np.newaxis]                                                # Mean over segments
+    return band_parameters(frequencies, psd, fbands)
+
+#%% Lomb-Scargle periodogram
+def lomb_psd_batch(nni_series, fbands=None, nfft=None, ofac=4,
+                   max_elements=2**22):
+    """
+    Function that computes the frequency domain parameters of many NNI series
+    with the Lomb-Scargle periodogram. The periodogram is computed directly
+    on the unevenly spaced NN intervals, no interpolation is needed. The
+    periodogram is scaled to a one-sided PSD [ms^2/Hz], so that band powers
+    are comparable to welch_psd_batch.
+
+    A spectral peak of a series of duration T has a width of about 1/T. By
+    default the frequencies of every series are therefore spaced 1/(ofac*T)
+    apart (oversampling factor ofac). This resolves the ULF band (0-0.003
+    Hz) with at least 3 frequencies above 0 Hz for a 5-minute series. A
+    fixed grid of nfft frequencies, as pyhrv.frequency_domain.lomb_psd (2**8
+    up to 0.41 Hz, about 0.0016 Hz apart), misses narrow peaks of long
+    series and puts only 2 frequencies in the ULF band. The computation 
+    time grows with the number of beats times T: about 0.02 s for 5 
+    minutes, 2 s for 1 hour and 90 s for 6 hours of NNI. For long series a 
+    fixed nfft, or welch_psd_batch, is much faster.
+
+    INPUT:
+        nni_series: list of arrays with nni series [ms]
+        fbands: dictionary with frequency bands (default:
+                HRV_calculations.FBANDS)
+        nfft: number of frequencies between 0 Hz and the upper limit of the
+              HF band, the same for all series (default: None, spacing of 
+              1/(ofac*T) per series)
+        ofac: oversampling factor of the frequencies if nfft is None
+        max_elements: maximum number of beats times frequencies per call of
+                      scipy.signal.lombscargle, limits memory use to about
+                      max_elements * 24 bytes
+
+    OUTPUT:
+        parameters: 2D array with rows = series, columns =
+                    HRV_calculations.FD_PARAMETERS
+    """
+    import pyhrv
+    import scipy.signal
+
+    fbands = hrvcalc.FBANDS if fbands is None else fbands
+    parameters = list()
+    for nni in nni_series:
+        nn = pyhrv.utils.check_input(nni, None)
+        t = np.cumsum(nn) / 1000                                                # Time of every NN interval [s]
+        t -= t[0]
+        if nfft is None:
+            frequencies = np.arange(0, fbands['hf'][1], 1 / (ofac * t[-1]))
+        else:
+            frequencies = np.linspace(0, fbands['hf'][1], nfft)
+        psd = np.zeros((1, len(frequencies)))                                   # Power at 0 Hz is undefined and set to 0
+        step = max(1, max_elements // len(t))
+        for start in range(1, len(frequencies), step):                          # Blocks of frequencies, scipy uses beats x frequencies memory
+            power = scipy.signal.lombscargle(
+                t, nn - nn.mean(), 2*np.pi*frequencies[start:start + step])
+            psd[0, start:start + step] = 2 * power * t[-1] / len(nn)            # Scale to one-sided PSD [ms^2/Hz]
+        parameters.append(band_parameters(frequencies, psd, fbands))
+    return np.vstack(parameters) if parameters else \
+        np.empty((0, len(hrvcalc.FD_PARAMETERS)))
+
+def frequency_domain_batch(nni_series, method='welch', fbands=None, **kwargs):
+    """
+    Function that computes the frequency domain parameters of many NNI
+    series at once.
+
+    INPUT:
+        nni_series: list of arrays with nni series [ms]
+        method: 'welch' (as hrv_results) or 'lomb' (Lomb-Scargle)
+        fbands: dictionary with frequency bands (default:
+                HRV_calculations.FBANDS)
+        kwargs: further arguments of welch_psd_batch or lomb_psd_batch
+
+    OUTPUT:
+        parameters: 2D array with rows = series, columns =
+                    HRV_calculations.FD_PARAMETERS
+    """
+    if method == 'welch':
+        return welch_psd_batch(nni_series, fbands, **kwargs)
+    elif method == 'lomb':
+        return lomb_psd_batch(nni_series, fbands, **kwargs)
+    raise ValueError("Unknown method '%s', use 'welch' or 'lomb'." % method)
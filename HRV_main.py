@@ -17,7 +17,80 @@ Make sure the following files are stored in the same folder before running:
     - HRV_preprocessing.py
     - HRV_calculations.py
     - HRV_batchmode.py
+    - HRV_recordstore.py
+    - HRV_export.py
+    - HRV_cache.py
+    - HRV_streaming.py
+    - HRV_sliding.py
+    - HRV_trace.py
+    - HRV_summary.py
+    - HRV_prefetch.py
+    - HRV_worker.py
+    - HRV_queue.py
     - files_id.txt
+
+Records can be ingested once in a local record store with 
+HRV_recordstore.ingest_batch(patient_ids, store). Set 'store' to the path of 
+the record store to read from it, and 'offline' to True to never access the 
+MIMIC-III database (e.g. on compute nodes without internet access).
+Without access to the MIMIC-III database, a cohort of synthetic records can
+be written with HRV_synthetic.synthetic_store(store, n_patients, duration), 
+which returns the .txt file with their patient IDs.
+
+Set 'cache_dir' to store the results per patient-window in a persistent cache
+(HRV_cache.py). Reruns, and runs that continue after an interruption, only 
+compute the windows that are not in the cache yet. Old entries are removed 
+with HRV_cache.evict(cache_dir, max_age, max_size).
+
+Set 'chunk' (e.g. 600 s) for long recordings: the ECG signal is then read and
+processed in chunks (HRV_streaming.py), so memory use does not grow with the
+recording length. batch_df is not created in that case.
+
+Set 'parameters' to a list of HRV parameter names (e.g. ['rmssd', 'sdnn',
+'ratio_lf_hf'], see HRV_calculations.PARAMETERS) to only calculate these
+parameters. The histograms at the end of this file need all parameters.
+
+Set 'lead' to a list of leads (e.g. ['II', 'V', 'I']) or 'all' to read all
+leads of a record at once and analyse the lead with the best signal quality
+per patient (lead_mode 'select'), or the fused R-peaks of all leads of 
+sufficient quality (lead_mode 'fusion'). The analysed lead is exported in 
+column 'lead'; chunk must be None in that case.
+
+Set 'gate' to True (or a dictionary with thresholds, see 
+HRV_preprocessing.GATE_THRESHOLDS) to skip windows with unusable ECG 
+(missing samples, flatline, saturation) or implausible beats before the 
+costly stages. Skipped windows are listed in failures with a reason code.
+
+Set 'prefetch' (e.g. 2) to load the next records on I/O threads while the 
+current patient is computed (HRV_prefetch.py), which hides the download time
+of the MIMIC-III database.
+
+Small on-demand requests (one patient, a few windows) are answered by a 
+long-running worker that keeps the libraries and caches warm, instead of a 
+new Python process per request: start it with 
+'python HRV_worker.py --socket 127.0.0.1:8765' (or '--spool dir') and send 
+jobs with HRV_worker.request (or HRV_worker.submit and HRV_worker.result).
+
+Set 'queue_dir' to a directory on a filesystem shared by several nodes to 
+shard the batch over these nodes (HRV_queue.py). Run this file on one node, 
+and 'python HRV_queue.py work <queue_dir>/first_hour' (and 
+'<queue_dir>/per5min') on the other nodes; tasks of a node that stops are 
+retried by the other nodes. The results of all nodes are merged into 
+export_all and per5min.csv, signals are not returned in this case.
+
+Set 'trace' to a .jsonl file to record wall time, CPU time, memory and input
+size of every stage per patient and window (HRV_trace.py); 
+HRV_trace.summary(trace) returns the slowest stages and patients.
+
+The cohort statistics of hrv_distribution are computed in one pass over the 
+export (HRV_summary.py), which may be larger than memory, the histograms are 
+counted exactly in a second pass. 
+Summaries of several exports (e.g. one per node) are merged with 
+HRV_summary.summarize_files(paths) and can be passed to hrv_distribution.
+
+Set 'n_workers' > 1 to analyse patients in parallel. On Windows, worker 
+processes re-import this file, so run it from a script guarded by 
+if __name__ == '__main__' in that case.
     
 Output variables: 
     - batch_df: list containing dataframes with timestamps, raw- and filtered
@@ -28,6 +101,10 @@ Output variables:
     - batch_rpeaks: list containing arrays with rpeak locations [s]
     - batch_rpeaks_first: list containing array with rpeak locations [s]-
       before ectopic beat- and outlier removal
+    - trends: list containing dataframes with time domain HRV parameters of
+      overlapping 5-minute windows per included patient
+    - failures: dataframe with patients (or windows) that could not be 
+      analysed, with the stage that failed and the error
 
 Output file: the output file is stored in the same folder as the current file.
     - HRVparameters.csv: file containing all calculated HRV parameters per 
@@ -41,18 +118,38 @@ Output file: the output file is stored in the same folder as the current file.
 import numpy as np
 import HRV_batchmode as workflow
 import HRV_evaluation as viseval
+import HRV_sliding as sliding
 
 #%% HRV calculation first hour
 # Specify input variables
 patient_ids = 'files_id_test.txt'                                               # .txt file containing patient_IDs
 sampfreq = 125                                                                  # Sample frequency in Hertz [Hz]
-lead = 'II'                                                                     # ECG lead to analyze 
+lead = 'II'                                                                     # ECG lead to analyze, or list of leads / 'all' for lead selection
+lead_mode = 'select'                                                            # With several leads: best lead ('select') or fusion of leads ('fusion')
 starttime = 0                                                                   # Starting time of analysis [s]
 endtime  = 3600                                                                 # Ending time of analysis [s]
+store = None                                                                    # Path of local record store, None: MIMIC-III database
+offline = False                                                                 # Only read records from local record store
+n_workers = 1                                                                   # Number of worker processes for parallel processing
+retain = 'all'                                                                  # Keep signals in memory ('all'), on disk ('disk') or not ('results')
+spill_dir = None                                                                # Directory for signals if retain = 'disk'
+cache_dir = None                                                                # Path of result cache, None: no cache
+chunk = None                                                                    # Chunk length for streaming R-peak detection [s], None: whole signal
+parameters = None                                                               # Names of HRV parameters to calculate, None: all parameters
+trace = None                                                                    # .jsonl file for timing and memory per stage, None: no tracing
+gate = False                                                                    # Quality gate: False, True or dictionary with thresholds
+prefetch = 0                                                                    # Number of records loaded ahead of the computation, 0: no prefetching
+queue_dir = None                                                                # Shared work queue to shard the batch over nodes (requires retain = 'results'), None: one node
+options = workflow.BatchOptions(n_workers=n_workers, retain=retain,             # Options of both batches, see HRV_batchmode.BatchOptions
+                                spill_dir=spill_dir, cache_dir=cache_dir, chunk=chunk,
+                                parameters=parameters, trace=trace, lead_mode=lead_mode,
+                                gate=gate, prefetch=prefetch, progress=True)
 
 # HRV calculations for all patients specified in patient_ids
-batch_df, batch_nni_first, batch_rpeaks_first, batch_nni, batch_rpeaks, export_all = workflow.workflow_batch(patient_ids,
-                                                                         sampfreq, lead, starttime, endtime)
+batch_df, batch_nni_first, batch_rpeaks_first, batch_nni, batch_rpeaks, export_all, failures = workflow.workflow_batch(patient_ids,
+                                                                         sampfreq, lead, starttime, endtime, store, offline,
+                                                                         options, return_failures=True,
+                                                                         queue_dir=None if queue_dir is None else queue_dir + '/first_hour')
 
 export_all.to_csv('HRVparameters.csv')
 
@@ -65,31 +162,30 @@ sampfreq = 125
 lead = 'II'                                                                     # ECG lead to analyze 
 starttime = np.arange(600, 4200, 300)                                           # Starting time of analysis [s]
 endtime  = np.arange(900, 4500, 300)                                            # Ending time of analysis [s]
-export = list()
-
-# Calculate HRV parameters per 5-minute segments
-for i in np.arange(0, len(starttime), 1):
-    print(i)
-    # HRV calculations for all patients specified in patient_ids
-    batch_df, batch_nni_first, batch_rpeaks_first, batch_nni, batch_rpeaks, export_all = workflow.workflow_batch(patient_ids,
-                                                                             sampfreq, lead, starttime[i], endtime[i])
-
-    export_all.insert(0, 'time [min]', starttime[i]/60)
-    export.append(export_all)  
- 
-exp = export[0]
-for i in np.arange(0, len(starttime)-1, 1):
-    exp = exp.append(export[i+1]) 
-
-exp['patientID'] = exp.index
-exp = exp.sort_values(['patientID', 'time [min]'])                              # Sort by patient, by time
-exp.to_csv('per5min.csv')                                                       # Export dataframe to .csv file
+windows = list(zip(starttime, endtime))                                         # 5-minute analysis windows
+
+# Calculate HRV parameters per 5-minute segments, the ECG signal of all 
+# windows is loaded and preprocessed once per patient. The parameters are 
+# written to per5min.csv while the batch is running
+batch_df, batch_nni_first, batch_rpeaks_first, batch_nni, batch_rpeaks, exp, failures = workflow.workflow_batch(patient_ids,
+                                                                         sampfreq, lead, starttime[0], endtime[-1], store, offline,
+                                                                         options, return_failures=True,
+                                                                         windows=windows, export_path='per5min.csv',
+                                                                         queue_dir=None if queue_dir is None else queue_dir + '/per5min')
+
+#%% HRV trends: time domain parameters of 5-minute windows every 30 seconds
+
+trends = [sliding.sliding_time_domain(rpeaks, nni, window=300, step=30)         # One DataFrame per included patient, time [min] since first valid sample
+          for rpeaks, nni in zip(batch_rpeaks, batch_nni)]
 
 #%% Visual evaluation 
-   
-viseval.visual_evaluation_rpeaks(batch_df, batch_rpeaks)                        # Visual evaluation of R-peak detection             
+
+qc_dir = None                                                                   # Directory for QC images (.png) per patient, None: interactive plots
+viseval.visual_evaluation_rpeaks(batch_df, batch_rpeaks, qc_dir=qc_dir,         # Visual evaluation of R-peak detection             
+                                 n_workers=n_workers)
 viseval.visual_evaluation_nni(batch_nni, batch_rpeaks, batch_nni_first,         # Visual evaluation of NNI correction
-                              batch_rpeaks_first)    
+                              batch_rpeaks_first, qc_dir=qc_dir, 
+                              n_workers=n_workers)    
 
 #%% Create histogram per HRV parameter, icluding mean and standard deviation
     
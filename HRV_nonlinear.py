@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+HRV nonlinear
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Fast implementations of the nonlinear HRV parameters sample entropy and
+detrended fluctuation analysis (DFA). The results match
+pyhrv.nonlinear.sample_entropy and, on NNI corrected for ectopic beats,
+pyhrv.nonlinear.dfa (see dfa), but scale to NNI series of 24 hours or more:
+    - sample_entropy counts matching templates with a k-d tree (dual tree
+      counting, about O(n^(2-1/m)) for embedding dimension m), instead of
+      comparing all pairs of templates, O(n^2)
+    - dfa detrends all boxes of a box size at once with the closed-form
+      least squares line, instead of one polynomial fit per box
+"""
+#%% Required modules
+import warnings
+
+import numpy as np
+
+#%% Sample entropy
+def _count_matches(templates, tolerance):
+    # Number of pairs of templates with a Chebyshev distance < tolerance
+    from scipy.spatial import cKDTree
+    
+    tree = cKDTree(templates, leafsize=16)
+    radius = np.nextafter(tolerance, -np.inf)                                   # count_neighbors counts distances <= radius
+    pairs = tree.count_neighbors(tree, radius, p=np.inf)                        # Ordered pairs, including template with itself
+    return (pairs - len(templates)) // 2
+
+def sample_entropy(nni, dim=2, tolerance=None):
+    """
+    Function that computes the sample entropy of an NNI series, identical to
+    pyhrv.nonlinear.sample_entropy (nolds.sampen).
+
+    INPUT:
+        nni: array with nni series [ms]
+        dim: entropy embedding dimension (default: 2)
+        tolerance: tolerance distance for which templates are considered
+                   equal (default: std(nni) * 0.2, as pyhrv)
+
+    OUTPUT:
+        ReturnTuple with key 'sampen': sample entropy of the NNI series
+    """
+    import pyhrv
+    from biosppy.utils import ReturnTuple
+    
+    nn = pyhrv.utils.check_input(nni, None)
+    if tolerance is None:
+        tolerance = np.std(nn, ddof=-1) * 0.2
+
+    # Templates of length dim and dim+1, the last template of length dim is
+    # left out as it has no template of length dim+1 (as nolds)
+    n = len(nn) - dim
+    templates = np.lib.stride_tricks.sliding_window_view(nn, dim + 1)[:n]
+    matches_m = _count_matches(templates[:, :dim], tolerance)
+    matches_m1 = _count_matches(templates, tolerance)
+
+    if matches_m > 0 and matches_m1 > 0:
+        sampen = -np.log(matches_m1 / matches_m)
+    else:
+        warnings.warn("Zero templates within tolerance, sample entropy is "
+                      "undefined.", RuntimeWarning)
+        if matches_m == 0 and matches_m1 == 0:
+            sampen = np.nan
+        elif matches_m == 0:
+            sampen = -np.inf
+        else:
+            sampen = np.inf
+    return ReturnTuple((float(sampen), ), ('sampen', ))
+
+#%% Detrended fluctuation analysis
+def _fluctuations(walk, nvals):
+    # Root mean square fluctuation around the linear trend per box size n
+    fluctuations = np.empty(len(nvals))
+    for i, n in enumerate(nvals):
+        boxes = walk[:len(walk) - len(walk) % n].reshape(-1, n)                 # Non-overlapping boxes of n beats
+        x = np.arange(n) - (n - 1)/2                                            # Centered beat number within box
+        y = boxes - boxes.mean(axis=1, keepdims=True)
+        slope = (y @ x) / (x @ x)                                               # Least squares trend per box
+        residuals = y - slope[:, np.newaxis] * x
+        fluctuations[i] = np.sqrt(np.mean(np.sum(residuals**2, axis=1) / n))
+    return fluctuations
+
+def _alpha(walk, nvals):
+    # Scaling exponent: slope of log F(n) against log n
+    fluctuations = _fluctuations(walk, nvals)
+    nonzero = fluctuations != 0
+    if not nonzero.any():
+        return np.nan
+    return np.polyfit(np.log(nvals[nonzero]), np.log(fluctuations[nonzero]),
+                      1)[0]
+
+def dfa(nni, short=(4, 16), long=(17, 64)):
+    """
+    Function that conducts a detrended fluctuation analysis (DFA) of an NNI
+    series, as pyhrv.nonlinear.dfa with non-overlapping boxes. The 
+    fluctuations are identical, but the scaling exponents are fitted with 
+    least squares, where pyhrv (nolds) uses the randomized RANSAC fit. On 
+    NNI corrected for ectopic beats (ecg_ectopic_removal, as in the 
+    workflow) the fluctuations lie close to a line and both fits agree: 
+    within 0.1 for 5 minutes of NNI, and mostly exactly from 20 minutes on 
+    (tests/test_nonlinear.py). On raw NNI with ectopic beats or outliers 
+    they do not agree, RANSAC then leaves out box sizes and varies between 
+    runs (e.g. alpha1 of 0.29 to 0.54), while least squares uses all box 
+    sizes.
+
+    INPUT:
+        nni: array with nni series [ms]
+        short: interval limits of the short term fluctuations [beats]
+        long: interval limits of the long term fluctuations [beats]
+
+    OUTPUT:
+        ReturnTuple with keys
+            'dfa_plot': None (no plot is created)
+            'dfa_alpha1': alpha value of the short term fluctuations
+            'dfa_alpha2': alpha value of the long term fluctuations
+            'dfa_alpha1_beats': range of box sizes of short term fluctuations
+            'dfa_alpha2_beats': range of box sizes of long term fluctuations
+    """
+    import pyhrv
+    from biosppy.utils import ReturnTuple
+    
+    nn = pyhrv.utils.check_input(nni, None)
+    short = range(short[0], short[1] + 1)
+    long = range(long[0], long[1] + 1)
+
+    if max(long) >= len(nn):                                                    # Not enough NNI samples, as pyhrv
+        warnings.warn("Not enough NNI samples for Detrended Fluctuations "
+                      "Analysis.")
+        alpha1, alpha2 = np.nan, np.nan
+    else:
+        walk = np.cumsum(nn - np.mean(nn))                                      # Profile of the NNI series
+        alpha1 = _alpha(walk, np.array(short))
+        alpha2 = _alpha(walk, np.array(long))
+
+    args = (None, alpha1, alpha2, short, long)
+    names = ('dfa_plot', 'dfa_alpha1', 'dfa_alpha2', 'dfa_alpha1_beats',
+             'dfa_alpha2_beats')
+    return ReturnTuple(args, names)
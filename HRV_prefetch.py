@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+HRV prefetch
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Overlap of record loading (I/O) with computation. prefetch loads the next
+records (or chunks of a record) on a bounded pool of I/O threads while the
+current one is processed; at most depth loads run or wait ahead of the
+consumer, so that memory use stays bounded when loading is faster than
+computing (backpressure). Loading from the MIMIC-III database (wfdb) and
+from the record store both release the GIL while waiting, so threads are
+sufficient. bounded_map submits the prefetched records to a pool of worker
+processes, with a bounded number of pending patients.
+
+slow_server is a local stand-in for the PhysioNet file server: it serves
+WFDB records (written with write_wfdb) over HTTP with a latency and
+bandwidth per request, and points wfdb to it, so that the overlap of I/O
+and computation can be measured without internet access (see
+HRV_benchmark.benchmark_prefetch).
+"""
+#%% Required modules
+import collections
+import contextlib
+import http.server
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+SERVER_VERSION = '1.0'                                                          # Database version reported by slow_server
+
+#%% Prefetching
+def prefetch(load, items, depth=2, n_threads=2):
+    """
+    Generator that loads items ahead on a pool of I/O threads.
+
+    INPUT:
+        load: function that loads one item (e.g. a patient ID)
+        items: iterable of items, in order of processing
+        depth: number of items that are loaded ahead of the item that is
+               being processed (queue depth)
+        n_threads: number of I/O threads
+
+    OUTPUT:
+        generator of (item, future) tuples in the order of items,
+        future.result() returns the loaded item or raises its error
+    """
+    items = iter(items)
+    pending = collections.deque()
+    executor = ThreadPoolExecutor(max_workers=n_threads)
+    try:
+        for item in itertools.islice(items, depth + 1):
+            pending.append((item, executor.submit(load, item)))
+        while pending:
+            item, future = pending.popleft()
+            for following in itertools.islice(items, 1):                        # Keep depth loads ahead of the consumer
+                pending.append((following, executor.submit(load, following)))
+            yield item, future
+    finally:
+        for _, future in pending:                                               # Generator closed early
+            future.cancel()
+        executor.shutdown(wait=True)
+
+def resolve(future):
+    """
+    Function that returns the result of a future, or its error.
+    """
+    try:
+        return future.result()
+    except Exception as error:
+        return error
+
+def bounded_map(executor, func, arguments, max_pending):
+    """
+    Generator that submits func(*args) to an executor for every tuple of
+    arguments, with at most max_pending submitted calls of which the result
+    has not been yielded, and yields the results in order.
+    """
+    arguments = iter(arguments)
+    pending = collections.deque()
+    for args in itertools.islice(arguments, max_pending):
+        pending.append(executor.submit(func, *args))
+    while pending:
+        result = pending.popleft().result()
+        for args in itertools.islice(arguments, 1):
+            pending.append(executor.submit(func, *args))
+        yield result
+
+#%% Slow file server
+def write_wfdb(directory, patient_id, signals, sampfreq):
+    """
+    Function that writes a record as WFDB files (.hea and .dat) in the
+    directory layout of the MIMIC-III waveform database on PhysioNet, for
+    slow_server.
+
+    INPUT:
+        directory: root directory of the server
+        patient_id: ID number of patient, as in files_id.txt
+        signals: dictionary with lead name as key and signal [mV] as value
+        sampfreq: sampling frequency of recording [Hz]
+    """
+    import wfdb
+
+    path = os.path.join(directory, 'mimic3wdb', SERVER_VERSION, patient_id)
+    os.makedirs(path, exist_ok=True)
+    names = list(signals)
+    p_signal = np.column_stack([signals[name] for name in names])
+    wfdb.wrsamp(patient_id[-7:], fs=sampfreq, units=['mV']*len(names),
+                sig_name=names, p_signal=p_signal, fmt=['16']*len(names),
+                write_dir=path)
+
+class _SlowHandler(http.server.SimpleHTTPRequestHandler):
+    # Static files with byte ranges, latency and bandwidth per request
+    latency = 0.
+    bandwidth = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, head):
+        time.sleep(self.latency)
+        if self.path.startswith('/content/'):                                   # Project page, wfdb reads the version from it
+            body = ('Version: %s<' % SERVER_VERSION).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if not head:
+                self.wfile.write(body)
+            return
+        fname = self.translate_path(self.path)
+        if not os.path.isfile(fname):
+            self.send_error(404)
+            return
+        size = os.path.getsize(fname)
+        start, end = 0, size - 1
+        ranged = self.headers.get('Range', '').startswith('bytes=')
+        if ranged:
+            first, last = self.headers['Range'][6:].split('-')
+            start = int(first) if first else max(size - int(last), 0)
+            end = min(int(last), size - 1) if first and last else size - 1
+        self.send_response(206 if ranged else 200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        if ranged:
+            self.send_header('Content-Range', 'bytes %i-%i/%i'
+                             % (start, end, size))
+        self.end_headers()
+        if head:
+            return
+        with open(fname, 'rb') as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+        if self.bandwidth:
+            time.sleep(len(body) / self.bandwidth)
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._send(head=False)
+
+    def do_HEAD(self):
+        self._send(head=True)
+
+@contextlib.contextmanager
+def slow_server(directory, latency=0.2, bandwidth=None):
+    """
+    Context manager that serves directory over HTTP on localhost and points
+    wfdb to it instead of PhysioNet, e.g.:
+
+        with slow_server('server', latency=0.5):
+            workflow_batch(patient_ids, ...)
+
+    INPUT:
+        directory: root directory with records of write_wfdb
+        latency: delay of every request [s]
+        bandwidth: transfer rate of every request [bytes/s] (default: None,
+                   unlimited)
+
+    OUTPUT:
+        url: URL of the server
+    """
+    import wfdb.io.download as download
+
+    handler = type('Handler', (_SlowHandler, ),
+                   {'latency': latency, 'bandwidth': bandwidth})
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0),
+        lambda *args: handler(*args, directory=directory))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://127.0.0.1:%i/' % server.server_address[1]
+    index_url, content_url = download.config.db_index_url, \
+        download.PN_CONTENT_URL
+    download.config.db_index_url = url
+    download.PN_CONTENT_URL = url + 'content/'
+    try:
+        yield url
+    finally:
+        download.config.db_index_url = index_url
+        download.PN_CONTENT_URL = content_url
+        server.shutdown()
+        server.server_close()
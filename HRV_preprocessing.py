@@ -11,18 +11,25 @@ Author: M. Verboom
 import pandas as pd
 import numpy as np
 
+# The signals toolbox (biosppy), pyhrv and the WFDB(WaveFormDataBase) package
+# are imported in the functions that use them, as they take seconds to import
+# (see HRV_worker.py)
 
-# Signals toolbox
-import biosppy
-import pyhrv.tools as tools
+# Local record store
+import HRV_recordstore as recstore
+import HRV_trace as tracer
 
-# import the WFDB(WaveFormDataBase) package
-import wfdb
+#%% Thresholds of ectopic beat- and outlier removal
+ECTOPIC_THRESHOLDS = {'short': 0.75, 'low': 0.85, 'high': 1.15,                 # Fractions of the mean of the previous 10 nnis
+                      'nni_min': 300, 'nni_max': 6000}                          # Physiological range of nni [ms]
 
 #%%
-def load_data(patient_id, sampfreq, sampfrom, sampto, lead='II'):
+def load_data(patient_id, sampfreq, sampfrom, sampto, lead='II', store=None,
+              offline=False):
     """
-    Function to load data from MIMIC-III database.
+    Function to load data from MIMIC-III database. If the record is available
+    in the local record store (see HRV_recordstore.py), the window is sliced
+    from the memory mapped record instead.
     
     INPUT:
         patient_id: ID number of patient for analysis
@@ -30,18 +37,61 @@ def load_data(patient_id, sampfreq, sampfrom, sampto, lead='II'):
         starttime: starting time of ECG analysis
         endtime: ending time of ECG analysis
         lead: ECG lead for analysis: 'I', "II", "V"
+        store: path of local record store (default: None, no store)
+        offline: if True, only read from the record store and never from
+                 the MIMIC-III database
         
     OUTPUT:
         record: data from waveform database 
     """
     pt_id = patient_id
     sampling_rate = sampfreq
-    Sampfrom = sampling_rate * sampfrom                                         # The starting sample number to read for all channels
-    Sampto = sampling_rate * sampto                                             # The sample number at which to stop reading for all channels
-    LeadWanted = [lead]                                                         # Lead that is used for the analysis
-    record = wfdb.rdrecord(pt_id[-7:], sampfrom = Sampfrom, sampto = Sampto, 
+    Sampfrom = int(sampling_rate * sampfrom)                                    # The starting sample number to read for all channels
+    Sampto = int(sampling_rate * sampto)                                        # The sample number at which to stop reading for all channels
+    
+    return load_samples(pt_id, Sampfrom, Sampto, lead, store, offline)
+
+def load_samples(patient_id, sampfrom, sampto, lead='II', store=None, 
+                 offline=False):
+    """
+    Function to load a window of a record by sample number, from the local 
+    record store if available or else from the MIMIC-III database. Several
+    leads are read at once with a list of leads (or 'all', ECG_LEADS); 
+    leads that the record does not have are left out, see 
+    record.sig_name.
+    
+    INPUT:
+        patient_id: ID number of patient for analysis
+        sampfrom: first sample of the window
+        sampto: sample at which the window stops (not included)
+        lead: ECG lead for analysis: 'I', "II", "V", a list of leads or 'all'
+        store: path of local record store (default: None, no store)
+        offline: if True, only read from the record store
+        
+    OUTPUT:
+        record: data from waveform database 
+    """
+    pt_id = patient_id
+    LeadWanted = ecg_leads(lead)                                                # Lead(s) that are used for the analysis
+    
+    if store is not None and recstore.has_record(store, pt_id):
+        if not isinstance(lead, str) or lead == 'all':
+            available = recstore.read_index(store, pt_id)['leads']
+            LeadWanted = [name for name in LeadWanted if name in available] \
+                or LeadWanted                                                   # No lead available: read_window raises
+        return recstore.read_window(store, pt_id, sampfrom, sampto, LeadWanted)
+    if offline:
+        raise FileNotFoundError('Record %s is not available in record store %s '
+                                'and offline mode is enabled.' % (pt_id, store))
+    
+    import wfdb
+    
+    record = wfdb.rdrecord(pt_id[-7:], sampfrom = sampfrom, sampto = sampto, 
                            pn_dir=('mimic3wdb/'+pt_id), channel_names =
                            LeadWanted)
+    if record.p_signal is None or record.n_sig == 0:
+        raise ValueError('Lead(s) %s not available for record %s.' 
+                         % (LeadWanted, pt_id))
     return record
 
 def ecg_dataframe(record, sampfreq):
@@ -68,45 +118,565 @@ def ecg_dataframe(record, sampfreq):
     return ecg_df
            
 
-def ecg_rpeak(ecg_df, sampfreq):
+def ecg_rpeak(ecg_df, sampfreq, method='fast', chunk=None, margin=10, 
+              n_workers=1):
     """
     Function that uses bioSPPY toolbox in order to filter the ECG signal and
     detect R-peaks. NN intervals are calculated as well.
     Reference: https://github.com/PIA-Group/BioSPPy/blob/5fbfb1de5917eef2609ce985307546d37aa0a0ca/biosppy/signals/ecg.py 
     
+    With method 'fast' only the steps of biosppy.signals.ecg.ecg that 
+    determine the R-peaks are run (see detect_rpeaks), the heart rate and 
+    heartbeat templates are not computed. Long signals can be split in 
+    overlapping chunks (chunk, margin), which are detected in parallel with
+    n_workers > 1 (see rpeak_chunks).
+    
     INPUT:
         ecg_df: DataFrame with rows = time [s], columns = ECG data [mV]
         sampfreq: sampling frequency of recording [Hz]
+        method: 'fast' (default) or 'biosppy' (biosppy.signals.ecg.ecg)
+        chunk: length of chunks [s] (default: None, whole signal at once)
+        margin: overlap margin on both sides of a chunk [s]
+        n_workers: number of worker processes for the chunks
         
     OUTPUT:
         dataframe: ecg_df with added column with filtered ECG signal [mV]
         r_peaks: array containing all detected R-peaks [s]
         nni: array containing all calculated NN intervals [ms]   
     """
+    import biosppy.signals.ecg
+    import pyhrv.tools as tools
+    
     sampling_rate = sampfreq
     dataframe = ecg_df
-    ecg_filtered, r_peaks = biosppy.signals.ecg.ecg(dataframe.ecg_signal, 125, 
-                                                    show=False)[1:3]            # [1:3] To get filtered signal and R-peaks
+    signal = dataframe.ecg_signal.to_numpy(dtype=np.float64)
+    if method == 'biosppy':
+        ecg_filtered, r_peaks = biosppy.signals.ecg.ecg(signal, sampling_rate, 
+                                                        show=False)[1:3]        # [1:3] To get filtered signal and R-peaks
+    elif method != 'fast':
+        raise ValueError("Unknown method '%s', use 'fast' or 'biosppy'." 
+                         % method)
+    elif chunk is None:
+        ecg_filtered, r_peaks = detect_rpeaks(signal, sampling_rate)
+    else:
+        ecg_filtered, r_peaks = rpeak_chunks(signal, sampling_rate, chunk, 
+                                             margin, n_workers)
     dataframe = dataframe.assign(ecg_filtered = ecg_filtered)                   # Add filtered ECG signal to dataframe
     r_peaks =  r_peaks * 1/sampling_rate                                        # Convert from index to time in seconds
     nni = tools.nn_intervals(r_peaks)                                           # Calculate NN intervals
                 
     return dataframe, r_peaks, nni
 
-def ecg_ectopic_removal(r_peaks, nni):
+def ecg_filter(signal, sampfreq):
+    """
+    Function that filters an ECG signal as biosppy.signals.ecg.ecg: FIR 
+    bandpass filter of 0.67 - 45 Hz with order 1.5 * sampfreq. The DC offset
+    is not removed.
+    
+    INPUT:
+        signal: array with ECG data [mV], without NaN
+        sampfreq: sampling frequency of recording [Hz]
+        
+    OUTPUT:
+        filtered: array with filtered ECG data [mV]
+    """
+    import biosppy.signals.tools
+    
+    order = int(1.5 * sampfreq)
+    filtered, _, _ = biosppy.signals.tools.filter_signal(signal=signal, 
+                                                         ftype='FIR',
+                                                         band='bandpass', 
+                                                         order=order,
+                                                         frequency=[0.67, 45],
+                                                         sampling_rate=sampfreq)
+    return filtered
+
+def segment_rpeaks(filtered, sampfreq):
+    """
+    Function that detects R-peaks in a filtered ECG signal as
+    biosppy.signals.ecg.ecg: Hamilton segmenter, R-peak correction to the 
+    maximum within 0.05 s, and removal of peaks within 0.2 s of the start or
+    0.4 s of the end of the signal (no complete heartbeat template). A 
+    signal without R-peaks gives an empty array instead of an error.
+    
+    INPUT:
+        filtered: array with filtered ECG data [mV]
+        sampfreq: sampling frequency of recording [Hz]
+        
+    OUTPUT:
+        rpeaks: array with sample indices of the R-peaks
+    """
+    import biosppy.signals.ecg
+    
+    rpeaks, = biosppy.signals.ecg.hamilton_segmenter(signal=filtered,
+                                                     sampling_rate=sampfreq)
+    if len(rpeaks) == 0:
+        return np.array([], dtype=int)
+    rpeaks, = biosppy.signals.ecg.correct_rpeaks(signal=filtered, 
+                                                 rpeaks=rpeaks,
+                                                 sampling_rate=sampfreq, 
+                                                 tol=0.05)
+    rpeaks = np.sort(rpeaks).astype(int)
+    before, after = int(0.2 * sampfreq), int(0.4 * sampfreq)
+    keep = (rpeaks - before >= 0) & (rpeaks + after <= len(filtered))
+    return rpeaks[keep]
+
+def detect_rpeaks(signal, sampfreq):
+    """
+    Function that filters an ECG signal and detects the R-peaks, with the 
+    same result as biosppy.signals.ecg.ecg.
+    
+    INPUT:
+        signal: array with ECG data [mV], without NaN
+        sampfreq: sampling frequency of recording [Hz]
+        
+    OUTPUT:
+        filtered: array with filtered ECG data [mV], DC offset removed
+        rpeaks: array with sample indices of the R-peaks
+    """
+    with tracer.stage('rpeak.filter'):
+        filtered = ecg_filter(signal, sampfreq)
+        filtered = filtered - np.mean(filtered)                                 # Remove DC offset
+    with tracer.stage('rpeak.segment'):
+        rpeaks = segment_rpeaks(filtered, sampfreq)
+    return filtered, rpeaks
+
+def _detect_chunk(signal, sampfreq, offset, core_start, core_end):
+    # Filtered core and R-peaks in the core of one chunk, offset is the 
+    # sample number of signal[0]
+    filtered = ecg_filter(signal, sampfreq)
+    rpeaks = segment_rpeaks(filtered, sampfreq) + offset                        # The segmenter does not depend on the DC offset
+    rpeaks = rpeaks[(rpeaks >= core_start) & (rpeaks < core_end)]
+    return filtered[core_start - offset:core_end - offset], rpeaks
+
+def merge_rpeaks(chunks, min_distance):
+    """
+    Function that merges the R-peaks of consecutive chunks. Peaks closer 
+    than min_distance to the last peak of the previous chunk are the same 
+    beat and are kept once (the first detection is kept).
+    
+    INPUT:
+        chunks: list with arrays of R-peak sample indices, in order of time
+        min_distance: minimum distance between two R-peaks [samples]
+        
+    OUTPUT:
+        rpeaks: array with sample indices of all R-peaks
+    """
+    merged = list()
+    last = -np.inf
+    for rpeaks in chunks:
+        rpeaks = rpeaks[rpeaks - last >= min_distance]
+        if len(rpeaks) > 0:
+            merged.append(rpeaks)
+            last = rpeaks[-1]
+    return np.concatenate(merged) if merged else np.array([], dtype=int)
+
+def rpeak_chunks(signal, sampfreq, chunk=600, margin=10, n_workers=1,
+                 min_distance=0.2):
+    """
+    Function that filters an ECG signal and detects the R-peaks in 
+    overlapping chunks, optionally in parallel. Every chunk is filtered and
+    segmented with an overlap margin on both sides, only the filtered signal
+    and R-peaks in the chunk itself (the core) are kept. The merge only 
+    depends on the order of the chunks, so the result is the same for any 
+    number of workers. R-peaks equal the whole-signal path except within a 
+    few beats of a chunk boundary (see HRV_streaming.py).
+    
+    INPUT:
+        signal: array with ECG data [mV], without NaN
+        sampfreq: sampling frequency of recording [Hz]
+        chunk: length of chunks [s]
+        margin: overlap margin on both sides of a chunk [s]
+        n_workers: number of worker processes (default: 1, no parallel 
+                   processing)
+        min_distance: minimum distance between two R-peaks [s]
+        
+    OUTPUT:
+        filtered: array with filtered ECG data [mV], DC offset removed
+        rpeaks: array with sample indices of the R-peaks
+    """
+    chunk_len = int(chunk * sampfreq)
+    margin_len = int(margin * sampfreq)
+    jobs = list()
+    for core_start in range(0, len(signal), chunk_len):
+        core_end = min(core_start + chunk_len, len(signal))
+        read_start = max(core_start - margin_len, 0)
+        read_end = min(core_end + margin_len, len(signal))
+        jobs.append((signal[read_start:read_end], sampfreq, read_start, 
+                     core_start, core_end))
+    
+    if n_workers > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_detect_chunk, *zip(*jobs)))            # map keeps the order of the chunks
+    else:
+        results = [_detect_chunk(*job) for job in jobs]
+    
+    filtered = np.concatenate([core for core, _ in results])
+    filtered = filtered - np.mean(filtered)                                     # Remove DC offset of the whole signal
+    rpeaks = merge_rpeaks([rpeaks for _, rpeaks in results], 
+                          min_distance * sampfreq)
+    return filtered, rpeaks
+
+#%% Multiple leads
+ECG_LEADS = ('II', 'I', 'III', 'V', 'AVR', 'AVL', 'AVF', 'MCL', 'MCL1', 'V1', 
+             'V2', 'V3', 'V4', 'V5', 'V6')                                      # ECG leads of MIMIC-III records, in order of preference
+QUALITY = {'band': (5, 20), 'segment': 10, 'kurtosis': 10,                     # QRS band [Hz], segment length [s], kurtosis of a clean lead
+           'minimum': 0.1}                                                      # Minimum score of a lead to be analysed
+
+def ecg_leads(lead):
+    """
+    Function that returns the list of requested leads: [lead] for a single 
+    lead, ECG_LEADS for 'all' or the given list of leads.
+    """
+    if isinstance(lead, str):
+        return list(ECG_LEADS) if lead == 'all' else [lead]
+    return list(lead)
+
+def lead_quality(signal, sampfreq):
+    """
+    Function that computes a cheap signal quality score of an ECG lead. The
+    signal is filtered in the QRS band and split in segments of 10 s; the 
+    kurtosis of a segment is high for a clean ECG (sharp QRS complexes on a
+    flat baseline) and 3 for noise. Per segment the score is 
+    (kurtosis - 3) / (QUALITY['kurtosis'] - 3), limited to [0, 1], and 0 if
+    half of the segment or more is missing or the segment is flat. The 
+    score of the lead is the mean of all segments, so missing data lowers
+    the score as well.
+    
+    INPUT:
+        signal: array with ECG data [mV], may contain NaN
+        sampfreq: sampling frequency of recording [Hz]
+        
+    OUTPUT:
+        score: quality score between 0 (no ECG) and 1 (clean ECG)
+    """
+    import scipy.signal
+    
+    signal = np.asarray(signal, dtype=np.float64)
+    seg_len = int(QUALITY['segment'] * sampfreq)
+    n_seg = max(len(signal) // seg_len, 1)
+    seg_len = min(seg_len, len(signal))
+    if seg_len == 0:
+        return 0.
+    valid = ~np.isnan(signal[:n_seg * seg_len]).reshape(n_seg, seg_len)
+    sos = scipy.signal.butter(2, QUALITY['band'], 'bandpass', fs=sampfreq, 
+                              output='sos')
+    filtered = scipy.signal.sosfilt(sos, np.nan_to_num(signal, nan=0.))
+    filtered = filtered[:n_seg * seg_len].reshape(n_seg, seg_len)
+    
+    score = np.zeros(n_seg)
+    use = (valid.mean(axis=1) > 0.5) & (filtered.std(axis=1) > 0)               # Segments with data that is not flat
+    if use.any():
+        segments = filtered[use]
+        segments = segments - segments.mean(axis=1, keepdims=True)
+        kurtosis = (segments**4).mean(axis=1) / (segments**2).mean(axis=1)**2
+        score[use] = np.clip((kurtosis - 3) / (QUALITY['kurtosis'] - 3), 0, 1)
+    return float(score.mean())
+
+def lead_scores(record, sampfreq):
+    """
+    Function that computes the quality score of every lead of a record.
+    
+    OUTPUT:
+        scores: dictionary with lead name as key and score as value, in the
+                order of record.sig_name
+    """
+    return {name: lead_quality(record.p_signal[:, i], sampfreq) 
+            for i, name in enumerate(record.sig_name)}
+
+def record_lead(record, lead):
+    """
+    Function that returns a single lead of a multi-lead record, as a record
+    for ecg_dataframe.
+    """
+    i = list(record.sig_name).index(lead)
+    return recstore.StoredRecord(record.record_name, record.fs, [lead], 
+                                 record.p_signal[:, i:i+1])
+
+def fuse_rpeaks(peaks, weights, tolerance):
+    """
+    Function that fuses the R-peaks detected in several leads. Peaks of all 
+    leads within tolerance of each other are one beat. A beat is kept if 
+    the leads that detected it have more than half of the total weight; its
+    location is the peak of the detecting lead with the highest weight.
+    
+    INPUT:
+        peaks: list with arrays of R-peak sample indices per lead
+        weights: list with the weight (quality score) per lead
+        tolerance: maximum distance between detections of one beat 
+                   [samples]
+        
+    OUTPUT:
+        rpeaks: array with sample indices of the fused R-peaks
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    lead_id = np.concatenate([np.full(len(p), i) for i, p in enumerate(peaks)])
+    rpeaks = np.concatenate(peaks).astype(int)
+    if len(rpeaks) == 0:
+        return rpeaks
+    order = np.argsort(rpeaks, kind='stable')
+    rpeaks, lead_id = rpeaks[order], lead_id[order]
+    beat = np.concatenate(([0], np.cumsum(np.diff(rpeaks) > tolerance)))        # Detections closer than tolerance belong to one beat
+    votes = np.bincount(beat, weights=weights[lead_id])
+    best = np.lexsort((-weights[lead_id], beat))                                # Per beat, detection of the best lead first
+    first = best[np.concatenate(([True], np.diff(beat[best]) > 0))]
+    return rpeaks[first][votes > 0.5 * weights.sum()]
+
+def _lead_rpeaks(signal, sampfreq):
+    # R-peaks of one lead for fusion, the filtered signal is not kept
+    return detect_rpeaks(signal, sampfreq)[1]
+
+def ecg_rpeak_fusion(ecg_df, record, scores, sampfreq, n_workers=1, 
+                     tolerance=0.1):
+    """
+    Function that detects the R-peaks in all leads with a quality score of
+    at least QUALITY['minimum'] and fuses them, weighted by quality score
+    (fuse_rpeaks). ecg_df is the dataframe of the best lead (see 
+    ecg_dataframe), the other leads are used from its first valid sample 
+    onwards.
+    
+    INPUT:
+        ecg_df: DataFrame of the best lead
+        record: record with all leads (load_data)
+        scores: dictionary with quality score per lead (lead_scores)
+        sampfreq: sampling frequency of recording [Hz]
+        n_workers: number of worker processes for the leads
+        tolerance: maximum distance between detections of one beat [s]
+        
+    OUTPUT:
+        dataframe: ecg_df with added column with filtered ECG signal [mV] of 
+                   the best lead
+        r_peaks: array containing the fused R-peaks [s]
+        nni: array containing all calculated NN intervals [ms]
+        leads: list of the fused leads, best lead first
+    """
+    import pyhrv.tools as tools
+    
+    leads = sorted((name for name in scores 
+                    if scores[name] >= QUALITY['minimum']), 
+                   key=lambda name: -scores[name])
+    dataframe, r_peaks, _ = ecg_rpeak(ecg_df, sampfreq)                         # Best lead, with filtered signal
+    start = ecg_df.index[0]                                                     # First valid sample of the best lead
+    others = [np.nan_to_num(record.p_signal[start:, list(record.sig_name)
+                                            .index(name)], nan=0.)
+              for name in leads[1:]]
+    if n_workers > 1 and len(others) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            peaks = list(executor.map(_lead_rpeaks, others, 
+                                      [sampfreq]*len(others)))
+    else:
+        peaks = [_lead_rpeaks(signal, sampfreq) for signal in others]
+    peaks = [np.round(r_peaks * sampfreq).astype(int)] + peaks
+    rpeaks = fuse_rpeaks(peaks, [scores[name] for name in leads], 
+                         tolerance * sampfreq)
+    r_peaks = rpeaks / sampfreq
+    nni = tools.nn_intervals(r_peaks)
+    return dataframe, r_peaks, nni, leads
+
+#%% Quality gating
+GATE_THRESHOLDS = {'missing': 0.5, 'flatline': 2., 'saturation': 0.02,          # Signal: maximum fraction of missing samples, longest flat run [s], fraction of samples at the extremes
+                   'beats': 30, 'coverage': 0.7, 'heart_rate': (30, 220),       # Beats: minimum number of nni and fraction of the window covered by nni, range of mean heart rate [bpm]
+                   'ectopic': 0.3}                                              # Maximum fraction of nni removed as ectopic beat or outlier
+
+def gate_thresholds(gate):
+    """
+    Function that returns the thresholds of the quality gate: None for 
+    gate = False or None (no gating), GATE_THRESHOLDS for gate = True, or 
+    GATE_THRESHOLDS updated with a dictionary of thresholds.
+    """
+    if gate is None or gate is False:
+        return None
+    thresholds = dict(GATE_THRESHOLDS)
+    if gate is not True:
+        unknown = set(gate) - set(GATE_THRESHOLDS)
+        if unknown:
+            raise ValueError('Unknown gate threshold(s) %s, see '
+                             'HRV_preprocessing.GATE_THRESHOLDS.' 
+                             % sorted(unknown))
+        thresholds.update(gate)
+    return thresholds
+
+def _longest_run(mask):
+    # Length of the longest run of True values
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return int(np.max(np.flatnonzero(edges == -1) - 
+                      np.flatnonzero(edges == 1), initial=0))
+
+def signal_gate(signal, sampfreq, bounds, thresholds):
+    """
+    Function that screens the raw ECG signal of analysis windows before 
+    filtering and R-peak detection: fraction of missing samples, longest 
+    flat run (e.g. disconnected lead) and fraction of samples at the 
+    minimum or maximum of the window (amplitude saturation).
+    
+    INPUT:
+        signal: array with raw ECG data [mV], with NaN for missing samples
+        sampfreq: sampling frequency of recording [Hz]
+        bounds: list of (sampfrom, sampto) tuples of the windows in signal
+        thresholds: dictionary with thresholds, see GATE_THRESHOLDS
+        
+    OUTPUT:
+        reasons: list with per window None (window passes) or a tuple of 
+                 reason code ('missing', 'flatline' or 'saturation') and 
+                 description
+    """
+    signal = np.asarray(signal, dtype=np.float64)
+    reasons = list()
+    for sampfrom, sampto in bounds:
+        window = signal[max(sampfrom, 0):sampto]
+        valid = ~np.isnan(window)
+        missing = 1 - valid.mean() if len(window) else 1.
+        if missing > thresholds['missing']:
+            reasons.append(('missing', 'missing samples %.2f > %.2f' 
+                            % (missing, thresholds['missing'])))
+            continue
+        flat = (_longest_run(np.diff(window) == 0) + 1) / sampfreq              # NaN samples are never flat
+        if flat > thresholds['flatline']:
+            reasons.append(('flatline', 'flat run %.1f s > %.1f s' 
+                            % (flat, thresholds['flatline'])))
+            continue
+        values = window[valid]
+        saturated = np.mean((values == values.max()) | 
+                            (values == values.min()))
+        if saturated > thresholds['saturation']:
+            reasons.append(('saturation', 'samples at the extremes %.3f > '
+                            '%.3f' % (saturated, thresholds['saturation'])))
+            continue
+        reasons.append(None)
+    return reasons
+
+def beat_gate(nni, nni_first, duration, thresholds):
+    """
+    Function that screens the NNI series of an analysis window after R-peak
+    detection and ectopic beat removal, before the HRV calculations: number
+    of nni, fraction of the window covered by nni, mean heart rate and 
+    fraction of nni removed as ectopic beat or outlier.
+    
+    INPUT:
+        nni: array with NN intervals of the window [ms], after removal
+        nni_first: array with NN intervals of the window [ms], before removal
+        duration: length of the window [s]
+        thresholds: dictionary with thresholds, see GATE_THRESHOLDS
+        
+    OUTPUT:
+        reason: None (window passes) or a tuple of reason code ('beats', 
+                'coverage', 'heart_rate' or 'ectopic') and description
+    """
+    if len(nni) < thresholds['beats']:
+        return ('beats', 'nni %i < %i' % (len(nni), thresholds['beats']))
+    coverage = np.sum(nni) / 1000 / duration
+    if coverage < thresholds['coverage']:
+        return ('coverage', 'coverage %.2f < %.2f' 
+                % (coverage, thresholds['coverage']))
+    heart_rate = 60000 / np.mean(nni)
+    low, high = thresholds['heart_rate']
+    if not low <= heart_rate <= high:
+        return ('heart_rate', 'mean heart rate %.0f bpm outside [%g, %g]' 
+                % (heart_rate, low, high))
+    removed = 1 - len(nni) / max(len(nni_first), 1)
+    if removed > thresholds['ectopic']:
+        return ('ectopic', 'removed nni %.2f > %.2f' 
+                % (removed, thresholds['ectopic']))
+    return None
+
+def ecg_ectopic_removal(r_peaks, nni, mode='vectorized'):
     """
     Function for the removal of outliers and ectopic beats.
     
+    Rules per NN interval i (from the 11th until the 3rd last interval), with 
+    mean and median of the 10 intervals i-11 until i-2:
+        - nni[i] and nni[i+1] < 0.75*mean and nni[i+2] > 0.75*mean: nni[i] is
+          replaced by the median, interval i+1 is removed
+        - nni[i] < 0.85*mean, nni[i+1] > 1.15*mean and nni[i+2] > 0.75*mean:
+          nni[i] is replaced by the median, R-peak i is moved accordingly and
+          interval i+1 is removed
+        - nni[i] > 1.15*mean or nni[i] < 0.85*mean: nni[i] is replaced by the
+          median
+    Intervals > 6000 ms or < 300 ms are removed (non-physiological values).
+    The thresholds of both modes are defined in ECTOPIC_THRESHOLDS.
+    
     INPUT:
         r_peaks: array containing all detected R-peaks [s]
         nni: array containing all calculated NN intervals [ms]
+        mode: 'vectorized' (default) evaluates the rules as boolean masks 
+              over rolling means and medians, 'reference' loops over all NN
+              intervals. Both give identical output.
         
     OUTPUT:
         rrn_true: corrected array containing all R-peaks [s]
         nni_true: corrected array containing all NN intervals [ms] 
         
     """
+    if mode == 'reference':
+        return _ectopic_removal_reference(r_peaks, nni)
+    elif mode != 'vectorized':
+        raise ValueError("Unknown mode '%s', use 'vectorized' or 'reference'."
+                         % mode)
     
+    nni = np.asarray(nni)
+    nni_true = nni.copy()
+    rrn = np.asarray(r_peaks)[:-1]
+    rrn_true = rrn.copy()
+    remove = np.zeros(len(nni), dtype=bool)                                     # Mask of 'extra' nni intervals/r peaks
+    
+    th = ECTOPIC_THRESHOLDS
+    remove[1:] = (nni[1:] > th['nni_max']) | (nni[1:] < th['nni_min'])         # Non-physiological values
+    
+    n = np.arange(11, len(nni) - 2)                                             # Number of nni intervals from 10th until end-5th value
+    if len(n) > 0:
+        previous = np.lib.stride_tricks.sliding_window_view(nni, 10)[:len(n)]  # Previous 10 nnis (i-11 until i-2) for every nni
+        mean = previous.mean(axis=1)
+        median = np.median(previous, axis=1)
+        current, consecutive, normal = nni[n], nni[n+1], nni[n+2]
+        
+        short, low, high = th['short']*mean, th['low']*mean, th['high']*mean
+        rule_short = ((current < short) & (consecutive < short) &               # Two short nnis followed by a 'normal' nni
+                      (normal > short))
+        rule_shift = ((current < low) & (consecutive > high) &                  # Short nni followed by a long nni and a 'normal' nni
+                      (normal > short))
+        rule_outlier = (current > high) | (current < low)
+        
+        replace = rule_short | rule_shift | rule_outlier
+        nni_true[n[replace]] = median[replace]                                  # True value of nni is median of previous 10 nnis
+        remove[n[rule_short | rule_shift] + 1] = True                           # Consecutive nni/rpeak is removed
+        
+        # True value of r peak is previous (corrected) r-peak + nni. The r 
+        # peak correction is cumulative over consecutive shifted nnis.
+        shifted = n[rule_shift]
+        if len(shifted) > 0:
+            runs = np.split(shifted, np.flatnonzero(np.diff(shifted) != 1) + 1)
+            single = np.array([run[0] for run in runs if len(run) == 1], 
+                              dtype=int)
+            rrn_true[single] = rrn_true[single-1] + nni_true[single]/1000
+            for run in runs:
+                if len(run) > 1:
+                    steps = np.concatenate(([rrn_true[run[0]-1]], 
+                                            nni_true[run]/1000))
+                    rrn_true[run] = np.cumsum(steps)[1:]
+    
+    nni_true = nni_true[~remove]                                                # Remove all 'extra' nni intervals from data
+    rrn_true = rrn_true[~remove]                                                # Remove all 'extra' r peaks from data
+    
+    return rrn_true, nni_true
+
+def _ectopic_removal_reference(r_peaks, nni):
+    """
+    Reference implementation of ecg_ectopic_removal, looping over all NN 
+    intervals. Kept to validate the vectorized implementation against.
+    
+    INPUT:
+        r_peaks: array containing all detected R-peaks [s]
+        nni: array containing all calculated NN intervals [ms]
+        
+    OUTPUT:
+        rrn_true: corrected array containing all R-peaks [s]
+        nni_true: corrected array containing all NN intervals [ms] 
+        
+    """
+    
+    th = ECTOPIC_THRESHOLDS                                                     # Same thresholds as the vectorized mode
     n = np.arange(1, len(nni), 1)[10:-2]                                        # Number of nni intervals from 10th until end-5th value 
     nni_true = nni.copy()
     rrn = r_peaks[:-1]
@@ -114,25 +684,50 @@ def ecg_ectopic_removal(r_peaks, nni):
     index = []
     
     for i in np.arange(1, len(nni), 1):
-         if nni[i] > 6000 or nni[i] < 300:                                      # Delete NNI and corresponding R-peaks of non-physiological values
+         if nni[i] > th['nni_max'] or nni[i] < th['nni_min']:                   # Delete NNI and corresponding R-peaks of non-physiological values
             index = index + [i]
     
     for i in n:                                                                 # For every nni
-        if nni[i] < 0.75*(np.mean(nni[i-11:i-1])):                              # If nni < 0.75 times the mean of the previous 10 nnis
-            if nni[i+1] < 0.75*(np.mean(nni[i-11:i-1])):                        # And if consecutive nni < 0.75 times the mean of the previous 10 nnis
-                if nni[i+2] > 0.75*(np.mean(nni[i-11:i-1])):                    # And if consecutive nni is 'normal' again
+        if nni[i] < th['short']*(np.mean(nni[i-11:i-1])):                       # If nni < 0.75 times the mean of the previous 10 nnis
+            if nni[i+1] < th['short']*(np.mean(nni[i-11:i-1])):                 # And if consecutive nni < 0.75 times the mean of the previous 10 nnis
+                if nni[i+2] > th['short']*(np.mean(nni[i-11:i-1])):             # And if consecutive nni is 'normal' again
                     nni_true[i] = np.median(nni[i-11:i-1])                      # True value of nni is median of previous 10 nnis
                     index = index + [i+1]                                       # Index of consecutive nni/rpeak (will be removed later on)
-        if nni[i] < 0.85*(np.mean(nni[i-11:i-1])):                              # If nni < 0.75 times the mean of the previous 10 nnis        
-            if nni[i+1] > 1.15*(np.mean(nni[i-11:i-1])):                        # And if conescutive nni >1.15 times the mean of the previous 10 nnis
-                if nni[i+2] > 0.75 * (np.mean(nni[i-11:i-1])):                  # And is consecutive nni is 'normal' again
+        if nni[i] < th['low']*(np.mean(nni[i-11:i-1])):                         # If nni < 0.75 times the mean of the previous 10 nnis        
+            if nni[i+1] > th['high']*(np.mean(nni[i-11:i-1])):                  # And if conescutive nni >1.15 times the mean of the previous 10 nnis
+                if nni[i+2] > th['short']*(np.mean(nni[i-11:i-1])):             # And is consecutive nni is 'normal' again
                     nni_true[i] = np.median(nni[i-11:i-1])                      # True value of nni is median of prevous 10 nnis     
                     rrn_true[i] = rrn_true[i-1] + nni_true[i]/1000              # True value of r peak is previous r-peak + nni
                     index = index + [i+1]                                       # Index of consecutive nni/rpeak (will be removed later on)        
-        if nni[i] > 1.15*(np.mean(nni[i-11:i-1])) or nni[i] < 0.85*(np.mean(nni[i-11:i-1])):
+        if nni[i] > th['high']*(np.mean(nni[i-11:i-1])) or nni[i] < th['low']*(np.mean(nni[i-11:i-1])):
             nni_true[i] = np.median(nni[i-11:i-1])
     
     nni_true = np.delete(nni_true, index)                                       # Remove all 'extra' nni intervals from data
     rrn_true = np.delete(rrn_true, index)                                       # Remove all 'extra' r peaks from data
     
-    return rrn_true, nni_true
\ No newline at end of file
+    return rrn_true, nni_true
+
+def nni_windows(r_peaks, nni, windows):
+    """
+    Function that cuts a (corrected) NNI series into analysis windows. An NN
+    interval is part of a window if both its R-peaks lie within the window.
+    
+    INPUT:
+        r_peaks: array containing the R-peak at the start of every NN interval
+                 [s], e.g. rrn_true of ecg_ectopic_removal
+        nni: array containing all NN intervals [ms]
+        windows: list of (start, end) tuples of the analysis windows [s], on
+                 the same time axis as r_peaks
+        
+    OUTPUT:
+        segments: list with per window a tuple of the R-peaks [s] and NN
+                  intervals [ms] within that window
+    """
+    r_peaks = np.asarray(r_peaks)
+    nni = np.asarray(nni)
+    r_end = r_peaks + nni/1000                                                  # R-peak at the end of every NN interval
+    segments = list()
+    for start, end in windows:
+        keep = (r_peaks >= start) & (r_end <= end)                              # Both R-peaks of the interval within the window
+        segments.append((r_peaks[keep], nni[keep]))
+    return segments
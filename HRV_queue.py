@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+HRV queue
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+File-based work queue for the analysis of a cohort on several nodes that
+share a filesystem (e.g. a cluster with a network drive). The patients are
+split in tasks of task_size patients. Every node (or process) runs work,
+which repeatedly leases a task, analyses its patients with
+HRV_batchmode.workflow_patient and writes the results of the task to its own
+part file. merge assembles the parts into the same export_all and failures
+as workflow_batch on one node.
+
+Queue layout:
+    queue_dir/
+        config.json         arguments of workflow_patient, lease timeout
+        pending/            tasks that wait for a node, 00000.json
+        leased/             tasks that are being processed, 00000@node.json
+        done/               finished tasks, 00000@node.json
+        failed/             tasks that failed max_attempts times
+        parts/              results per task, 00000.jsonl
+
+All state changes are renames within queue_dir, which are atomic: a task is
+leased by renaming it from pending/ to leased/, so only one node gets it.
+While a task is processed, the node touches its lease every
+lease_timeout / 4 seconds. A lease that was not touched for lease_timeout
+seconds belongs to a node that stopped (or lost the filesystem), and is
+returned to pending/ by the first node that notices it, up to max_attempts
+times per task. Parts are written under a temporary name and renamed, so a
+part is complete or absent. If a node with an expired lease still finishes
+its task, it writes the same part again, so no result is counted twice.
+
+Start a worker on every node with:
+    python HRV_queue.py work queue_dir
+after the queue is created by workflow_batch(..., queue_dir=queue_dir) or
+create_queue, and merge the results with:
+    python HRV_queue.py merge queue_dir HRVparameters.csv
+"""
+#%% Required modules
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+
+import HRV_batchmode as workflow
+import HRV_cache as cache
+
+FOLDERS = ('pending', 'leased', 'done', 'failed', 'parts')
+
+#%% Queue
+def _path(queue_dir, folder, name=''):
+    return os.path.join(queue_dir, folder, name)
+
+def _write_json(fname, content):
+    # Write under a temporary name and rename, readers never see part of it
+    tmp = os.path.join(os.path.dirname(fname), '.%s.%s.tmp'
+                       % (os.path.basename(fname), _node()))
+    with open(tmp, 'w') as f:
+        json.dump(content, f, default=cache._to_json)
+    os.replace(tmp, fname)
+
+def _read_json(fname):
+    with open(fname) as f:
+        return json.load(f)
+
+def _node():
+    # Default name of a node: host name and process ID
+    return '%s-%i' % (socket.gethostname(), os.getpid())
+
+def _task_name(fname):
+    # Task of a file name, e.g. '00012@node-123.json' gives '00012'
+    return os.path.basename(fname).split('@')[0].split('.')[0]
+
+def create_queue(queue_dir, patient_ids, task_size=10, lease_timeout=600,
+                 max_attempts=3, **kwargs):
+    """
+    Function that creates a queue with a task per task_size patients. The
+    queue is created under a temporary name and renamed, so when several
+    nodes create the same queue, one of them creates it and the others
+    join it. Joining a queue that was created with other arguments raises a
+    ValueError.
+
+    INPUT:
+        queue_dir: directory of the queue, on a filesystem that all nodes
+                   share
+        patient_ids: .txt file or list of patient IDs
+        task_size: number of patients per task
+        lease_timeout: time after which the lease of a task that is not
+                       touched expires [s]
+        max_attempts: number of times a task is leased before it fails
+        kwargs: arguments of workflow_patient (sampfreq, lead, starttime,
+                endtime, store, windows, ...), except retain, which is
+                always 'results'
+
+    OUTPUT:
+        n_tasks: number of tasks of the queue
+    """
+    if isinstance(patient_ids, str):
+        with open(patient_ids) as f:
+            patient_ids = [x.strip() for x in f if x.strip()]
+    config = json.loads(json.dumps(
+        {'patients': list(patient_ids), 'task_size': task_size,
+         'lease_timeout': lease_timeout, 'max_attempts': max_attempts,
+         'kwargs': kwargs}, default=cache._to_json))
+    tasks = [config['patients'][i:i + task_size]
+             for i in range(0, len(config['patients']), task_size)]
+
+    if not os.path.exists(queue_dir):
+        tmp = '%s.%s.tmp' % (queue_dir.rstrip(os.sep), _node())
+        for folder in FOLDERS:
+            os.makedirs(_path(tmp, folder), exist_ok=True)
+        for i, patients in enumerate(tasks):
+            _write_json(_path(tmp, 'pending', '%05i.json' % i),
+                        {'task': '%05i' % i, 'patients': patients,
+                         'attempts': 0, 'errors': list()})
+        _write_json(os.path.join(tmp, 'config.json'), config)
+        try:
+            os.rename(tmp, queue_dir)                                           # Fails if another node created the queue first
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    for _ in range(100):                                                        # config.json of another node may not be visible yet
+        if os.path.exists(os.path.join(queue_dir, 'config.json')):
+            break
+        time.sleep(0.1)
+    if _read_json(os.path.join(queue_dir, 'config.json')) != config:
+        raise ValueError('Queue %s was created for other patients or '
+                         'arguments, use another queue_dir.' % queue_dir)
+    return len(tasks)
+
+def status(queue_dir):
+    """
+    Function that returns the number of tasks per state ('pending',
+    'leased', 'done', 'failed') and the number of finished tasks per node.
+    """
+    result = {folder: len(_task_files(queue_dir, folder))
+              for folder in FOLDERS[:4]}
+    nodes = [name.split('@', 1)[1][:-5]
+             for name in _task_files(queue_dir, 'done')]
+    result['nodes'] = {node: nodes.count(node) for node in sorted(set(nodes))}
+    return result
+
+def _task_files(queue_dir, folder):
+    # Task files of a folder in order of the tasks, temporary files excluded
+    return sorted(name for name in os.listdir(_path(queue_dir, folder))
+                  if name.endswith('.json') and not name.startswith('.'))
+
+#%% Leases
+def _claim(queue_dir, node):
+    # Lease the first pending task, None if there is none
+    for name in _task_files(queue_dir, 'pending'):
+        pending = _path(queue_dir, 'pending', name)
+        leased = _path(queue_dir, 'leased', '%s@%s.json' % (name[:-5], node))
+        try:
+            os.utime(pending)                                                   # A lease starts now, rename keeps the time
+            os.rename(pending, leased)
+        except FileNotFoundError:                                               # Leased by another node
+            continue
+        return _read_json(leased), leased
+    return None
+
+def _release(queue_dir, fname, task, error, max_attempts):
+    # Return a task to pending, or to failed after max_attempts
+    task['attempts'] += 1
+    task['errors'].append(error)
+    folder = 'failed' if task['attempts'] >= max_attempts else 'pending'
+    _write_json(_path(queue_dir, folder, task['task'] + '.json'), task)
+    os.remove(fname)
+
+def reap(queue_dir, lease_timeout, max_attempts):
+    """
+    Function that returns tasks with an expired lease to pending (or to
+    failed after max_attempts).
+
+    OUTPUT:
+        n_reaped: number of expired leases
+    """
+    n_reaped = 0
+    now = time.time()
+    for name in _task_files(queue_dir, 'leased'):
+        leased = _path(queue_dir, 'leased', name)
+        try:
+            if now - os.path.getmtime(leased) <= lease_timeout:
+                continue
+            reaping = _path(queue_dir, 'leased', '.%s.%s.reap'
+                            % (name, _node()))
+            os.rename(leased, reaping)                                          # Only one node reaps a lease
+        except FileNotFoundError:                                               # Finished or reaped meanwhile
+            continue
+        _release(queue_dir, reaping, _read_json(reaping),
+                 'Lease of %s expired.' % name.split('@', 1)[1][:-5],
+                 max_attempts)
+        n_reaped += 1
+    return n_reaped
+
+def _heartbeat(fname, interval, stop):
+    # Touch the lease until stop is set, or the lease is lost
+    while not stop.wait(interval):
+        try:
+            os.utime(fname)
+        except FileNotFoundError:
+            return
+
+#%% Workers
+def run_task(task, kwargs, part):
+    """
+    Function that analyses the patients of a task and writes their results
+    to a part file, one line of JSON per patient with the keys 'patient',
+    'hrv', 'failures' and 'gated' of workflow_patient. An error of a patient
+    that workflow_patient does not catch (e.g. an invalid option or a full
+    cache disk) is a failure with stage 'queue' of that patient, so that
+    the other patients of the task keep their results.
+
+    INPUT:
+        task: dictionary with key 'patients'
+        kwargs: arguments of workflow_patient, see create_queue
+        part: .jsonl file of the results
+    """
+    kwargs = dict(kwargs, retain='results')
+    if kwargs.get('windows') is not None:
+        kwargs['windows'] = [tuple(window) for window in kwargs['windows']]
+    tmp = os.path.join(os.path.dirname(part), '.%s.%s.tmp'
+                       % (os.path.basename(part), _node()))
+    with open(tmp, 'w') as f:
+        for patient_id in task['patients']:
+            try:
+                result = workflow.workflow_patient(patient_id, **kwargs)
+            except Exception as error:
+                result = {'patient': patient_id, 'hrv': list(), 'gated': False,
+                          'failures': [{'patient': patient_id, 'window': None,
+                                        'stage': 'queue',
+                                        'error': repr(error),
+                                        'reason': None}]}
+            f.write(json.dumps({key: result[key] for key in
+                                ('patient', 'hrv', 'failures', 'gated')},
+                               default=cache._to_json) + '\n')
+    os.replace(tmp, part)
+
+def work(queue_dir, node=None, wait=False, poll=1., max_tasks=None):
+    """
+    Function that processes tasks of the queue until no task is pending.
+    Expired leases of other nodes are returned to pending first.
+
+    INPUT:
+        queue_dir: directory of the queue, see create_queue
+        node: name of the node in the queue (default: None, host name and
+              process ID)
+        wait: if True, wait until the tasks that other nodes lease are
+              finished, and take them over if their lease expires
+        poll: interval between checks while waiting [s]
+        max_tasks: maximum number of tasks of this call (default: None, no
+                   limit)
+
+    OUTPUT:
+        n_done: number of tasks finished by this node
+    """
+    node = _node() if node is None else node.replace('@', '_')
+    config = _read_json(os.path.join(queue_dir, 'config.json'))
+    timeout = config['lease_timeout']
+    n_done = 0
+    while max_tasks is None or n_done < max_tasks:
+        reap(queue_dir, timeout, config['max_attempts'])
+        claimed = _claim(queue_dir, node)
+        if claimed is None:
+            if wait and _task_files(queue_dir, 'leased'):                       # Tasks of other nodes are not finished yet
+                time.sleep(poll)
+                continue
+            break
+        task, leased = claimed
+        stop = threading.Event()
+        beat = threading.Thread(target=_heartbeat,
+                                args=(leased, timeout / 4, stop), daemon=True)
+        beat.start()
+        try:
+            run_task(task, config['kwargs'],
+                     _path(queue_dir, 'parts', task['task'] + '.jsonl'))
+        except Exception as error:
+            stop.set()
+            beat.join()
+            try:
+                _release(queue_dir, leased, task, repr(error),
+                         config['max_attempts'])
+            except FileNotFoundError:                                           # Lease expired and reaped meanwhile
+                pass
+            continue
+        stop.set()
+        beat.join()
+        try:
+            os.rename(leased, _path(queue_dir, 'done',
+                                    os.path.basename(leased)))
+        except FileNotFoundError:                                               # Lease expired, the part is still valid
+            continue
+        n_done += 1
+    return n_done
+
+#%% Merge
+def results(queue_dir):
+    """
+    Function that returns the results of all tasks, in the order of the
+    patients, as dictionaries with the keys 'patient', 'hrv', 'failures' and
+    'gated' of workflow_patient. Patients of failed tasks have a failure
+    with stage 'queue'. A queue that is not finished raises a RuntimeError.
+
+    INPUT:
+        queue_dir: directory of the queue, see create_queue
+
+    OUTPUT:
+        results: generator of the results of the patients
+    """
+    config = _read_json(os.path.join(queue_dir, 'config.json'))
+    remaining = {folder: len(_task_files(queue_dir, folder))
+                 for folder in ('pending', 'leased')}
+    if any(remaining.values()):
+        raise RuntimeError('Queue %s is not finished: %i tasks pending, %i '
+                           'leased.' % (queue_dir, remaining['pending'],
+                                        remaining['leased']))
+    failed = {_task_name(name): _read_json(_path(queue_dir, 'failed', name))
+              for name in _task_files(queue_dir, 'failed')}
+    n_tasks = -(-len(config['patients']) // config['task_size'])
+    return _results(queue_dir, n_tasks, failed)
+
+def _results(queue_dir, n_tasks, failed):
+    # Results per patient, read from the parts one task at a time
+    for i in range(n_tasks):
+        task = '%05i' % i
+        if task in failed:
+            for patient_id in failed[task]['patients']:
+                yield {'patient': patient_id, 'hrv': list(), 'gated': False,
+                       'failures': [{'patient': patient_id, 'window': None,
+                                     'stage': 'queue',
+                                     'error': failed[task]['errors'][-1],
+                                     'reason': None}]}
+            continue
+        with open(_path(queue_dir, 'parts', task + '.jsonl')) as f:
+            for line in f:
+                yield json.loads(line)
+
+def merge(queue_dir, export_path=None, chunk_rows=100000,
+          array_fields='drop'):
+    """
+    Function that assembles the parts of all tasks, in the order of the
+    patients, into the output of workflow_batch (see results and
+    HRV_batchmode.collect_results).
+
+    INPUT:
+        queue_dir: directory of the queue, see create_queue
+        export_path: .csv or .parquet file for the HRV parameters
+                     (default: None, only return export_all)
+        chunk_rows, array_fields: see workflow_batch
+
+    OUTPUT:
+        export_all: dataframe with HRV parameters, see workflow_batch. None
+                    if export_path is given
+        failures: dataframe with failed patients (or windows), see
+                  workflow_batch
+    """
+    config = _read_json(os.path.join(queue_dir, 'config.json'))
+    output = workflow.collect_results(                                          # Sorted by patient and time, as workflow_batch
+        results(queue_dir), config['kwargs'].get('windows') is not None,
+        'results', export_path, chunk_rows, array_fields,
+        patients=config['patients'])
+    return output[5], output[6]
+
+#%% Command line
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Worker and merge of a '
+                                     'HRV work queue.')
+    parser.add_argument('command', choices=['work', 'status', 'merge'])
+    parser.add_argument('queue_dir', help='directory of the queue')
+    parser.add_argument('export_path', nargs='?',
+                        help='.csv or .parquet file of merge')
+    parser.add_argument('--node', help='name of this node in the queue')
+    parser.add_argument('--wait', action='store_true',
+                        help='wait until the tasks of other nodes finish')
+    args = parser.parse_args()
+
+    if args.command == 'work':
+        print('%i tasks done' % work(args.queue_dir, args.node, args.wait))
+    elif args.command == 'status':
+        print(status(args.queue_dir))
+    else:
+        if args.export_path is None:
+            parser.error('merge requires an export_path')
+        export_all, failures = merge(args.queue_dir, args.export_path)
+        print('%i failures' % len(failures))
+        if len(failures):
+            print(failures)
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+HRV record store
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Local on-disk mirror of MIMIC-III waveform records. A one-time ingest converts
+every record into one memory-mapped .npy array per lead, together with a small
+index.json (record name, sampling rate, length and NaN-gap map per lead).
+Windows of a stored record are returned by slicing the memory map, so the
+record is never downloaded or parsed again.
+
+Store layout (patient_id as in files_id.txt, e.g. '34/3400089'):
+    store/
+        34/3400089/
+            index.json
+            II.npy
+            V.npy
+"""
+#%% Required modules
+import collections
+import json
+import os
+
+import numpy as np
+
+INDEX_FILE = 'index.json'
+
+#%% Record object
+class StoredRecord:
+    """
+    Minimal stand-in for wfdb.Record, holding a window of a stored record.
+    Only the attributes used by the HRV pipeline are provided.
+
+    ATTRIBUTES:
+        record_name: name of the record (last 7 characters of patient ID)
+        fs: sampling frequency of recording [Hz]
+        sig_len: number of samples in the window
+        sig_name: list with names of the leads in p_signal
+        n_sig: number of leads in p_signal
+        p_signal: array with rows = samples, columns = leads [mV]
+    """
+
+    def __init__(self, record_name, fs, sig_name, p_signal):
+        self.record_name = record_name
+        self.fs = fs
+        self.sig_name = list(sig_name)
+        self.p_signal = p_signal
+        self.sig_len = p_signal.shape[0]
+        self.n_sig = p_signal.shape[1]
+
+#%% Writing records
+def nan_gaps(signal):
+    """
+    Function that returns the runs of missing samples in a signal.
+
+    INPUT:
+        signal: 1D array with ECG data [mV]
+
+    OUTPUT:
+        gaps: list of [start, stop) sample indices of all NaN runs
+    """
+    isnan = np.isnan(signal).astype(np.int8)
+    edges = np.diff(np.concatenate(([0], isnan, [0])))                          # +1 at start of a gap, -1 after the end of a gap
+    starts = np.flatnonzero(edges == 1)
+    stops = np.flatnonzero(edges == -1)
+    return [[int(a), int(b)] for a, b in zip(starts, stops)]
+
+def record_dir(store, patient_id):
+    """
+    Function that returns the directory of a patient in the record store.
+
+    INPUT:
+        store: path of the record store
+        patient_id: ID number of patient, as in files_id.txt
+
+    OUTPUT:
+        path of the directory of the patient in the store
+    """
+    return os.path.join(store, *patient_id.strip('/').split('/'))
+
+def write_record(store, patient_id, signals, sampfreq, record_name=None):
+    """
+    Function to write a record to the record store. Used by the ingest, but
+    can also be used to store synthetic records.
+
+    INPUT:
+        store: path of the record store
+        patient_id: ID number of patient, as in files_id.txt
+        signals: dictionary with lead name as key and 1D array with ECG data
+                 [mV] as value
+        sampfreq: sampling frequency of recording [Hz]
+        record_name: name of the record (default: last 7 characters of
+                     patient_id)
+
+    OUTPUT:
+        index: dictionary with the index of the stored record
+    """
+    path = record_dir(store, patient_id)
+    os.makedirs(path, exist_ok=True)
+
+    leads = dict()
+    sig_len = None
+    for lead, signal in signals.items():
+        signal = np.asarray(signal, dtype=np.float64)
+        if sig_len is None:
+            sig_len = len(signal)
+        elif len(signal) != sig_len:
+            raise ValueError("All leads of a record must have the same length.")
+        fname = lead + '.npy'
+        np.save(os.path.join(path, fname), signal)
+        leads[lead] = {'file': fname, 'nan_gaps': nan_gaps(signal)}
+
+    index = {'record_name': record_name or patient_id[-7:],
+             'fs': sampfreq, 'sig_len': sig_len, 'leads': leads}
+
+    # Index is written last, a record without index is not part of the store
+    tmp = os.path.join(path, INDEX_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, os.path.join(path, INDEX_FILE))
+    return index
+
+def ingest_record(store, patient_id, leads=None):
+    """
+    Function that downloads a complete record from the MIMIC-III database
+    and writes it to the record store.
+
+    INPUT:
+        store: path of the record store
+        patient_id: ID number of patient for analysis
+        leads: list of ECG leads to store (default: None, all leads)
+
+    OUTPUT:
+        index: dictionary with the index of the stored record
+    """
+    import wfdb
+
+    record = wfdb.rdrecord(patient_id[-7:], pn_dir=('mimic3wdb/'+patient_id),
+                           channel_names=leads)
+    signals = {name: record.p_signal[:, i]
+               for i, name in enumerate(record.sig_name)}
+    return write_record(store, patient_id, signals, record.fs,
+                        record.record_name)
+
+def ingest_batch(patient_ids, store, leads=None, progress=False):
+    """
+    Function that ingests all records of a .txt file with patient IDs.
+    Records that are already in the store are skipped.
+
+    INPUT:
+        patient_ids: .txt file of patient ID from MIMIC-III database
+        store: path of the record store
+        leads: list of ECG leads to store (default: None, all leads)
+        progress: if True, the patient ID is printed before every ingest
+
+    OUTPUT:
+        ingested: list of patient IDs that were added to the store
+    """
+    with open(patient_ids) as f:
+        lines = [x.strip() for x in list(f) if x.strip()]
+
+    ingested = list()
+    for line in lines:
+        if has_record(store, line):
+            continue
+        if progress:
+            print(line)
+        ingest_record(store, line, leads)
+        ingested.append(line)
+    return ingested
+
+#%% Reading records
+def has_record(store, patient_id):
+    """
+    Function that checks if a record is available in the record store.
+    """
+    return os.path.isfile(os.path.join(record_dir(store, patient_id),
+                                       INDEX_FILE))
+
+def read_index(store, patient_id):
+    """
+    Function that reads the index of a stored record.
+
+    INPUT:
+        store: path of the record store
+        patient_id: ID number of patient, as in files_id.txt
+
+    OUTPUT:
+        index: dictionary with record name, sampling frequency [Hz], signal
+               length and per lead the file name and NaN-gap map
+    """
+    with open(os.path.join(record_dir(store, patient_id), INDEX_FILE)) as f:
+        return json.load(f)
+
+MAX_MMAPS = 64                                                                  # Maximum number of memory maps kept open
+_mmaps = collections.OrderedDict()                                              # Lead file: (modification time, memory map), least recently used first
+
+def _open_lead(fname):
+    """
+    Function that memory maps a lead array. The MAX_MMAPS most recently used
+    memory maps are reused as long as the file is not modified; a modified 
+    (e.g. rewritten) file is mapped again, and the least recently used 
+    memory map is released when the limit is reached, so that a long batch
+    or worker does not keep a file descriptor open for every lead file.
+    """
+    mtime = os.stat(fname).st_mtime_ns
+    entry = _mmaps.get(fname)
+    if entry is not None and entry[0] == mtime:
+        _mmaps.move_to_end(fname)
+        return entry[1]
+    array = np.load(fname, mmap_mode='r')
+    _mmaps[fname] = (mtime, array)                                              # Replaces the map of an older version of the file
+    _mmaps.move_to_end(fname)
+    while len(_mmaps) > MAX_MMAPS:
+        _mmaps.popitem(last=False)                                              # Closed when no window refers to it anymore
+    return array
+
+def read_window(store, patient_id, sampfrom, sampto, leads):
+    """
+    Function that returns a window of a stored record by slicing the memory
+    mapped lead arrays.
+
+    INPUT:
+        store: path of the record store
+        patient_id: ID number of patient, as in files_id.txt
+        sampfrom: first sample of the window
+        sampto: sample at which the window stops (not included)
+        leads: list of ECG leads to read
+
+    OUTPUT:
+        record: StoredRecord with the requested window
+    """
+    path = record_dir(store, patient_id)
+    index = read_index(store, patient_id)
+    sig_len = index['sig_len']
+    if sampto is None:
+        sampto = sig_len
+    if sampfrom < 0 or sampto > sig_len or sampfrom >= sampto:
+        raise ValueError('Invalid window [%i, %i) for record %s of length %i.'
+                         % (sampfrom, sampto, patient_id, sig_len))
+
+    missing = [lead for lead in leads if lead not in index['leads']]
+    if missing:
+        raise ValueError('Lead(s) %s not available for record %s.'
+                         % (missing, patient_id))
+
+    columns = [_open_lead(os.path.join(path, index['leads'][lead]['file']))
+               [sampfrom:sampto] for lead in leads]
+    if len(columns) == 1:
+        p_signal = columns[0][:, np.newaxis]                                    # View on the memory map, no copy
+    else:
+        p_signal = np.column_stack(columns)
+    return StoredRecord(index['record_name'], index['fs'], leads, p_signal)
+
+#%% Spilled batch results
+class SpilledArray:
+    """
+    Lazy handle to an array that is spilled to disk by spill_patient. The 
+    array is memory mapped when it is used, e.g. with np.asarray(handle).
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+
+    def load(self):
+        return _open_lead(self.fname)
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.load()
+        return array if dtype is None else array.astype(dtype)
+
+    def __len__(self):
+        return len(self.load())
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __repr__(self):
+        return 'SpilledArray(%r)' % self.fname
+
+class SpilledDataFrame:
+    """
+    Lazy handle to an ECG dataframe (columns Time, ecg_signal, ecg_filtered)
+    that is spilled to disk by spill_patient. Columns are memory mapped when
+    they are accessed (handle.ecg_signal), handle.load() returns the full
+    dataframe. Both keep the index of the original dataframe, which is not
+    contiguous where samples with missing data are dropped.
+    """
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = list(columns)
+
+    @property
+    def index(self):
+        import pandas as pd
+        return pd.Index(_open_lead(os.path.join(self.path, 'index.npy')))
+
+    def __getattr__(self, column):
+        if column in ('path', 'columns') or column not in self.columns:
+            raise AttributeError(column)
+        import pandas as pd
+        return pd.Series(_open_lead(os.path.join(self.path, column + '.npy')),
+                         index=self.index, name=column)
+
+    def __getitem__(self, column):
+        return getattr(self, column)
+
+    def load(self):
+        import pandas as pd
+        return pd.DataFrame({column: getattr(self, column)
+                             for column in self.columns}, index=self.index)
+
+    def __repr__(self):
+        return 'SpilledDataFrame(%r)' % self.path
+
+def spill_patient(spill_dir, patient_id, ecg_df, arrays):
+    """
+    Function that writes the ECG dataframe and R-peak/NNI arrays of a patient
+    to disk, so they do not have to be kept in memory during a batch. The 
+    ECG signals are stored as float32, the time axis, R-peaks and NN 
+    intervals as float64, and the index of ecg_df as it is.
+
+    INPUT:
+        spill_dir: path of the directory for spilled results
+        patient_id: ID number of patient, as in files_id.txt
+        ecg_df: DataFrame with time [s], raw and filtered ECG data [mV], or
+                None
+        arrays: dictionary with name as key and array as value, e.g. 
+                {'r_peaks': r_peaks, 'nni': nni}
+
+    OUTPUT:
+        ecg_handle: SpilledDataFrame of ecg_df (None if ecg_df is None)
+        handles: dictionary with name as key and SpilledArray as value
+    """
+    path = record_dir(spill_dir, patient_id)
+    os.makedirs(path, exist_ok=True)
+    
+    ecg_handle = None
+    if ecg_df is not None:
+        np.save(os.path.join(path, 'index.npy'), ecg_df.index.to_numpy())
+        for column in ecg_df.columns:
+            dtype = np.float64 if column == 'Time' else np.float32
+            np.save(os.path.join(path, column + '.npy'), 
+                    ecg_df[column].to_numpy(dtype=dtype))
+        ecg_handle = SpilledDataFrame(path, ecg_df.columns)
+
+    handles = dict()
+    for name, array in arrays.items():
+        fname = os.path.join(path, name + '.npy')
+        np.save(fname, np.asarray(array, dtype=np.float64))
+        handles[name] = SpilledArray(fname)
+    return ecg_handle, handles
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+HRV sliding windows
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Time domain HRV parameters of overlapping windows (e.g. 5-minute windows
+every 30 seconds over a complete ICU stay), for trend analysis such as
+circadian rhythms. hrv_results computes every window from scratch, O(window)
+per window. Here every parameter is updated incrementally while the window
+slides over the NNI series, so each step costs O(step):
+    - sums (mean, SDNN, RMSSD, SDSD, HR mean and std, NN50) are differences
+      of prefix sums. Prefix sums are taken of values centered on the mean
+      of the complete series, to limit floating point cancellation
+    - minima and maxima (NNI, NNI differences, HR) are kept in monotonic
+      deques, in which every interval is added and removed once
+
+The parameters follow pyhrv.time_domain as used in hrv_results: NNI
+differences are absolute differences, standard deviations use ddof = 1 and
+pNN50 is relative to the number of NNI differences.
+"""
+#%% Required modules
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+TIME_PARAMETERS = ('nni_counter', 'nni_mean', 'nni_min', 'nni_max',
+                   'nni_diff_mean', 'nni_diff_min', 'nni_diff_max', 'hr_mean',
+                   'hr_min', 'hr_max', 'hr_std', 'sdnn', 'rmssd', 'sdsd',
+                   'nn50', 'pnn50')                                             # Parameters of sliding_time_domain, names as hrv_results
+
+#%% Building blocks
+def _prefix(values):
+    # Prefix sums with a leading 0, prefix[j] - prefix[i] = sum(values[i:j])
+    return np.concatenate(([0.], np.cumsum(values)))
+
+def _window_std(values, lo, hi):
+    # Standard deviation (ddof = 1) of values[lo:hi] for every window
+    centered = values - values.mean()
+    s1 = _prefix(centered)
+    s2 = _prefix(centered**2)
+    n = hi - lo
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = ((s2[hi] - s2[lo]) - (s1[hi] - s1[lo])**2 / n) / (n - 1)
+    return np.sqrt(np.maximum(var, 0))
+
+def sliding_extrema(values, lo, hi):
+    """
+    Function that computes the minimum and maximum of values[lo:hi] for a
+    sequence of windows with monotonic deques. Every value is added to and
+    removed from the deques at most once.
+
+    INPUT:
+        values: 1D array
+        lo: array with first index of every window, non-decreasing
+        hi: array with index after the last element of every window,
+            non-decreasing
+
+    OUTPUT:
+        minima: array with minimum per window (NaN for empty windows)
+        maxima: array with maximum per window (NaN for empty windows)
+    """
+    minima = np.full(len(lo), np.nan)
+    maxima = np.full(len(lo), np.nan)
+    low, high = deque(), deque()                                                # Indices with increasing / decreasing values
+    added = 0                                                                   # Values added to the deques so far
+    for w, (start, stop) in enumerate(zip(lo, hi)):
+        while added < stop:
+            value = values[added]
+            while low and values[low[-1]] >= value:
+                low.pop()
+            low.append(added)
+            while high and values[high[-1]] <= value:
+                high.pop()
+            high.append(added)
+            added += 1
+        while low and low[0] < start:
+            low.popleft()
+        while high and high[0] < start:
+            high.popleft()
+        if stop > start:
+            minima[w] = values[low[0]]
+            maxima[w] = values[high[0]]
+    return minima, maxima
+
+def window_bounds(r_peaks, nni, windows):
+    """
+    Function that returns the range of NN intervals within every window. As
+    in preproc.nni_windows, an interval is part of a window if both its
+    R-peaks lie within the window; the intervals of a window are the run
+    lo until hi (not included).
+
+    INPUT:
+        r_peaks: array containing the R-peak at the start of every NN
+                 interval [s]
+        nni: array containing all NN intervals [ms]
+        windows: array with rows = (start, end) of the windows [s]
+
+    OUTPUT:
+        lo: array with the first interval of every window
+        hi: array with the interval after the last interval of every window
+    """
+    # R-peak at the end of every NN interval, made non-decreasing as the
+    # ectopic beat correction can move an R-peak slightly
+    r_end = np.maximum.accumulate(r_peaks + nni/1000)
+    lo = np.searchsorted(r_peaks, windows[:, 0], side='left')
+    hi = np.searchsorted(r_end, windows[:, 1], side='right')
+    return lo, np.maximum(hi, lo)
+
+#%% Sliding windows
+def sliding_time_domain(r_peaks, nni, window=300, step=30, start=None,
+                        end=None):
+    """
+    Function that computes the time domain HRV parameters of overlapping
+    windows.
+
+    INPUT:
+        r_peaks: array containing the R-peak at the start of every NN
+                 interval [s], e.g. rrn_true of ecg_ectopic_removal
+        nni: array containing all NN intervals [ms]
+        window: length of the windows [s]
+        step: step between the start of consecutive windows [s]
+        start: start of the first window [s] (default: first R-peak)
+        end: end of the last window [s] (default: last R-peak)
+
+    OUTPUT:
+        trend: DataFrame with rows = windows, columns = 'time [min]' (start
+               of window) and TIME_PARAMETERS. Windows with less than two
+               NN intervals have NaN parameters.
+    """
+    r_peaks = np.asarray(r_peaks, dtype=np.float64)
+    nni = np.asarray(nni, dtype=np.float64)
+    start = r_peaks[0] if start is None else start
+    end = r_peaks[-1] + nni[-1]/1000 if end is None else end
+    starts = np.arange(start, end - window + 1e-9, step)
+    windows = np.column_stack((starts, starts + window))
+    lo, hi = window_bounds(r_peaks, nni, windows)
+
+    n = hi - lo                                                                 # Number of NN intervals per window
+    nd = np.maximum(n - 1, 0)                                                   # Number of NN interval differences
+    diff = np.abs(np.diff(nni))
+    hr = 60000. / nni
+    valid = n >= 2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s_nni = _prefix(nni - nni.mean())
+        nni_mean = (s_nni[hi] - s_nni[lo]) / n + nni.mean()
+        s_hr = _prefix(hr - hr.mean())
+        hr_mean = (s_hr[hi] - s_hr[lo]) / n + hr.mean()
+        s_diff = _prefix(diff)
+        s_diff2 = _prefix(diff**2)
+        diff_sum = s_diff[lo + nd] - s_diff[lo]                                 # Differences lo until hi-1
+        nni_diff_mean = diff_sum / nd
+        rmssd = np.sqrt((s_diff2[lo + nd] - s_diff2[lo]) / nd)
+        sdsd = _window_std(diff, lo, lo + nd) if len(diff) else np.nan*nd
+        nn50 = _prefix(diff > 50)
+        nn50 = (nn50[lo + nd] - nn50[lo]).astype(int)
+        pnn50 = nn50 / nd * 100
+
+    nni_min, nni_max = sliding_extrema(nni, lo, hi)
+    diff_min, diff_max = sliding_extrema(diff, lo, lo + nd)
+
+    parameters = {
+        'nni_counter': n,
+        'nni_mean': nni_mean,
+        'nni_min': nni_min,
+        'nni_max': nni_max,
+        'nni_diff_mean': nni_diff_mean,
+        'nni_diff_min': np.floor(diff_min),                                     # Integers, as pyhrv
+        'nni_diff_max': np.floor(diff_max),
+        'hr_mean': hr_mean,
+        'hr_min': 60000. / nni_max,
+        'hr_max': 60000. / nni_min,
+        'hr_std': _window_std(hr, lo, hi),
+        'sdnn': _window_std(nni, lo, hi),
+        'rmssd': rmssd,
+        'sdsd': sdsd,
+        'nn50': nn50,
+        'pnn50': pnn50}
+    if not valid.all():
+        for key in TIME_PARAMETERS[1:]:
+            parameters[key] = np.where(valid, parameters[key], np.nan)
+    return pd.DataFrame({'time [min]': starts/60, **parameters})
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+HRV streaming
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Streaming R-peak detection for long recordings (e.g. 72-hour ICU stays).
+Instead of loading the complete [starttime, endtime) span as a DataFrame,
+the record is read in chunks of a fixed length. Every chunk is read with an
+overlap margin on both sides, filtered and segmented as biosppy.signals.ecg.ecg
+does for the whole signal (preproc.ecg_filter and preproc.segment_rpeaks),
+and only the R-peaks within the chunk itself (the core, without margins) are
+kept. Peaks in the core of two chunks that lie closer together than
+min_distance are the same beat and are kept once (preproc.merge_rpeaks).
+
+Peak memory is set by the chunk length plus margins, not by the length of
+the recording; only the R-peaks and NN intervals of the whole recording are
+kept (about 10 bytes per beat).
+
+Differences with the whole-signal path (HRV_preprocessing.ecg_rpeak):
+    - the Hamilton segmenter adapts its thresholds to the previous beats,
+      so it needs a warm-up period. The margin (default: 10 s) gives every
+      chunk this warm-up; peaks can only differ within a few beats of a
+      chunk boundary, and the location of a detected peak differs by at
+      most the correction tolerance of biosppy (0.05 s)
+    - the R-peak times are on the same axis (relative to the first valid
+      sample), but the first valid sample is given exactly as sample/fs,
+      where ecg_dataframe's time axis is stretched by sig_len/(sig_len-1)
+"""
+#%% Required modules
+import numpy as np
+
+import HRV_preprocessing as preproc
+import HRV_prefetch as prefetcher
+
+#%% Streaming
+def stream_rpeaks(patient_id, sampfreq, starttime, endtime, lead='II',
+                  store=None, offline=False, chunk=600, margin=10,
+                  min_distance=0.2, prefetch=0):
+    """
+    Function that detects all R-peaks between starttime and endtime by
+    reading and processing the record in chunks. Leading missing samples
+    are skipped, later missing samples are set to 0, as in ecg_dataframe.
+
+    INPUT:
+        patient_id: ID number of patient from MIMIC-III database
+        sampfreq: sampling frequency of recording [Hz]
+        starttime: starting time of ECG analysis [s]
+        endtime: ending time of ECG analysis [s]
+        lead: ECG lead for analysis: 'I', "II", "V"
+        store: path of local record store, see HRV_recordstore.py
+        offline: if True, only load records from the record store
+        chunk: length of the chunks [s]
+        margin: overlap margin on both sides of a chunk [s]
+        min_distance: minimum distance between two R-peaks [s], closer
+                      peaks at a chunk boundary are the same beat
+        prefetch: number of chunks read ahead on I/O threads (one per 
+                  chunk) while the current chunk is processed (default: 0,
+                  no prefetching)
+
+    OUTPUT:
+        r_peaks: array containing all detected R-peaks [s], relative to the
+                 first valid sample
+        nni: array containing all calculated NN intervals [ms]
+        first_valid: time of the first valid sample [s], relative to
+                     starttime
+    """
+    import pyhrv.tools as tools
+    
+    start = int(sampfreq * starttime)
+    stop = int(sampfreq * endtime)
+    chunk_len = int(chunk * sampfreq)
+    margin_len = int(margin * sampfreq)
+
+    def read(sampfrom, sampto):
+        record = preproc.load_samples(patient_id, sampfrom, sampto, lead,
+                                      store, offline)
+        return np.asarray(record.p_signal[:, 0], dtype=np.float64)
+
+    # First valid sample
+    first = None
+    position = start
+    while first is None and position < stop:
+        valid = np.flatnonzero(~np.isnan(read(position,
+                                              min(position + chunk_len, stop))))
+        if len(valid) > 0:
+            first = position + valid[0]
+        position += chunk_len
+    if first is None:
+        raise ValueError('No valid ECG samples between %s and %s s.'
+                         % (starttime, endtime))
+
+    # R-peaks per chunk, only the peaks in the core of a chunk are kept
+    jobs = [(core_start, min(core_start + chunk_len, stop),
+             max(core_start - margin_len, first), 
+             min(core_start + chunk_len + margin_len, stop)) 
+            for core_start in range(first, stop, chunk_len)]
+    
+    def load(job):
+        return np.nan_to_num(read(job[2], job[3]), nan=0.)
+    
+    if prefetch > 0:
+        signals = ((job, future.result()) for job, future                       # Next chunks are read while this chunk is processed
+                   in prefetcher.prefetch(load, jobs, prefetch, prefetch))
+    else:
+        signals = ((job, load(job)) for job in jobs)
+    
+    peaks = list()
+    for (core_start, core_end, read_start, read_end), signal in signals:
+        filtered = preproc.ecg_filter(signal, sampfreq)
+        rpeaks = preproc.segment_rpeaks(filtered, sampfreq) + read_start
+        peaks.append(rpeaks[(rpeaks >= core_start) & (rpeaks < core_end)])
+        del signal, filtered
+
+    rpeaks = preproc.merge_rpeaks(peaks, min_distance * sampfreq)               # Same beat detected in two chunks is kept once
+    r_peaks = (rpeaks - first) / sampfreq                                       # Time relative to first valid sample [s]
+    nni = tools.nn_intervals(r_peaks)                                           # Calculate NN intervals
+    return r_peaks, nni, (first - start) / sampfreq
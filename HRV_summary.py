@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+HRV summary
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Single-pass summary statistics of exported HRV parameters (.csv or .parquet,
+see HRV_export.py) that do not have to fit in memory. The export is read in
+chunks of rows and per parameter the summary keeps:
+    - count, mean and standard deviation, updated per chunk with the
+      parallel variant of Welford's algorithm (Chan et al.)
+    - minimum and maximum
+    - a quantile sketch with relative accuracy (DDSketch): values are
+      counted in logarithmic buckets, so that every quantile is known within
+      a relative error of accuracy (default: 1%)
+    - optionally a histogram with fixed bin edges
+
+Every part is mergeable: summaries of parts of a cohort (e.g. of parallel
+workers, or of one file per node) are combined with merge, which gives the
+same result as one summary of all rows (up to floating point rounding).
+Units of the parameters are taken from HRV_calculations.PARAMETERS.
+"""
+#%% Required modules
+import math
+
+import numpy as np
+import pandas as pd
+
+EXCLUDE = ('time [min]', )                                                      # Numeric columns of the export that are not HRV parameters
+
+#%% Quantile sketch
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with relative accuracy (DDSketch). A positive
+    value x is counted in bucket ceil(log(x) / log(gamma)) with
+    gamma = (1 + accuracy) / (1 - accuracy), negative values in a separate
+    store of buckets of -x, zeros separately.
+
+    INPUT:
+        accuracy: relative accuracy of the quantiles
+    """
+
+    def __init__(self, accuracy=0.01):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = dict()                                                  # Bucket: count
+        self.negative = dict()
+        self.zeros = 0
+        self.count = 0
+
+    def _add(self, store, values):
+        keys, counts = np.unique(np.ceil(np.log(values) / self._log_gamma),
+                                 return_counts=True)
+        for key, count in zip(keys.astype(int).tolist(), counts.tolist()):
+            store[key] = store.get(key, 0) + count
+
+    def update(self, values):
+        """
+        Function that adds an array of finite values to the sketch.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        self._add(self.positive, values[values > 0])
+        self._add(self.negative, -values[values < 0])
+        self.zeros += int(np.count_nonzero(values == 0))
+        self.count += len(values)
+
+    def merge(self, other):
+        """
+        Function that adds the counts of another sketch with the same
+        accuracy.
+        """
+        if other.accuracy != self.accuracy:
+            raise ValueError('Sketches with different accuracy cannot be '
+                             'merged.')
+        for store, other_store in ((self.positive, other.positive),
+                                   (self.negative, other.negative)):
+            for key, count in other_store.items():
+                store[key] = store.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        return self
+
+    def _value(self, key):
+        # Representative value of a bucket, within accuracy of all values
+        return 2 * self.gamma**key / (self.gamma + 1)
+
+    def buckets(self):
+        """
+        Function that returns the representative values and counts of all
+        buckets, sorted by value.
+        """
+        values = ([-self._value(key) for key in sorted(self.negative,
+                                                       reverse=True)] +
+                  ([0.] if self.zeros else []) +
+                  [self._value(key) for key in sorted(self.positive)])
+        counts = ([self.negative[key] for key in sorted(self.negative,
+                                                        reverse=True)] +
+                  ([self.zeros] if self.zeros else []) +
+                  [self.positive[key] for key in sorted(self.positive)])
+        return np.array(values), np.array(counts, dtype=np.int64)
+
+    def quantile(self, q):
+        """
+        Function that returns the q-quantile(s) (0 <= q <= 1) of the values,
+        NaN for an empty sketch.
+        """
+        q = np.asarray(q, dtype=np.float64)
+        if self.count == 0:
+            return np.full(q.shape, np.nan)[()]
+        values, counts = self.buckets()
+        rank = q * (self.count - 1)                                             # Rank of the quantile, 0-based
+        index = np.searchsorted(np.cumsum(counts), rank, side='right')
+        return values[np.minimum(index, len(values) - 1)][()]
+
+#%% Summary per parameter
+class StreamingSummary:
+    """
+    Mergeable single-pass summary of the numeric columns of a table of HRV
+    parameters.
+
+    INPUT:
+        accuracy: relative accuracy of the quantile sketches
+        edges: dictionary with column name as key and fixed bin edges of
+               its histogram as value (default: None, no fixed histograms,
+               see histogram)
+        exclude: names of numeric columns that are not summarized
+    """
+
+    def __init__(self, accuracy=0.01, edges=None, exclude=EXCLUDE):
+        self.accuracy = accuracy
+        self.edges = {key: np.asarray(value, dtype=np.float64)
+                      for key, value in (edges or dict()).items()}
+        self.exclude = tuple(exclude)
+        self.columns = list()                                                   # Summarized columns, in order of appearance
+        self.stats = dict()                                                     # Column: [count, mean, M2, min, max, missing]
+        self.sketches = dict()
+        self.histograms = dict()                                                # Column: counts within edges, below, above
+
+    def _add_column(self, column):
+        self.columns.append(column)
+        self.stats[column] = [0, 0., 0., np.inf, -np.inf, 0]
+        self.sketches[column] = QuantileSketch(self.accuracy)
+        if column in self.edges:
+            self.histograms[column] = np.zeros(len(self.edges[column]) + 1,
+                                               dtype=np.int64)
+
+    def update(self, chunk):
+        """
+        Function that adds the rows of a DataFrame. Non-numeric columns
+        (e.g. patient IDs) are skipped, non-finite values are counted as
+        missing.
+        """
+        for column in chunk.columns:
+            if column in self.exclude or \
+                    not pd.api.types.is_numeric_dtype(chunk[column]):
+                continue
+            if column not in self.stats:
+                self._add_column(column)
+            values = chunk[column].to_numpy(dtype=np.float64)
+            finite = values[np.isfinite(values)]
+            n = len(finite)
+            stats = self.stats[column]
+            stats[5] += len(values) - n
+            if n == 0:
+                continue
+            mean = finite.mean()
+            m2 = np.sum((finite - mean)**2)
+            self._combine(stats, [n, mean, m2, finite.min(), finite.max(), 0])
+            self.sketches[column].update(finite)
+            if column in self.histograms:
+                edges = self.edges[column]
+                index = np.searchsorted(edges, finite, side='right')            # 0: below first edge, len(edges): above last edge
+                index[finite == edges[-1]] = len(edges) - 1                     # Last bin includes its right edge, as np.histogram
+                self.histograms[column] += np.bincount(index,
+                                                       minlength=len(edges)+1)
+
+    @staticmethod
+    def _combine(stats, other):
+        # Parallel update of count, mean and M2 (Chan et al.), in place
+        n_a, mean_a, m2_a = stats[:3]
+        n_b, mean_b, m2_b = other[:3]
+        n = n_a + n_b
+        if n_b > 0:
+            delta = mean_b - mean_a
+            stats[0] = n
+            stats[1] = mean_a + delta * n_b / n
+            stats[2] = m2_a + m2_b + delta**2 * n_a * n_b / n
+            stats[3] = min(stats[3], other[3])
+            stats[4] = max(stats[4], other[4])
+        stats[5] += other[5]
+
+    def merge(self, other):
+        """
+        Function that adds another summary (e.g. of a parallel worker) with
+        the same accuracy and edges. Returns the merged summary.
+        """
+        for column in other.columns:
+            if column not in self.stats:
+                self._add_column(column)
+            self._combine(self.stats[column], other.stats[column])
+            self.sketches[column].merge(other.sketches[column])
+            if column in self.histograms:
+                if not np.array_equal(self.edges[column],
+                                      other.edges.get(column)):
+                    raise ValueError('Histograms of %s have different edges.'
+                                     % column)
+                self.histograms[column] += other.histograms[column]
+        return self
+
+    def histogram(self, column, bins=20):
+        """
+        Function that returns the histogram of a column. With fixed edges
+        the exact counts are returned, otherwise bins bins between the
+        minimum and maximum are filled from the quantile sketch (every value
+        within the accuracy of the sketch).
+
+        OUTPUT:
+            counts: array with counts per bin
+            edges: array with bin edges
+        """
+        if column in self.histograms:
+            return self.histograms[column][1:-1], self.edges[column]            # Values outside the edges are left out, as np.histogram
+        stats = self.stats[column]
+        if stats[0] == 0:
+            return np.zeros(bins, dtype=np.int64), np.linspace(0, 1, bins + 1)
+        values, counts = self.sketches[column].buckets()
+        values = np.clip(values, stats[3], stats[4])
+        return np.histogram(values, bins=bins, range=(stats[3], stats[4]),
+                            weights=counts)[0].astype(np.int64), \
+            np.linspace(stats[3], stats[4], bins + 1)
+
+    def result(self, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        """
+        Function that returns the summary as a DataFrame.
+
+        OUTPUT:
+            result: DataFrame with rows = parameters, columns = 'Mean', 'Std'
+                    (ddof = 1), 'Count', 'Missing', 'Min', quantiles (e.g.
+                    'Q50'), 'Max' and 'Unit'
+        """
+        rows = dict()
+        for column in self.columns:
+            n, mean, m2, minimum, maximum, missing = self.stats[column]
+            row = {'Mean': mean if n else np.nan,
+                   'Std': np.sqrt(m2 / (n - 1)) if n > 1 else np.nan,
+                   'Count': n, 'Missing': missing,
+                   'Min': minimum if n else np.nan}
+            values = np.atleast_1d(self.sketches[column].quantile(quantiles))
+            for q, value in zip(quantiles, values):
+                row['Q%g' % (100*q)] = value
+            row['Max'] = maximum if n else np.nan
+            row['Unit'] = unit(column)
+            rows[column] = row
+        return pd.DataFrame.from_dict(rows, orient='index')
+
+#%% Reading exports
+def unit(column):
+    """
+    Function that returns the unit of an exported column from
+    HRV_calculations.PARAMETERS, also for the '_min' and '_max' columns of
+    array fields. Unknown columns give '[-]'.
+    """
+    import HRV_calculations as hrvcalc
+
+    for name in (column, column.rsplit('_', 1)[0]):
+        if name in hrvcalc.PARAMETERS:
+            return hrvcalc.PARAMETERS[name][1]
+    return '[-]'
+
+def read_chunks(path, chunk_rows=100000):
+    """
+    Function that reads an export (.csv or .parquet) in chunks of rows, with
+    the index of the export as index.
+
+    INPUT:
+        path: .csv or .parquet file
+        chunk_rows: number of rows per chunk
+
+    OUTPUT:
+        generator of DataFrames
+    """
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('pyarrow is required to read .parquet files.')
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, index_col=0, chunksize=chunk_rows)         # First column: index of the export (patient ID or row number)
+
+def summarize(path, chunk_rows=100000, accuracy=0.01, edges=None,
+              exclude=EXCLUDE):
+    """
+    Function that summarizes an export in one pass over its chunks.
+
+    INPUT:
+        path: .csv or .parquet file with HRV parameters
+        chunk_rows: number of rows per chunk
+        accuracy, edges, exclude: see StreamingSummary
+
+    OUTPUT:
+        summary: StreamingSummary
+    """
+    summary = StreamingSummary(accuracy, edges, exclude)
+    for chunk in read_chunks(path, chunk_rows):
+        summary.update(chunk)
+    return summary
+
+def summarize_files(paths, chunk_rows=100000, accuracy=0.01, edges=None,
+                    exclude=EXCLUDE, n_workers=1):
+    """
+    Function that summarizes several exports (e.g. one per node) on
+    n_workers processes and merges the partial summaries.
+
+    OUTPUT:
+        summary: StreamingSummary of all rows of all files
+    """
+    if n_workers > 1 and len(paths) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            parts = list(executor.map(summarize, paths,
+                                      *zip(*[(chunk_rows, accuracy, edges,
+                                              exclude)]*len(paths))))
+    else:
+        parts = [summarize(path, chunk_rows, accuracy, edges, exclude)
+                 for path in paths]
+    summary = StreamingSummary(accuracy, edges, exclude)
+    for part in parts:
+        summary.merge(part)
+    return summary
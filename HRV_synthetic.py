@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+HRV synthetic
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Deterministic synthetic NNI series and ECG signals, so that the pipeline can
+be run and benchmarked without access to the MIMIC-III database. The same
+arguments (including the seed) always give the same data. Length (5 minutes
+to 72 hours or more), sampling frequency, rate of ectopic beats and NaN gaps
+can be set; synthetic_store writes a cohort of synthetic records to a local
+record store (HRV_recordstore.py), from which workflow_batch reads them with
+offline = True.
+"""
+#%% Required modules
+import os
+
+import numpy as np
+
+import HRV_recordstore as recstore
+
+#%% NNI series
+def synthetic_nni(n_beats, ectopic_rate=0.02, seed=0, outlier_rate=None):
+    """
+    Function that creates a random NNI series with ectopic beats and outliers.
+
+    INPUT:
+        n_beats: number of NN intervals
+        ectopic_rate: fraction of ectopic beats (short interval followed by a
+                      long interval)
+        seed: seed of the random number generator
+        outlier_rate: fraction of non-physiological intervals (150 or 7000
+                      ms) (default: None, ectopic_rate / 10)
+
+    OUTPUT:
+        r_peaks: array containing all R-peaks [s]
+        nni: array containing all NN intervals [ms]
+    """
+    rng = np.random.default_rng(seed)
+    outlier_rate = ectopic_rate/10 if outlier_rate is None else outlier_rate
+    nni = rng.normal(800, 40, n_beats)
+    ectopic = np.flatnonzero(rng.random(n_beats - 1) < ectopic_rate)
+    nni[ectopic] *= 0.6                                                         # Premature beat
+    nni[ectopic + 1] *= 1.4                                                     # Compensatory pause
+    outlier = rng.random(n_beats) < outlier_rate
+    nni[outlier] = rng.choice([150., 7000.], outlier.sum())                     # Non-physiological values
+    r_peaks = np.concatenate(([0.], np.cumsum(nni)/1000))
+    return r_peaks, nni
+
+#%% ECG signals
+def synthetic_ecg(duration, sampfreq=125, ectopic_rate=0, gaps=(), seed=0,
+                  block=10000):
+    """
+    Function that creates a simple synthetic ECG signal: Gaussian QRS
+    complexes and T waves at the R-peaks of synthetic_nni (without
+    outliers), with baseline wander and noise. The beats are added in blocks,
+    so that long signals (e.g. 72 hours) need little more memory than the
+    signal itself.
+
+    INPUT:
+        duration: duration of the signal [s]
+        sampfreq: sampling frequency [Hz]
+        ectopic_rate: fraction of ectopic beats
+        gaps: list of (start, end) tuples of missing data [s], set to NaN
+        seed: seed of the random number generator
+        block: number of beats added at once
+
+    OUTPUT:
+        signal: array with ECG data [mV]
+        r_peaks: array containing the R-peaks outside the gaps [s]
+    """
+    rng = np.random.default_rng(seed)
+    r_peaks = synthetic_nni(int(duration/0.8) + 2, ectopic_rate=ectopic_rate,
+                            seed=seed, outlier_rate=0)[0] + 0.5
+    r_peaks = r_peaks[r_peaks < duration - 0.5]
+    n = int(duration*sampfreq)
+    signal = 0.03*rng.standard_normal(n)                                        # Noise
+    for start in range(0, n, 10**6):
+        t = np.arange(start, min(start + 10**6, n)) / sampfreq
+        signal[start:start + len(t)] += 0.1*np.sin(2*np.pi*0.25*t)              # Baseline wander
+    width = np.arange(-int(0.3*sampfreq), int(0.3*sampfreq) + 1)
+    qrs = 1.2*np.exp(-0.5*(width/(0.012*sampfreq))**2)                          # QRS complex
+    twave = 0.3*np.exp(-0.5*((width/sampfreq - 0.25)/0.04)**2)                  # T wave
+    for start in range(0, len(r_peaks), block):
+        index = (np.round(r_peaks[start:start + block]*sampfreq).astype(int)
+                 [:, np.newaxis] + width)
+        valid = (index >= 0) & (index < n)
+        np.add.at(signal, index[valid], np.broadcast_to(qrs + twave,
+                                                        index.shape)[valid])
+    for start, end in gaps:
+        signal[int(start*sampfreq):int(end*sampfreq)] = np.nan
+        r_peaks = r_peaks[(r_peaks < start) | (r_peaks >= end)]
+    return signal, r_peaks
+
+#%% Synthetic cohort
+def synthetic_store(store, n_patients, duration, sampfreq=125, lead='II',
+                    ectopic_rate=0.02, gaps=(), seed=0):
+    """
+    Function that writes a cohort of synthetic records to a record store,
+    together with a .txt file with their patient IDs (as files_id.txt).
+    Patient i has seed + i as seed, existing records with the same patient
+    ID are overwritten.
+
+    INPUT:
+        store: path of the record store
+        n_patients: number of synthetic patients
+        duration: duration of every record [s]
+        sampfreq: sampling frequency [Hz]
+        lead: name of the lead
+        ectopic_rate: fraction of ectopic beats
+        gaps: list of (start, end) tuples of missing data [s]
+        seed: seed of the first patient
+
+    OUTPUT:
+        patient_ids: path of the .txt file with patient IDs
+    """
+    lines = list()
+    for i in range(n_patients):
+        patient_id = 'synthetic/%07i' % (seed + i)
+        signal, _ = synthetic_ecg(duration, sampfreq, ectopic_rate, gaps,
+                                  seed + i)
+        recstore.write_record(store, patient_id, {lead: signal}, sampfreq)
+        lines.append(patient_id)
+    patient_ids = os.path.join(store, 'synthetic_ids.txt')
+    with open(patient_ids, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return patient_ids
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+HRV trace
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Instrumentation of the stages of the pipeline (loading, dataframe, R-peak
+detection, ectopic beat removal, HRV calculations and the pyhrv calls within
+hrv_results). Every stage is wrapped in a context manager:
+
+    with tracer.stage('rpeak', samples=len(ecg_df)):
+        ...
+
+When tracing is enabled, every stage gives a record with wall time, CPU
+time, peak RSS of the process, the increase of the peak RSS during the stage,
+optionally the peak of traced Python memory (tracemalloc) and the tags of
+the stage and of the stages around it (patient, window, samples, beats).
+Records are appended as JSON lines to a file and/or passed to hooks
+(callables with the record as argument). summary turns a trace into tables
+of the slowest stages and patients.
+
+When tracing is disabled (default), stage returns one shared context manager
+that does nothing, so the instrumentation costs a function call per stage.
+Worker processes of workflow_batch enable tracing themselves and append to
+the same file; every record contains the process ID.
+"""
+#%% Required modules
+import json
+import os
+import time
+import tracemalloc
+
+import pandas as pd
+
+try:
+    import resource                                                             # Not available on Windows
+except ImportError:
+    resource = None
+
+_tracer = None                                                                  # Active tracer, None: tracing disabled
+
+#%% Tracer
+def _max_rss():
+    # Peak resident set size of the process [MB]
+    if resource is None:
+        return float('nan')
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024            # Linux: kB
+
+class _NoStage:
+    # Context manager of a disabled tracer
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_STAGE = _NoStage()
+
+class _Stage:
+    # Context manager that measures one stage
+    def __init__(self, tracer, name, tags):
+        self.tracer = tracer
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        tracer = self.tracer
+        self.parent = tracer.stack[-1] if tracer.stack else None
+        if self.parent is not None:
+            self.tags = {**self.parent.tags, **self.tags}                       # Patient, window etc. of the enclosing stages
+        self.peak = 0
+        if tracer.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            for stage in tracer.stack:                                          # Keep the peak of the enclosing stages before resetting it
+                stage.peak = max(stage.peak, peak)
+            if hasattr(tracemalloc, 'reset_peak'):                              # Python >= 3.9
+                tracemalloc.reset_peak()
+            self.memory_start = current
+        tracer.stack.append(self)
+        self.rss_start = _max_rss()
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        rss = _max_rss()
+        tracer = self.tracer
+        tracer.stack.pop()
+        record = {'stage': self.name, **self.tags, 'wall': wall, 'cpu': cpu,
+                  'rss_peak': rss, 'rss_delta': rss - self.rss_start,
+                  'pid': os.getpid(), 'error': exc_type is not None}
+        if tracer.memory:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            if self.parent is not None:
+                self.parent.peak = max(self.parent.peak, self.peak)
+            record['traced_peak'] = (self.peak - self.memory_start) / 2**20     # [MB] above the traced memory at the start of the stage
+        tracer.emit(record)
+        return False
+
+class Tracer:
+    """
+    Tracer that measures stages and writes their records.
+
+    INPUT:
+        path: .jsonl file to which records are appended (default: None)
+        memory: if True, also measure the peak of traced Python memory with
+                tracemalloc (slows down the pipeline)
+        hooks: list of callables that receive every record
+    """
+
+    def __init__(self, path=None, memory=False, hooks=()):
+        self.path = path
+        self.memory = memory
+        self.hooks = list(hooks)
+        self.stack = list()                                                     # Open stages, innermost last
+        self.records = list() if path is None else None                         # Records in memory if no path is given
+        self.started_tracemalloc = False                                        # tracemalloc started by enable
+
+    def stage(self, name, **tags):
+        return _Stage(self, name, tags)
+
+    def emit(self, record):
+        if self.path is not None:
+            with open(self.path, 'a') as f:                                     # One write per record, processes append to the same file
+                f.write(json.dumps(record, default=_to_json) + '\n')
+        else:
+            self.records.append(record)
+        for hook in self.hooks:
+            hook(record)
+
+def _to_json(value):
+    # numpy scalars (e.g. patient window start) as JSON types
+    return value.item() if hasattr(value, 'item') else str(value)
+
+#%% Module interface
+def enable(path=None, memory=False, hooks=()):
+    """
+    Function that enables tracing in the current process.
+
+    INPUT:
+        path: .jsonl file to which records are appended (default: None,
+              records are kept in memory, see records)
+        memory: if True, also measure the peak of traced Python memory
+        hooks: list of callables that receive every record
+
+    OUTPUT:
+        tracer: the active Tracer
+    """
+    global _tracer
+    disable()
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    _tracer = Tracer(path, memory, hooks)
+    _tracer.started_tracemalloc = started
+    return _tracer
+
+def disable():
+    """
+    Function that disables tracing, tracemalloc is stopped if it was
+    started by enable.
+    """
+    global _tracer
+    if _tracer is not None and _tracer.started_tracemalloc:
+        tracemalloc.stop()
+    _tracer = None
+
+def enabled():
+    """
+    Function that returns the active Tracer, or None if tracing is disabled.
+    """
+    return _tracer
+
+def stage(name, **tags):
+    """
+    Function that returns a context manager around one stage of the
+    pipeline. Tags are stored in the record of the stage and of all stages
+    within it.
+
+    INPUT:
+        name: name of the stage, e.g. 'rpeak' or 'hrv.welch_psd'
+        tags: e.g. patient (ID), window (start [s]), samples or beats (size
+              of the input)
+    """
+    if _tracer is None:
+        return _NO_STAGE
+    return _Stage(_tracer, name, tags)
+
+def records():
+    """
+    Function that returns the records of the active tracer without path.
+    """
+    return [] if _tracer is None or _tracer.records is None else \
+        _tracer.records
+
+#%% Summary
+def read_trace(path):
+    """
+    Function that reads a .jsonl trace into a DataFrame with one row per
+    record.
+    """
+    with open(path) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+def summary(trace, top=10):
+    """
+    Function that summarizes a trace.
+
+    INPUT:
+        trace: .jsonl file, list of records or DataFrame of read_trace
+        top: number of patients and records in the tables of the slowest
+             patients and records
+
+    OUTPUT:
+        stages: DataFrame with rows = stages, columns = count, total, mean
+                and maximum wall time [s], total CPU time [s], maximum RSS
+                increase [MB] (and maximum traced peak [MB]), sorted by
+                total wall time
+        patients: DataFrame with the slowest patients, wall time [s] per 
+                  patient in total and per first level stage (stages 
+                  without '.' in their name)
+        slowest: DataFrame with the slowest records
+    """
+    if isinstance(trace, str):
+        trace = read_trace(trace)
+    elif not isinstance(trace, pd.DataFrame):
+        trace = pd.DataFrame(trace)
+    if trace.empty:
+        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+
+    aggregate = {'count': ('wall', 'size'), 'wall_total': ('wall', 'sum'),
+                 'wall_mean': ('wall', 'mean'), 'wall_max': ('wall', 'max'),
+                 'cpu_total': ('cpu', 'sum'), 'rss_delta_max': ('rss_delta',
+                                                                'max')}
+    if 'traced_peak' in trace:
+        aggregate['traced_peak_max'] = ('traced_peak', 'max')
+    stages = trace.groupby('stage').agg(**aggregate)
+    stages = stages.sort_values('wall_total', ascending=False)
+
+    patients = pd.DataFrame()
+    if 'patient' in trace:
+        first_level = trace[~trace.stage.str.contains('.', regex=False)]       # Nested stages (e.g. 'hrv.sdnn') are part of their first level stage
+        patients = first_level.pivot_table(index='patient', columns='stage',
+                                           values='wall', aggfunc='sum')
+        patients.insert(0, 'total', patients.sum(axis=1))
+        patients = patients.sort_values('total', ascending=False).head(top)
+
+    slowest = trace.sort_values('wall', ascending=False).head(top)
+    return stages, patients, slowest
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+HRV worker
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Long-running worker for small on-demand HRV requests (e.g. the trend of one
+patient in the last hour). Starting Python and importing pyhrv, biosppy,
+scipy and wfdb takes seconds, which is more than the analysis of a short
+window. The worker imports all libraries once (preload) and keeps the
+caches of the process warm between jobs: the code version of the result
+cache (HRV_cache.code_version), the most recently used memory maps of the
+record store (HRV_recordstore.MAX_MMAPS) and the imported pyhrv modules.
+
+A job is a dictionary with the arguments of HRV_batchmode.workflow_patient,
+options as keyword arguments (see HRV_batchmode.PatientOptions), e.g.:
+
+    {"id": "bed12", "patient_id": "30/3000003", "sampfreq": 125,
+     "lead": "II", "starttime": 0, "endtime": 3600, "store": "store",
+     "windows": [[0, 300], [300, 600]], "engine": "fast"}
+
+Only the HRV parameters are returned (retain = 'results'): a dictionary
+with 'id', 'patient', 'hrv', 'failures', 'cached', 'lead', 'lead_quality',
+'gated' and the processing time 'seconds', or 'id' and 'error' if the job
+itself is invalid. The jobs {"command": "ping"} and {"command": "stop"}
+return the state of the worker and stop it.
+
+Jobs are accepted over a local TCP socket, one JSON object per line (see
+serve_socket and request), or over a spool directory (see serve_spool,
+submit and result):
+    spool_dir/
+        in/         submitted jobs, id.json
+        work/       jobs that are being processed
+        out/        results, id.json
+Files are written under a temporary name and renamed, so a job or result is
+never read half-written, and several workers can share a spool directory.
+Jobs are processed one at a time per worker.
+
+Start a worker from the command line:
+    python HRV_worker.py --socket 127.0.0.1:8765
+    python HRV_worker.py --spool spool_dir --store store --offline
+"""
+#%% Required modules
+import json
+import os
+import socket
+import socketserver
+import time
+import uuid
+
+import HRV_batchmode as workflow
+import HRV_cache as cache
+
+#%% Jobs
+def preload():
+    """
+    Function that imports the libraries of the compute path, which are
+    otherwise imported by the first job.
+
+    OUTPUT:
+        seconds: time of the imports [s]
+    """
+    start = time.perf_counter()
+    import wfdb
+    import biosppy.signals.ecg
+    import biosppy.signals.tools
+    import pyhrv.time_domain
+    import pyhrv.frequency_domain
+    import pyhrv.nonlinear
+    import pyhrv.tools
+    import scipy.spatial
+
+    cache.code_version()                                                        # Hash of the source code, kept by lru_cache
+    return time.perf_counter() - start
+
+def run_job(job, defaults=None):
+    """
+    Function that runs one job in this process.
+
+    INPUT:
+        job: dictionary with an optional 'id' and the arguments of
+             workflow_patient, or a command ('ping' or 'stop')
+        defaults: dictionary with arguments of workflow_patient that are
+                  used if the job does not contain them (e.g. store)
+
+    OUTPUT:
+        reply: dictionary that can be written as JSON, see module docstring
+    """
+    if not isinstance(job, dict):
+        return {'id': None, 'error': 'A job is a JSON object, not %s.' 
+                % type(job).__name__}
+    job = dict(job)
+    reply = {'id': job.pop('id', None)}
+    command = job.pop('command', None)
+    if command is not None:
+        if command not in ('ping', 'stop'):
+            reply['error'] = 'Unknown command %r.' % command
+            return reply
+        reply.update({'status': 'stopped' if command == 'stop' else 'ok',
+                      'pid': os.getpid(), 'jobs': run_job.count})
+        return reply
+
+    kwargs = dict(defaults or dict())
+    kwargs.update(job)
+    kwargs['retain'] = 'results'                                                # Signals are not returned
+    if kwargs.get('windows') is not None:
+        kwargs['windows'] = [tuple(window) for window in kwargs['windows']]
+    start = time.perf_counter()
+    try:
+        result = workflow.workflow_patient(**kwargs)
+    except Exception as error:                                                  # Invalid job, errors of the analysis are failures
+        reply['error'] = repr(error)
+        return reply
+    run_job.count += 1
+    for key in ('patient', 'hrv', 'failures', 'cached', 'lead',
+                'lead_quality', 'gated'):
+        reply[key] = result[key]
+    reply['seconds'] = time.perf_counter() - start
+    return reply
+
+run_job.count = 0                                                               # Number of jobs processed by this worker
+
+def _dumps(reply):
+    # One line of JSON, numpy values as JSON types
+    return json.dumps(reply, default=cache._to_json)
+
+#%% Socket
+class _JobHandler(socketserver.StreamRequestHandler):
+    # One JSON job per line, one JSON reply per line
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                reply = run_job(json.loads(line), self.server.defaults)
+            except ValueError as error:                                         # Not a JSON object
+                reply = {'id': None, 'error': repr(error)}
+            self.wfile.write((_dumps(reply) + '\n').encode())
+            self.wfile.flush()
+            if reply.get('status') == 'stopped':
+                self.server.stopped = True
+                return
+
+def serve_socket(address=('127.0.0.1', 8765), defaults=None, warm=True):
+    """
+    Function that accepts jobs on a local TCP socket until a stop command.
+    A client may send several jobs over one connection.
+
+    INPUT:
+        address: (host, port) tuple, port 0 chooses a free port
+        defaults: dictionary with default arguments of the jobs
+        warm: if True, the libraries are imported before the first job
+    """
+    if warm:
+        preload()
+    server = socketserver.TCPServer(address, _JobHandler)
+    server.defaults = defaults
+    server.stopped = False
+    try:
+        print('HRV worker listening on %s:%i' % server.server_address,
+              flush=True)
+        while not server.stopped:
+            server.handle_request()
+    finally:
+        server.server_close()
+
+def request(address, job, timeout=None):
+    """
+    Function that sends one job to a worker (serve_socket) and returns its
+    reply.
+
+    INPUT:
+        address: (host, port) tuple of the worker
+        job: dictionary, see run_job
+        timeout: maximum time to wait for the reply [s] (default: None, no
+                 limit)
+
+    OUTPUT:
+        reply: dictionary, see run_job
+    """
+    with socket.create_connection(address, timeout=timeout) as connection:
+        connection.sendall((_dumps(job) + '\n').encode())
+        with connection.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError('The worker closed the connection.')
+    return json.loads(line)
+
+#%% Spool directory
+def _spool(spool_dir, folder, name=''):
+    return os.path.join(spool_dir, folder, name)
+
+def _write_json(fname, content):
+    # Write under a temporary name and rename, readers never see part of it
+    tmp = os.path.join(os.path.dirname(fname),
+                       '.%s.%i.tmp' % (os.path.basename(fname), os.getpid()))
+    with open(tmp, 'w') as f:
+        f.write(_dumps(content))
+    os.replace(tmp, fname)
+
+def submit(spool_dir, job):
+    """
+    Function that submits a job to the spool directory of a worker.
+
+    INPUT:
+        spool_dir: spool directory, see serve_spool
+        job: dictionary, see run_job; without 'id' a unique ID is added
+
+    OUTPUT:
+        job_id: ID of the job, see result
+    """
+    job = dict(job)
+    job['id'] = job.get('id') or uuid.uuid4().hex
+    os.makedirs(_spool(spool_dir, 'in'), exist_ok=True)
+    _write_json(_spool(spool_dir, 'in', job['id'] + '.json'), job)
+    return job['id']
+
+def result(spool_dir, job_id, timeout=None, poll=0.01):
+    """
+    Function that waits for the result of a submitted job and removes it
+    from the spool directory.
+
+    INPUT:
+        spool_dir: spool directory, see serve_spool
+        job_id: ID of the job, as returned by submit
+        timeout: maximum time to wait [s] (default: None, no limit)
+        poll: interval between checks [s]
+
+    OUTPUT:
+        reply: dictionary, see run_job
+    """
+    fname = _spool(spool_dir, 'out', job_id + '.json')
+    start = time.perf_counter()
+    while not os.path.exists(fname):
+        if timeout is not None and time.perf_counter() - start > timeout:
+            raise TimeoutError('No result of job %s after %g s.'
+                               % (job_id, timeout))
+        time.sleep(poll)
+    with open(fname) as f:
+        reply = json.load(f)
+    os.remove(fname)
+    return reply
+
+def serve_spool(spool_dir, defaults=None, warm=True, poll=0.05):
+    """
+    Function that processes the jobs in the spool directory, in order of
+    submission, until a stop command. A job is claimed by renaming it from
+    in/ to work/, so every job is processed by one worker only.
+
+    INPUT:
+        spool_dir: spool directory, created if it does not exist
+        defaults: dictionary with default arguments of the jobs
+        warm: if True, the libraries are imported before the first job
+        poll: interval between checks for new jobs [s]
+    """
+    for folder in ('in', 'work', 'out'):
+        os.makedirs(_spool(spool_dir, folder), exist_ok=True)
+    if warm:
+        preload()
+    print('HRV worker watching %s' % spool_dir, flush=True)
+    while True:
+        names = [name for name in os.listdir(_spool(spool_dir, 'in'))
+                 if name.endswith('.json') and not name.startswith('.')]
+        names.sort(key=lambda name: _mtime(_spool(spool_dir, 'in', name)))      # Oldest job first
+        if not names:
+            time.sleep(poll)
+            continue
+        for name in names:
+            claimed = _spool(spool_dir, 'work', name)
+            try:
+                os.rename(_spool(spool_dir, 'in', name), claimed)
+            except FileNotFoundError:                                           # Claimed by another worker
+                continue
+            try:
+                with open(claimed) as f:
+                    reply = run_job(json.load(f), defaults)
+            except ValueError as error:                                         # Not JSON
+                reply = {'id': None, 'error': repr(error)}
+            if reply['id'] is None:
+                reply['id'] = name[:-5]                                         # ID of the result file
+            _write_json(_spool(spool_dir, 'out', name), reply)
+            os.remove(claimed)
+            if reply.get('status') == 'stopped':
+                return
+
+def _mtime(fname):
+    # Modification time, or inf for a file that was claimed meanwhile
+    try:
+        return os.path.getmtime(fname)
+    except FileNotFoundError:
+        return float('inf')
+
+#%% Command line
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Long-running HRV worker.')
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--socket', metavar='HOST:PORT',
+                      help='accept jobs on a local TCP socket')
+    mode.add_argument('--spool', metavar='DIR',
+                      help='process jobs in a spool directory')
+    parser.add_argument('--store', help='default record store of the jobs')
+    parser.add_argument('--offline', action='store_true',
+                        help='only read records from the record store')
+    parser.add_argument('--cache-dir', help='default result cache of the jobs')
+    args = parser.parse_args()
+
+    defaults = {key: value for key, value in (('store', args.store),
+                                              ('offline', args.offline),
+                                              ('cache_dir', args.cache_dir))
+                if value}
+    if args.socket is not None:
+        host, port = args.socket.rsplit(':', 1)
+        serve_socket((host, int(port)), defaults)
+    else:
+        serve_spool(args.spool, defaults)
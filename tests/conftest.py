@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Configuration of the tests, run from the main folder with:
+    python -m pytest tests
+The HRV modules are imported from the main folder, the tests use small
+synthetic records of HRV_synthetic.py.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests batchmode
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of workflow_batch (HRV_batchmode.py) on a synthetic record store.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import HRV_batchmode as workflow
+import HRV_recordstore as recstore
+import HRV_synthetic as synth
+
+DURATION = 600
+KWARGS = {'offline': True, 'engine': 'fast',
+          'parameters': ['rmssd', 'sdnn', 'sampen']}
+
+@pytest.fixture(scope='module')
+def cohort(tmp_path_factory):
+    # Synthetic store with 3 patients, patient IDs in reverse order
+    directory = tmp_path_factory.mktemp('batchmode')
+    store = str(directory / 'store')
+    with open(synth.synthetic_store(store, 3, DURATION)) as f:
+        lines = [line.strip() for line in f if line.strip()][::-1]
+    patient_ids = str(directory / 'ids.txt')
+    with open(patient_ids, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return patient_ids, store, lines
+
+def _batch(cohort, **kwargs):
+    patient_ids, store = cohort[:2]
+    return workflow.workflow_batch(patient_ids, 125, 'II', 0, DURATION, store,
+                                   return_failures=True,
+                                   **dict(KWARGS, **kwargs))
+
+def test_window_order(tmp_path, cohort):
+    lines = cohort[2]
+    output = _batch(cohort, window=300)
+    export_all = output[5]
+    assert export_all.patientID.tolist() == [line for line in sorted(lines)
+                                             for _ in range(2)]
+    assert export_all['time [min]'].tolist() == [0, 5]*3
+
+    # Signals in the order of the file, as without windows (the patients
+    # have different NNI)
+    single = _batch(cohort)
+    for windowed, whole in zip(output[3], single[3]):
+        np.testing.assert_array_equal(windowed, whole)
+    assert len(output[3]) == len(single[3]) == 3
+
+    path = str(tmp_path / 'per5min.csv')
+    _batch(cohort, window=300, export_path=path, chunk_rows=1)
+    written = pd.read_csv(path, index_col=0)
+    assert written.patientID.tolist() == export_all.patientID.tolist()
+
+@pytest.mark.parametrize('retain', ['results', 'disk'])
+def test_retain(tmp_path, cohort, retain):
+    reference = _batch(cohort, window=300)
+    output = _batch(cohort, window=300, retain=retain,
+                    spill_dir=str(tmp_path / 'spill'))
+    pd.testing.assert_frame_equal(output[5], reference[5])
+    assert output[6].empty
+    if retain == 'results':
+        assert all(len(signals) == 0 for signals in output[:5])
+        return
+
+    for spilled, kept in zip(output[:5], reference[:5]):
+        assert len(spilled) == len(kept) == 3
+    for spilled, kept in zip(output[0], reference[0]):
+        loaded = spilled.load()                                                 # SpilledDataFrame
+        assert loaded.index.equals(kept.index)
+        np.testing.assert_array_equal(loaded.Time, kept.Time)
+        np.testing.assert_array_equal(loaded.ecg_filtered,
+                                      kept.ecg_filtered.astype(np.float32))
+    for spilled, kept in zip(sum(output[1:5], []), sum(reference[1:5], [])):
+        assert isinstance(spilled, recstore.SpilledArray)
+        np.testing.assert_array_equal(np.asarray(spilled), kept)
+
+def test_windows(cohort):
+    patient_ids, store, lines = cohort
+    export_all = _batch(cohort, window=300, step=150)[5]                        # Overlapping windows, from one load
+    assert export_all['time [min]'].tolist() == [0, 2.5, 5]*3
+    for patient_id in lines:
+        rows = export_all.loc[[patient_id]].to_dict('records')
+        for row, start in zip(rows, (0, 150, 300)):
+            single = workflow.workflow_patient(patient_id, 125, 'II', 0,        # Same span, one window
+                                               DURATION, store,
+                                               windows=[(start, start + 300)],
+                                               **KWARGS)
+            assert row == single['hrv'][0]
+
+@pytest.mark.parametrize('kwargs', [{}, {'window': 300}, {'prefetch': 2}])
+def test_parallel(cohort, kwargs):
+    serial = _batch(cohort, **kwargs)
+    parallel = _batch(cohort, n_workers=2, chunksize=1, **kwargs)
+    pd.testing.assert_frame_equal(parallel[5], serial[5])
+    if 'window' not in kwargs:
+        assert parallel[5].index.tolist() == cohort[2]                          # Order of the file
+    for signals, expected in zip(parallel[1:5], serial[1:5]):
+        assert len(signals) == len(expected) == 3
+        for array, expected_array in zip(signals, expected):
+            np.testing.assert_array_equal(array, expected_array)
+    assert parallel[6].empty and serial[6].empty
+
+def _failing(function, n):
+    # Function that raises on its n-th call
+    calls = [0]
+
+    def failing(*args, **kwargs):
+        calls[0] += 1
+        if calls[0] == n:
+            raise RuntimeError('Failure of call %i' % n)
+        return function(*args, **kwargs)
+    return failing
+
+@pytest.mark.parametrize('stage, module, name, window', [
+    ('rpeak', workflow.preproc, 'ecg_rpeak', None),
+    ('hrv', workflow.hrvcalc, 'hrv_parameters', 0)])
+def test_failure(cohort, monkeypatch, stage, module, name, window):
+    reference = _batch(cohort, window=300)[5]
+    monkeypatch.setattr(module, name, _failing(getattr(module, name), 3))
+    output = _batch(cohort, window=300)                                         # Serial: 3rd call of the patients in file order
+    failures = output[6]
+    patient_id = cohort[2][2 if stage == 'rpeak' else 1]
+    assert failures[['patient', 'stage']].values.tolist() == [[patient_id,
+                                                               stage]]
+    assert failures.window.iloc[0] == window or \
+        (window is None and pd.isna(failures.window.iloc[0]))
+    assert failures.error.iloc[0] == "RuntimeError('Failure of call 3')"
+    failed = (reference.patientID == patient_id) & \
+        (window is None or reference['time [min]'] == window/60)
+    expected = reference[~failed]
+    pd.testing.assert_frame_equal(output[5].reset_index(drop=True),             # Other patients and windows unaffected
+                                  expected.reset_index(drop=True))
+
+def test_parallel_failure(tmp_path, cohort):
+    patient_ids, store, lines = cohort
+    fname = str(tmp_path / 'ids.txt')
+    with open(fname, 'w') as f:
+        f.write('\n'.join(lines[:1] + ['30/3999999'] + lines[1:]) + '\n')
+    output = _batch((fname, store), n_workers=2, chunksize=1)
+    failures = output[6]
+    assert failures[['patient', 'stage']].values.tolist() == [['30/3999999',
+                                                               'load']]
+    assert failures.error.iloc[0].startswith('FileNotFoundError')
+    pd.testing.assert_frame_equal(output[5], _batch(cohort)[5])                 # Other patients unaffected
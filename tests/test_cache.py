@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests cache
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of the persistent cache of HRV results (HRV_cache.py): a rerun reads
+the cached windows without computing them, the key changes with the
+analysis configuration, and evict removes old and least recently used
+entries.
+"""
+import os
+import time
+
+import pytest
+
+import HRV_batchmode as workflow
+import HRV_cache as cache
+import HRV_synthetic as synth
+
+DURATION = 600
+KWARGS = {'sampfreq': 125, 'lead': 'II', 'starttime': 0, 'endtime': DURATION,
+          'offline': True, 'engine': 'fast', 'parameters': ['rmssd', 'sdnn'],
+          'windows': [(0, 300), (300, 600)]}
+
+@pytest.fixture
+def patient(tmp_path):
+    store = str(tmp_path / 'store')
+    with open(synth.synthetic_store(store, 1, DURATION)) as f:
+        return f.readline().strip(), store
+
+def test_rerun(tmp_path, patient, monkeypatch):
+    patient_id, store = patient
+    cache_dir = str(tmp_path / 'cache')
+    first = workflow.workflow_patient(patient_id, store=store,
+                                      cache_dir=cache_dir, **KWARGS)
+    assert first['cached'] == 0 and len(first['hrv']) == 2
+    assert cache.cache_info(cache_dir)['entries'] == 2
+
+    def fail(*args, **kwargs):
+        raise AssertionError('Cached windows are computed again.')
+
+    monkeypatch.setattr(workflow.preproc, 'load_data', fail)
+    second = workflow.workflow_patient(patient_id, store=store,
+                                       cache_dir=cache_dir, **KWARGS)
+    assert second['cached'] == 2 and not second['failures']
+    assert second['hrv'] == first['hrv']
+    assert second['r_peaks'] is None                                            # Not loaded
+
+    third = workflow.workflow_patient(patient_id, store=store,                  # Changed selection: computed again
+                                      cache_dir=cache_dir,
+                                      **dict(KWARGS, parameters=['rmssd']))
+    assert third['cached'] == 0
+    assert [failure['stage'] for failure in third['failures']] == ['load']
+
+@pytest.mark.parametrize('changes', [{'engine': 'pyhrv'},
+                                     {'parameters': ['rmssd']},
+                                     {'stream': (60, 10)},
+                                     {'lead_mode': 'fusion'}, {'gate': True},
+                                     {'gate': {'beats': 10}}])
+def test_key(changes):
+    reference = {'engine': 'fast', 'parameters': ['rmssd', 'sdnn']}
+    key = cache.cache_key('30/3000001', 'II', 125, (0, 600), (0, 300),
+                          cache.analysis_config(**reference))
+    changed = cache.cache_key('30/3000001', 'II', 125, (0, 600), (0, 300),
+                              cache.analysis_config(**dict(reference,
+                                                           **changes)))
+    assert changed != key
+
+def test_same_key():
+    keys = {cache.cache_key('30/3000001', 'II', 125, (0, 600), (0, 300),
+                            cache.analysis_config(**config))
+            for config in ({'parameters': ['sdnn', 'rmssd']},
+                           {'parameters': ['rmssd', 'sdnn'], 'gate': False})}
+    assert len(keys) == 1                                                       # Order of names, no gate
+    keys = {cache.cache_key('30/3000001', 'II', 125, (0, 600), (0, 300),
+                            cache.analysis_config(gate=gate))
+            for gate in (True, {}, dict(cache.analysis_config(gate=True)
+                                        ['gate']))}
+    assert len(keys) == 1                                                       # Default thresholds
+    assert {'HRV_batchmode', 'HRV_sliding'} <= set(cache.ANALYSIS_MODULES)
+
+def test_evict(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    now = time.time()
+    for i in range(6):
+        key = '%02i' % i + 'a'*62
+        cache.write_entry(cache_dir, key, {'rmssd': float(i)})
+        fname = os.path.join(cache_dir, key[:2], key + '.json')
+        os.utime(fname, (now - 1000*(6 - i), now - 1000*(6 - i)))               # Entry 0 is the oldest
+    assert cache.read_entry(cache_dir, '00' + 'a'*62) == {'rmssd': 0.}          # Read: most recently used
+    assert cache.evict(cache_dir, max_age=2500) == 3                            # Entries 1, 2 and 3
+    assert cache.read_entry(cache_dir, '01' + 'a'*62) is None
+    size = cache.cache_info(cache_dir)['size']
+    assert cache.evict(cache_dir, max_size=size - 1) == 1                       # Least recently used: entry 4
+    assert [cache.read_entry(cache_dir, '%02i' % i + 'a'*62) is not None
+            for i in (0, 4, 5)] == [True, False, True]
+    assert cache.evict(cache_dir) == 0
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests ectopic
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of the ectopic beat and outlier removal: the vectorized mode of
+ecg_ectopic_removal gives the same output as the reference mode.
+"""
+import numpy as np
+import pytest
+
+import HRV_preprocessing as preproc
+from HRV_synthetic import synthetic_nni
+
+def _assert_modes_equal(r_peaks, nni):
+    vectorized = preproc.ecg_ectopic_removal(r_peaks, nni)
+    reference = preproc.ecg_ectopic_removal(r_peaks, nni, mode='reference')
+    np.testing.assert_array_equal(vectorized[0], reference[0])
+    np.testing.assert_array_equal(vectorized[1], reference[1])
+    return vectorized
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('ectopic_rate', [0, 0.02, 0.2])
+def test_modes(seed, ectopic_rate):
+    r_peaks, nni = synthetic_nni(3000, ectopic_rate, seed)
+    rrn, nni_true = _assert_modes_equal(r_peaks, nni)
+    assert len(rrn) == len(nni_true)
+    assert np.all((nni_true >= 300) & (nni_true <= 6000))
+
+@pytest.mark.parametrize('n_beats', [1, 2, 5, 12, 13, 14])
+def test_short_series(n_beats):
+    _assert_modes_equal(*synthetic_nni(n_beats, 0.2, seed=1))
+
+def test_thresholds(monkeypatch):
+    r_peaks, nni = synthetic_nni(3000, 0.05, seed=2)
+    default = _assert_modes_equal(r_peaks, nni)
+    monkeypatch.setitem(preproc.ECTOPIC_THRESHOLDS, 'short', 0.6)
+    monkeypatch.setitem(preproc.ECTOPIC_THRESHOLDS, 'low', 0.9)
+    monkeypatch.setitem(preproc.ECTOPIC_THRESHOLDS, 'nni_max', 1000)
+    changed = _assert_modes_equal(r_peaks, nni)
+    assert not np.array_equal(default[1], changed[1])
+
+def test_mode():
+    with pytest.raises(ValueError):
+        preproc.ecg_ectopic_removal(*synthetic_nni(100), mode='loop')
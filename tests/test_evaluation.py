@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests evaluation
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of the histograms of HRV parameters (HRV_evaluation.py): without
+fixed edges, the values are counted exactly between their minimum and
+maximum, and without out_dir the figures are shown interactively.
+"""
+import os
+
+import matplotlib
+matplotlib.use('Agg')                                                           # No display in the tests
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import pytest
+
+import HRV_evaluation as viseval
+import HRV_summary as hrvsum
+from HRV_synthetic import synthetic_ecg
+
+SAMPFREQ = 125
+
+def test_minmax_decimate():
+    rng = np.random.default_rng(0)
+    x = np.sort(rng.uniform(0, 100, 10000))                                     # Unevenly spaced
+    y = rng.normal(0, 1, len(x))
+    y[rng.integers(0, len(y), 100)] = np.nan
+    x_dec, y_dec = viseval.minmax_decimate(x, y, 300)
+    assert len(y_dec) <= 2*300
+    assert np.nanmin(y) == y_dec.min() and np.nanmax(y) == y_dec.max()
+    starts = np.searchsorted(x, x_dec[::2])
+    for start, stop, y_min, y_max in zip(starts, list(starts[1:]) + [len(x)],
+                                         y_dec[::2], y_dec[1::2]):
+        assert y_min == np.nanmin(y[start:stop])                                # Minimum and maximum of every column
+        assert y_max == np.nanmax(y[start:stop])
+    x_dec, y_dec = viseval.minmax_decimate(x[:500], y[:500], 300)               # Short lines are not decimated
+    np.testing.assert_array_equal(y_dec, y[:500])
+
+@pytest.fixture(scope='module')
+def batch():
+    batch_df, batch_rpeaks, batch_nni = list(), list(), list()
+    for seed in range(3):
+        signal, r_peaks = synthetic_ecg(120, SAMPFREQ, ectopic_rate=0.02,
+                                        seed=seed)
+        batch_df.append(pd.DataFrame({'Time': np.arange(len(signal)) /
+                                      SAMPFREQ, 'ecg_signal': signal}))
+        batch_rpeaks.append(r_peaks / SAMPFREQ)
+        batch_nni.append(np.diff(r_peaks) / SAMPFREQ * 1000)
+    labels = ['30/300000%i' % i for i in range(3)]
+    return batch_df, batch_rpeaks, batch_nni, labels
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_qc_batch(tmp_path, batch, n_workers):
+    batch_df, batch_rpeaks, batch_nni, labels = batch
+    qc_dir = str(tmp_path / 'qc')
+    files = viseval.visual_evaluation_rpeaks(batch_df, batch_rpeaks, qc_dir,
+                                             labels, n_workers=n_workers)
+    assert files == [os.path.join(qc_dir, '30_300000%i_rpeaks.png' % i)
+                     for i in range(3)]                                         # One image per patient, in order
+    files += viseval.visual_evaluation_nni(batch_nni, batch_rpeaks,
+                                           batch_nni, batch_rpeaks, qc_dir,
+                                           labels, [(0, 60), (60, 120)],
+                                           n_workers)
+    assert files[3:] == [os.path.join(qc_dir, '30_300000%i_nni_%is.png'
+                                      % (i, start))
+                         for i in range(3) for start in (0, 60)]
+    assert sorted(os.listdir(qc_dir)) == sorted(os.path.basename(fname)
+                                                for fname in files)
+    assert all(os.path.getsize(fname) > 0 for fname in files)
+    assert plt.get_fignums() == []
+
+@pytest.fixture
+def export(tmp_path):
+    rng = np.random.default_rng(0)
+    table = pd.DataFrame({'rmssd': rng.lognormal(3, 1, 3000),
+                          'sdnn': rng.normal(50, 10, 3000)})
+    table.insert(0, 'time [min]', np.arange(len(table)) % 1440)
+    path = str(tmp_path / 'export.csv')
+    table.to_csv(path)
+    return path
+
+def test_histogram(tmp_path, export, monkeypatch):
+    histograms = dict()
+    histogram = hrvsum.StreamingSummary.histogram
+
+    def record(self, column, bins=20):
+        histograms[column] = histogram(self, column, bins)
+        return histograms[column]
+
+    monkeypatch.setattr(hrvsum.StreamingSummary, 'histogram', record)
+    result = viseval.hrv_distribution(export, chunk_rows=700,
+                                      out_dir=str(tmp_path))
+    table = pd.read_csv(export, index_col=0)                                    # As parsed by hrv_distribution
+    for col in ('rmssd', 'sdnn'):
+        counts, bins = np.histogram(table[col], bins=20)
+        np.testing.assert_array_equal(histograms[col][0], counts)
+        np.testing.assert_array_equal(histograms[col][1], bins)
+        assert os.path.isfile(os.path.join(str(tmp_path), col + '.png'))
+    assert list(result.index) == ['rmssd', 'sdnn']
+    assert plt.get_fignums() == []                                              # Saved without pyplot
+
+    edges = {'rmssd': [0, 10, 100]}                                             # Fixed edges: values outside left out
+    viseval.hrv_distribution(export, edges=edges, out_dir=str(tmp_path))
+    np.testing.assert_array_equal(histograms['rmssd'][0],
+                                  np.histogram(table.rmssd,
+                                               edges['rmssd'])[0])
+
+def test_interactive(tmp_path, export, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    plt.close('all')
+    viseval.hrv_distribution(export)
+    try:
+        assert len(plt.get_fignums()) == 2
+        assert sorted(os.listdir(str(tmp_path))) == ['export.csv',
+                                                     'rmssd.png', 'sdnn.png']
+    finally:
+        plt.close('all')
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests export
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of the columnar ResultsAccumulator (HRV_export.py): the accumulated
+rows equal the rows that were appended, in memory and written in chunks.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import HRV_export as export
+
+@pytest.fixture
+def rows():
+    rng = np.random.default_rng(0)
+    values = rng.random((250, 12))
+    keys = ['parameter_%i' % i for i in range(values.shape[1])]
+    return values, [dict(zip(keys, row)) for row in values]
+
+def test_values(rows):
+    values, batch = rows
+    accumulator = export.ResultsAccumulator(capacity=16)                        # Grows while rows are appended
+    accumulator.extend(batch)
+    np.testing.assert_array_equal(accumulator.to_dataframe().values, values)
+    assert len(accumulator) == len(values)
+
+@pytest.mark.parametrize('chunk_rows', [1, 64, 1000])
+def test_chunks(tmp_path, rows, chunk_rows):
+    values, batch = rows
+    path = str(tmp_path / 'export.csv')
+    accumulator = export.ResultsAccumulator(path, chunk_rows)
+    accumulator.extend(batch, index=['p%03i' % (i // 10)
+                                     for i in range(len(batch))])
+    accumulator.close()
+    written = pd.read_csv(path, index_col=0, float_precision='round_trip')
+    np.testing.assert_array_equal(written.values, values)
+    assert list(written.index) == ['p%03i' % (i // 10)
+                                   for i in range(len(batch))]
+
+def test_types():
+    accumulator = export.ResultsAccumulator()
+    accumulator.append({'nn50': 3, 'rmssd': 20.5, 'patientID': 'a'})
+    accumulator.append({'nn50': 4.5, 'patientID': 'b'})                         # Integer column to float, missing field
+    table = accumulator.to_dataframe()
+    assert table.nn50.tolist() == [3, 4.5]
+    assert np.isnan(table.rmssd.iloc[1])
+    assert table.patientID.tolist() == ['a', 'b']
+    with pytest.raises(ValueError):
+        accumulator.append({'sdnn': 1.})
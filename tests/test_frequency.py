@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests frequency
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of the batched frequency domain analysis (HRV_frequency.py): the 
+Welch PSD equals pyhrv.frequency_domain.welch_psd of hrv_results, and the 
+Lomb-Scargle periodogram gives the band powers of a series with known 
+spectral content.
+"""
+import warnings
+
+import numpy as np
+import pytest
+
+import HRV_calculations as hrvcalc
+import HRV_frequency as freq
+import HRV_preprocessing as preproc
+from HRV_synthetic import synthetic_nni
+
+@pytest.fixture(scope='module')
+def series():
+    # NNI of about 4, 5, 20 and 60 minutes with ectopic beats removed
+    series = list()
+    for seed, n_beats in enumerate((300, 370, 1500, 4500)):
+        r_peaks, nni = synthetic_nni(n_beats, seed=seed)
+        series.append(preproc.ecg_ectopic_removal(r_peaks, nni)[1])
+    return series
+
+@pytest.fixture(scope='module')
+def sines():
+    # NNI with sines of 0.02 (VLF), 0.1 (LF) and 0.25 Hz (HF): band powers
+    # of half the squared amplitudes, 50, 450 and 200 ms^2
+    t = np.arange(3000) * 0.8
+    return 800 + 10*np.sin(2*np.pi*0.02*t) + 30*np.sin(2*np.pi*0.1*t) + \
+        20*np.sin(2*np.pi*0.25*t)
+
+def test_welch(series):
+    import pyhrv.frequency_domain as fd
+
+    parameters = freq.welch_psd_batch(series, max_segments=7)                   # Several FFT calls
+    assert parameters.shape == (len(series), len(hrvcalc.FD_PARAMETERS))
+    for i, nni in enumerate(series):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            psd = fd.welch_psd(nni=nni, fbands=hrvcalc.FBANDS, show=False,
+                               mode='dev')[0]
+        reference = np.hstack((psd['fft_abs'], psd['fft_rel'], 
+                               psd['fft_log'], psd['fft_norm'],
+                               psd['fft_ratio'], psd['fft_total']))
+        np.testing.assert_allclose(parameters[i], reference, rtol=1e-9)
+
+def test_lomb_sines(sines):
+    parameters = dict(zip(hrvcalc.FD_PARAMETERS,
+                          freq.lomb_psd_batch([sines])[0]))
+    assert parameters['abs_ulf'] < 1
+    assert parameters['abs_vlf'] == pytest.approx(50, rel=0.02)
+    assert parameters['abs_lf'] == pytest.approx(450, rel=0.02)
+    assert parameters['abs_hf'] == pytest.approx(200, rel=0.02)
+    assert parameters['total_power'] == pytest.approx(np.var(sines), 
+                                                      rel=0.02)
+
+def test_lomb(series):
+    parameters = freq.frequency_domain_batch(series, 'lomb')
+    welch = freq.frequency_domain_batch(series, 'welch')
+    total = hrvcalc.FD_PARAMETERS.index('total_power')
+    np.testing.assert_allclose(parameters[:, total], welch[:, total], 
+                               rtol=0.2)                                        # Different estimators of the same spectrum
+    np.testing.assert_allclose(freq.lomb_psd_batch(series, max_elements=1000),
+                               parameters, rtol=1e-12)                          # Blocks of frequencies
+    assert freq.lomb_psd_batch(series, nfft=2**8).shape == parameters.shape
+
+def test_method(series):
+    with pytest.raises(ValueError):
+        freq.frequency_domain_batch(series, 'fft')
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests gate
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of the quality gate (HRV_preprocessing.py): reason codes of the signal
+gate and the beat gate, the thresholds, and the gate summary of
+workflow_batch.
+"""
+import numpy as np
+import pytest
+
+import HRV_batchmode as workflow
+import HRV_preprocessing as preproc
+import HRV_synthetic as synth
+
+SAMPFREQ = 125
+THRESHOLDS = preproc.gate_thresholds(True)
+
+@pytest.fixture(scope='module')
+def signal():
+    # Four windows of 60 s: clean, flat, clipped and missing
+    signal, _ = synth.synthetic_ecg(240, SAMPFREQ, seed=5)
+    signal[70*SAMPFREQ:73*SAMPFREQ] = 0.1                                       # Disconnected lead for 3 s
+    clipped = signal[120*SAMPFREQ:180*SAMPFREQ]
+    signal[120*SAMPFREQ:180*SAMPFREQ] = np.clip(
+        clipped, *np.quantile(clipped, [0.05, 0.95]))                           # Amplitude saturation
+    signal[180*SAMPFREQ:220*SAMPFREQ] = np.nan
+    return signal
+
+def test_signal_gate(signal):
+    bounds = [(i*60*SAMPFREQ, (i + 1)*60*SAMPFREQ) for i in range(4)]
+    reasons = preproc.signal_gate(signal, SAMPFREQ, bounds, THRESHOLDS)
+    assert reasons[0] is None
+    assert [reason[0] for reason in reasons[1:]] == ['flatline', 'saturation',
+                                                     'missing']
+    reasons = preproc.signal_gate(signal, SAMPFREQ, bounds, 
+                                  dict(THRESHOLDS, flatline=5, missing=0.8))
+    assert reasons[1] is None and reasons[3] is None                            # Within the changed thresholds
+
+def test_beat_gate():
+    nni = np.full(75, 800.)
+    assert preproc.beat_gate(nni, nni, 60, THRESHOLDS) is None
+    assert preproc.beat_gate(nni[:20], nni[:20], 16, THRESHOLDS)[0] == 'beats'
+    assert preproc.beat_gate(nni, nni, 120, THRESHOLDS)[0] == 'coverage'
+    assert preproc.beat_gate(nni / 4, nni / 4, 15, THRESHOLDS)[0] == \
+        'heart_rate'
+    assert preproc.beat_gate(nni, np.full(150, 400.), 60, THRESHOLDS)[0] == \
+        'ectopic'
+
+def test_gate_thresholds():
+    assert preproc.gate_thresholds(None) is None
+    assert preproc.gate_thresholds(False) is None
+    assert preproc.gate_thresholds(True) == preproc.GATE_THRESHOLDS
+    assert preproc.gate_thresholds({}) == preproc.GATE_THRESHOLDS
+    assert preproc.gate_thresholds({'beats': 10})['beats'] == 10
+    with pytest.raises(ValueError):
+        preproc.gate_thresholds({'beat': 10})
+
+def test_workflow_batch(tmp_path, capsys):
+    store = str(tmp_path / 'store')
+    patient_ids = synth.synthetic_store(store, 2, 600, gaps=((0, 250), ))
+    output = workflow.workflow_batch(patient_ids, SAMPFREQ, 'II', 0, 600, 
+                                     store, offline=True, window=300, 
+                                     engine='fast', parameters=['rmssd'],
+                                     gate={}, return_failures=True)
+    failures = output[6]
+    assert failures.reason.tolist() == ['missing']*2
+    assert failures.window.tolist() == [0, 0]
+    assert len(output[5]) == 2                                                  # Second window of both patients
+    assert 'Quality gate: 2 windows skipped (missing: 2)' in \
+        capsys.readouterr().out
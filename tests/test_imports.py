@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests imports
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of the import of the HRV modules in a new Python process: the
+libraries of the compute path and of plotting are imported by the functions
+that use them, so that a batch, a worker or a queue node starts quickly.
+"""
+import json
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+
+FORBIDDEN = ('matplotlib', 'pyhrv', 'biosppy', 'wfdb')
+MAX_SECONDS = 1.5                                                               # Import of pyhrv alone takes seconds
+CODE = ('import json, sys, time; start = time.perf_counter(); import %s; '
+        'print(json.dumps([time.perf_counter() - start, '
+        '[name for name in %r if name in sys.modules]]))')
+
+def _import(module):
+    # Import time [s] and forbidden libraries loaded by a new process
+    output = subprocess.run([sys.executable, '-c', CODE % (module, FORBIDDEN)],
+                            capture_output=True, text=True, check=True,
+                            cwd=ROOT).stdout
+    return json.loads(output.splitlines()[-1])
+
+@pytest.mark.parametrize('module', ['HRV_batchmode', 'HRV_worker',
+                                    'HRV_queue', 'HRV_frequency'])
+def test_import(module):
+    seconds, loaded = _import(module)
+    assert loaded == []
+    if seconds > MAX_SECONDS:
+        seconds = min(seconds, *(_import(module)[0] for _ in range(2)))         # Best of three, a busy machine is not a regression
+    assert seconds < MAX_SECONDS
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests leads
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of multi-lead analysis (HRV_preprocessing.py): the quality score and
+selection of the best lead, the fusion of R-peaks of several leads, and the
+analysis of a record without some of the requested leads.
+"""
+import numpy as np
+import pytest
+
+import HRV_batchmode as workflow
+import HRV_preprocessing as preproc
+import HRV_recordstore as recstore
+from HRV_synthetic import synthetic_ecg
+
+SAMPFREQ = 125
+DURATION = 300
+
+@pytest.fixture(scope='module')
+def leads():
+    signal, r_peaks = synthetic_ecg(DURATION, SAMPFREQ, seed=6)
+    noise = np.random.default_rng(6).normal(0, 0.3, len(signal))
+    shifted = np.concatenate((np.full(2, signal[0]), signal[:-2]))              # Same beats, 2 samples later
+    noisy = 0.8 * shifted + 0.5 * noise                                         # Lower quality than lead V
+    return {'II': noise, 'V': signal, 'I': noisy}, r_peaks
+
+@pytest.fixture(scope='module')
+def store(tmp_path_factory, leads):
+    store = str(tmp_path_factory.mktemp('leads') / 'store')
+    recstore.write_record(store, '30/3000001', leads[0], SAMPFREQ)
+    recstore.write_record(store, '30/3000002', {'V': leads[0]['V']}, SAMPFREQ)
+    return store
+
+def test_lead_quality(leads):
+    signals = leads[0]
+    assert preproc.lead_quality(signals['V'], SAMPFREQ) > 0.5
+    assert preproc.lead_quality(signals['II'], SAMPFREQ) < \
+        preproc.QUALITY['minimum']
+    assert preproc.lead_quality(np.full(1000, np.nan), SAMPFREQ) == 0
+    assert preproc.lead_quality(np.zeros(1000), SAMPFREQ) == 0
+
+@pytest.mark.parametrize('lead', [['II', 'V'], 'all'])
+def test_select(store, leads, lead):
+    result = workflow.workflow_patient('30/3000001', SAMPFREQ, lead, 0, 
+                                       DURATION, store, offline=True, 
+                                       engine='fast', parameters=['rmssd'])
+    assert result['lead'] == 'V'                                                # Lead II is noise
+    assert set(result['lead_quality']) == ({'II', 'V'} if lead != 'all' 
+                                           else {'II', 'V', 'I'})
+    single = workflow.workflow_patient('30/3000001', SAMPFREQ, 'V', 0, 
+                                       DURATION, store, offline=True, 
+                                       engine='fast', parameters=['rmssd'])
+    assert [row['rmssd'] for row in result['hrv']] == \
+        [row['rmssd'] for row in single['hrv']]
+    assert result['hrv'][0]['lead'] == 'V'
+
+def test_fuse_rpeaks():
+    beats = np.arange(100, 2000, 100)
+    peaks = [beats, beats + 2, np.append(beats - 3, 2050)]                      # Offsets between leads, a false detection in the third lead
+    fused = preproc.fuse_rpeaks(peaks, [0.9, 0.6, 0.5], 12)
+    np.testing.assert_array_equal(fused, beats)                                 # Location of the best lead
+    fused = preproc.fuse_rpeaks([beats[::2], beats, beats], [0.9, 0.6, 0.5],
+                                12)
+    np.testing.assert_array_equal(fused, beats)                                 # Beats missed by the best lead
+    assert len(preproc.fuse_rpeaks([np.array([], dtype=int)]*2, [1, 1], 
+                                   12)) == 0
+
+def test_ecg_rpeak_fusion(store, leads):
+    record = preproc.load_data('30/3000001', SAMPFREQ, 0, DURATION, 'all', 
+                               store, offline=True)
+    scores = preproc.lead_scores(record, SAMPFREQ)
+    ecg_df = preproc.ecg_dataframe(preproc.record_lead(record, 'V'), SAMPFREQ)
+    _, r_peaks, nni, fused = preproc.ecg_rpeak_fusion(ecg_df, record, scores, 
+                                                      SAMPFREQ)
+    assert fused == ['V', 'I']                                                  # Noise is not fused
+    reference = preproc.ecg_rpeak(ecg_df, SAMPFREQ)[1]
+    np.testing.assert_array_equal(r_peaks, reference)
+    assert len(nni) == len(r_peaks) - 1
+
+def test_missing_lead(store):
+    for lead_mode in ('select', 'fusion'):
+        result = workflow.workflow_patient('30/3000002', SAMPFREQ, 
+                                           ['II', 'V'], 0, DURATION, store, 
+                                           offline=True, engine='fast', 
+                                           parameters=['rmssd'], 
+                                           lead_mode=lead_mode)
+        assert result['lead'] == 'V'
+        assert list(result['lead_quality']) == ['V']
+        assert len(result['hrv']) == 1 and not result['failures']
+    result = workflow.workflow_patient('30/3000002', SAMPFREQ, 'II', 0, 
+                                       DURATION, store, offline=True, 
+                                       engine='fast')
+    assert [failure['stage'] for failure in result['failures']] == ['load']
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests nonlinear
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of the fast sample entropy and DFA (HRV_nonlinear.py) against 
+pyhrv.nonlinear, on NNI corrected for ectopic beats as in the workflow.
+"""
+import warnings
+
+import numpy as np
+import pytest
+
+import HRV_nonlinear as nonlin
+import HRV_preprocessing as preproc
+from HRV_synthetic import synthetic_nni
+
+DFA_TOLERANCE = 0.1                                                             # Least squares against RANSAC, 5 minutes of NNI
+
+@pytest.fixture(scope='module', params=[(370, 2), (370, 3), (1500, 0), 
+                                        (1500, 1), (5000, 0)])
+def nni(request):
+    n_beats, seed = request.param
+    r_peaks, nni = synthetic_nni(n_beats, seed=seed)
+    return preproc.ecg_ectopic_removal(r_peaks, nni)[1]
+
+def test_sample_entropy(nni):
+    import pyhrv.nonlinear
+
+    reference = pyhrv.nonlinear.sample_entropy(nni)['sampen']
+    assert nonlin.sample_entropy(nni)['sampen'] == pytest.approx(reference,
+                                                                 rel=1e-12)
+
+def test_dfa(nni):
+    import pyhrv.nonlinear
+    import matplotlib.pyplot as plt
+
+    np.random.seed(0)                                                           # RANSAC of nolds draws from the global generator
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        reference = pyhrv.nonlinear.dfa(nni, show=False, mode='dev')
+    plt.close('all')
+    result = nonlin.dfa(nni)
+    for key in ('dfa_alpha1', 'dfa_alpha2'):
+        assert abs(result[key] - reference[key]) <= DFA_TOLERANCE, key
+    if len(nni) > 1000:
+        for key in ('dfa_alpha1', 'dfa_alpha2'):
+            assert result[key] == pytest.approx(reference[key], abs=1e-3), key
+    assert list(result['dfa_alpha1_beats']) == list(range(4, 17))
+    assert list(result['dfa_alpha2_beats']) == list(range(17, 65))
+
+def test_short():
+    with pytest.warns(UserWarning):
+        result = nonlin.dfa(np.full(50, 800.))
+    assert np.isnan(result['dfa_alpha1']) and np.isnan(result['dfa_alpha2'])
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests parameters
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of the selective HRV parameters: hrv_parameters gives the same values
+as hrv_results, for all parameters and for a selection. The fast engine is
+used, as the DFA of pyhrv is not reproducible between runs.
+"""
+import warnings
+
+import numpy as np
+import pytest
+
+import HRV_calculations as hrvcalc
+import HRV_export as export
+import HRV_preprocessing as preproc
+from HRV_synthetic import synthetic_nni
+
+@pytest.fixture(scope='module', params=[370, 1500])
+def nni(request):
+    # NNI of about 5 and 20 minutes with ectopic beats removed
+    r_peaks, nni = synthetic_nni(request.param, seed=4)
+    return preproc.ecg_ectopic_removal(r_peaks, nni)[1]
+
+@pytest.fixture(scope='module')
+def reference(nni):
+    import pyhrv
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        results = hrvcalc.hrv_results(nni, 125, engine='fast')
+    return export.hrv_row(pyhrv.utils.join_tuples(*results))
+
+def _assert_equal(results, reference, names):
+    for name in names:
+        np.testing.assert_array_equal(np.asarray(results[name]),
+                                      np.asarray(reference[name]), name)
+
+def test_all(nni, reference):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        results = hrvcalc.hrv_parameters(nni, engine='fast')
+    assert set(results.keys()) >= set(reference)
+    _assert_equal(results, reference, reference)
+
+@pytest.mark.parametrize('parameters', [['rmssd', 'sdnn', 'ratio_lf_hf'],
+                                        ['sampen'], ['sd1', 'nni_mean'],
+                                        'pnn50'])
+def test_selection(nni, reference, parameters):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        results = hrvcalc.hrv_parameters(nni, parameters, engine='fast')
+    names = [parameters] if isinstance(parameters, str) else parameters
+    assert set(results.keys()) == set(names)
+    _assert_equal(results, reference, names)
+
+def test_unknown():
+    with pytest.raises(ValueError):
+        hrvcalc.parameter_plan(['rmssd', 'unknown'])
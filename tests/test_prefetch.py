@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests prefetch
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of prefetching records (HRV_prefetch.py): items are returned in
+order, and workflow_batch gives the same results with and without
+prefetching from a slow file server.
+"""
+import threading
+import time
+
+import pytest
+
+import HRV_batchmode as workflow
+import HRV_prefetch as prefetcher
+from HRV_synthetic import synthetic_ecg
+
+DURATION = 600
+
+def test_order():
+    lock = threading.Lock()
+    started = list()
+
+    def load(item):
+        with lock:
+            started.append(item)
+        time.sleep(0.01 * (item % 3))                                           # Loads finish out of order
+        if item == 5:
+            raise ValueError(item)
+        return item * 2
+
+    results = list()
+    for item, future in prefetcher.prefetch(load, range(8), depth=3):
+        assert len(started) <= item + 5                                         # Bounded read-ahead
+        try:
+            results.append((item, future.result()))
+        except ValueError:
+            results.append((item, None))
+    assert results == [(i, None if i == 5 else 2*i) for i in range(8)]
+
+@pytest.fixture
+def server(tmp_path):
+    directory = str(tmp_path / 'server')
+    lines = list()
+    for i in range(3):
+        patient_id = '30/30%05i' % i
+        signal, _ = synthetic_ecg(DURATION, 125, seed=i)
+        prefetcher.write_wfdb(directory, patient_id, {'II': signal}, 125)
+        lines.append(patient_id)
+    patient_ids = str(tmp_path / 'ids.txt')
+    with open(patient_ids, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return directory, patient_ids
+
+def test_workflow_batch(server):
+    directory, patient_ids = server
+    kwargs = {'window': 300, 'engine': 'fast', 'retain': 'results',
+              'parameters': ['rmssd', 'sdnn', 'sampen']}
+    with prefetcher.slow_server(directory, latency=0.02):
+        reference = workflow.workflow_batch(patient_ids, 125, 'II', 0,
+                                            DURATION, **kwargs)[5]
+        output = workflow.workflow_batch(patient_ids, 125, 'II', 0, DURATION,
+                                         prefetch=2, **kwargs)[5]
+    assert len(reference) == 6
+    assert output.equals(reference)
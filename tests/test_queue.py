@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests queue
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of the work queue (HRV_queue.py): several worker processes, of which
+one stops while it holds a lease, give the same results as workflow_batch
+on one node.
+"""
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+import HRV_batchmode as workflow
+import HRV_queue as queue
+import HRV_synthetic as synth
+from conftest import ROOT
+
+DURATION = 600
+
+@pytest.fixture
+def cohort(tmp_path):
+    # Synthetic store with 4 patients and a patient that is not in the store
+    store = str(tmp_path / 'store')
+    patient_ids = synth.synthetic_store(store, 4, DURATION)
+    with open(patient_ids, 'a') as f:
+        f.write('synthetic/9999999\n')
+    kwargs = {'sampfreq': 125, 'lead': 'II', 'starttime': 0,
+              'endtime': DURATION, 'store': store, 'offline': True,
+              'windows': [(0, 300), (300, 600)], 'engine': 'fast',
+              'parameters': ['rmssd', 'sdnn', 'sampen']}
+    return patient_ids, kwargs
+
+def _worker(queue_dir, node):
+    return subprocess.Popen([sys.executable, 'HRV_queue.py', 'work',
+                             queue_dir, '--node', node, '--wait'], cwd=ROOT,
+                            stdout=subprocess.DEVNULL)
+
+def _leases(queue_dir, node):
+    return [name for name in os.listdir(os.path.join(queue_dir, 'leased'))
+            if name.endswith('@%s.json' % node)]
+
+def test_killed_worker(tmp_path, cohort):
+    patient_ids, kwargs = cohort
+    export_all, failures = workflow.workflow_batch(
+        patient_ids, retain='results', return_failures=True, **kwargs)[5:]
+    assert len(failures) == 1
+
+    queue_dir = str(tmp_path / 'queue')
+    queue.create_queue(queue_dir, patient_ids, task_size=1, lease_timeout=2,
+                       **kwargs)
+    workers = [_worker(queue_dir, 'node%i' % i) for i in range(2)]
+    try:
+        start = time.time()
+        while True:                                                             # Stop node0 while it holds a lease
+            assert time.time() - start < 60, 'node0 leased no task'
+            if _leases(queue_dir, 'node0'):
+                os.kill(workers[0].pid, signal.SIGSTOP)
+                if _leases(queue_dir, 'node0'):
+                    break
+                os.kill(workers[0].pid, signal.SIGCONT)                         # Finished the task meanwhile
+            time.sleep(0.01)
+        workers[0].kill()
+        assert workers[1].wait(timeout=120) == 0
+    finally:
+        for worker in workers:
+            worker.kill()
+            worker.wait()
+
+    assert queue.status(queue_dir)['pending'] == 0
+    assert queue.status(queue_dir)['leased'] == 0
+    retried = list()
+    for name in os.listdir(os.path.join(queue_dir, 'done')):
+        with open(os.path.join(queue_dir, 'done', name)) as f:
+            task = json.load(f)
+        if task['attempts']:
+            retried.append(task['errors'])
+    assert retried == [['Lease of node0 expired.']]
+
+    merged, merged_failures = queue.merge(queue_dir)
+    assert merged.equals(export_all)
+    assert merged_failures.equals(failures)
+
+def test_workflow_batch_sharded(tmp_path, cohort):
+    patient_ids, kwargs = cohort
+    reference = workflow.workflow_batch(patient_ids, retain='results',
+                                        return_failures=True, **kwargs)
+    sharded = workflow.workflow_batch(patient_ids, retain='results',
+                                      return_failures=True, task_size=2,
+                                      queue_dir=str(tmp_path / 'queue'),
+                                      **kwargs)
+    assert sharded[:5] == ([], [], [], [], [])
+    assert sharded[5].equals(reference[5])
+    assert sharded[6].equals(reference[6])
+
+def test_failure_of_patient(tmp_path, cohort):
+    patient_ids, kwargs = cohort
+    part = str(tmp_path / '00000.jsonl')
+    queue.run_task({'patients': ['synthetic/0000000', 'synthetic/0000001']},
+                   dict(kwargs, parameters=['unknown']), part)
+    with open(part) as f:
+        results = [json.loads(line) for line in f]
+    assert [result['patient'] for result in results] == [
+        'synthetic/0000000', 'synthetic/0000001']
+    for result in results:
+        assert result['hrv'] == []
+        assert [failure['stage'] for failure in result['failures']] == [
+            'queue']
+        assert 'ValueError' in result['failures'][0]['error']
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests recordstore
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of the local record store (HRV_recordstore.py) with synthetic records
+in a temporary directory: windows read from the store equal the written
+signals, also across NaN gaps, the number of open memory maps stays
+bounded, and spilled batch results equal the results that were spilled.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import HRV_preprocessing as preproc
+import HRV_recordstore as recstore
+from HRV_synthetic import synthetic_ecg
+
+SAMPFREQ = 125
+DURATION = 120
+
+@pytest.fixture
+def store(tmp_path):
+    store = str(tmp_path / 'store')
+    signal, _ = synthetic_ecg(DURATION, SAMPFREQ, gaps=((30, 32), ),
+                              seed=1)
+    signals = {'II': signal, 'V': -signal}
+    recstore.write_record(store, '30/3000001', signals, SAMPFREQ)
+    return store, signals
+
+def test_index(store):
+    store, signals = store
+    index = recstore.read_index(store, '30/3000001')
+    assert index['record_name'] == '3000001'
+    assert index['fs'] == SAMPFREQ
+    assert index['sig_len'] == len(signals['II'])
+    assert index['leads']['II']['nan_gaps'] == [[30*SAMPFREQ,
+                                                 32*SAMPFREQ]]
+
+@pytest.mark.parametrize('sampfrom, sampto', [(0, None), (1000, 2000),
+                                              (3500, 4500)])                    # Last window crosses the NaN gap
+def test_read_window(store, sampfrom, sampto):
+    store, signals = store
+    record = recstore.read_window(store, '30/3000001', sampfrom, sampto,
+                                  ['V', 'II'])
+    stop = len(signals['II']) if sampto is None else sampto
+    assert record.sig_name == ['V', 'II']
+    assert record.p_signal.shape == (stop - sampfrom, 2)
+    np.testing.assert_array_equal(record.p_signal[:, 0],
+                                  signals['V'][sampfrom:stop])
+    np.testing.assert_array_equal(record.p_signal[:, 1],
+                                  signals['II'][sampfrom:stop])
+
+def test_invalid_window(store):
+    store, signals = store
+    with pytest.raises(ValueError):
+        recstore.read_window(store, '30/3000001', 0, len(signals['II']) + 1,
+                             ['II'])
+    with pytest.raises(ValueError):
+        recstore.read_window(store, '30/3000001', 0, 100, ['I'])
+
+def test_load_data(store):
+    store, signals = store
+    record = preproc.load_data('30/3000001', SAMPFREQ, 28, 34, 'II', store,
+                               offline=True)
+    np.testing.assert_array_equal(record.p_signal[:, 0],
+                                  signals['II'][28*SAMPFREQ:34*SAMPFREQ])
+    assert np.isnan(record.p_signal[:, 0]).sum() == 2*SAMPFREQ
+    with pytest.raises(FileNotFoundError):
+        preproc.load_data('30/3000002', SAMPFREQ, 0, 10, 'II', store,
+                          offline=True)
+
+def test_open_lead(tmp_path, monkeypatch):
+    monkeypatch.setattr(recstore, 'MAX_MMAPS', 3)
+    monkeypatch.setattr(recstore, '_mmaps', type(recstore._mmaps)())
+    fnames = list()
+    for i in range(5):
+        fnames.append(str(tmp_path / ('%i.npy' % i)))
+        np.save(fnames[-1], np.full(10, i, dtype=np.float64))
+    for fname in fnames:
+        recstore._open_lead(fname)
+        assert len(recstore._mmaps) <= 3
+    assert list(recstore._mmaps) == fnames[2:]                                  # Least recently used maps released
+    assert recstore._open_lead(fnames[2]) is recstore._mmaps[fnames[2]][1]      # Reused while the file is not modified
+    assert list(recstore._mmaps)[-1] == fnames[2]
+
+def test_ingest_batch(tmp_path, monkeypatch):
+    import wfdb
+
+    signal, _ = synthetic_ecg(10, SAMPFREQ, seed=2)
+    requested = list()
+
+    def rdrecord(record_name, pn_dir, channel_names=None):
+        requested.append(pn_dir)
+        return recstore.StoredRecord(record_name, SAMPFREQ, ['II'],
+                                     signal[:, np.newaxis])
+
+    monkeypatch.setattr(wfdb, 'rdrecord', rdrecord)                             # No download from PhysioNet
+    store = str(tmp_path / 'store')
+    patient_ids = str(tmp_path / 'ids.txt')
+    with open(patient_ids, 'w') as f:
+        f.write('30/3000001\n30/3000002\n')
+    assert recstore.ingest_batch(patient_ids, store) == ['30/3000001',
+                                                         '30/3000002']
+    assert recstore.ingest_batch(patient_ids, store) == []                      # Stored records are skipped
+    assert requested == ['mimic3wdb/30/3000001', 'mimic3wdb/30/3000002']
+    record = recstore.read_window(store, '30/3000002', 0, None, ['II'])
+    np.testing.assert_array_equal(record.p_signal[:, 0], signal)
+
+def test_spill_patient(tmp_path):
+    signal, r_peaks = synthetic_ecg(DURATION, SAMPFREQ, seed=3)
+    ecg_df = pd.DataFrame({'Time': np.arange(len(signal))/SAMPFREQ,
+                           'ecg_signal': signal, 'ecg_filtered': -signal})
+    ecg_df = ecg_df.drop(labels=range(1000, 1250), axis=0)                      # Dropped samples, as in ecg_dataframe
+    nni = np.diff(r_peaks)/SAMPFREQ*1000
+    ecg_handle, handles = recstore.spill_patient(str(tmp_path), '30/3000001',
+                                                 ecg_df, {'r_peaks': r_peaks,
+                                                          'nni': nni})
+    loaded = ecg_handle.load()
+    assert loaded.index.equals(ecg_df.index)
+    assert list(loaded.columns) == list(ecg_df.columns)
+    np.testing.assert_array_equal(loaded.Time, ecg_df.Time)
+    np.testing.assert_array_equal(loaded.ecg_signal,
+                                  ecg_df.ecg_signal.astype(np.float32))         # Signals stored as float32
+    assert ecg_handle.ecg_filtered.index.equals(ecg_df.index)
+    assert ecg_handle['Time'].loc[1250] == ecg_df.Time.loc[1250]
+    with pytest.raises(AttributeError):
+        ecg_handle.rr
+
+    np.testing.assert_array_equal(np.asarray(handles['nni']), nni)
+    np.testing.assert_array_equal(handles['r_peaks'][:5], r_peaks[:5])
+    assert len(handles['r_peaks']) == len(r_peaks)
+    assert np.asarray(handles['nni'], dtype=np.float32).dtype == np.float32
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests rpeak
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of the R-peak detection paths on synthetic ECG: the fast path of
+ecg_rpeak, its chunks and the streaming detection (HRV_streaming.py) find
+the same R-peaks as biosppy on the whole signal.
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import HRV_preprocessing as preproc
+import HRV_streaming as streaming
+import HRV_synthetic as synth
+
+SAMPFREQ = 125
+DURATION = 1200
+
+@pytest.fixture(scope='module')
+def ecg_df():
+    signal, _ = synth.synthetic_ecg(DURATION, SAMPFREQ, seed=2)
+    return pd.DataFrame({'ecg_signal': signal})
+
+@pytest.fixture(scope='module')
+def reference(ecg_df):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return preproc.ecg_rpeak(ecg_df, SAMPFREQ, method='biosppy')
+
+def test_fast(ecg_df, reference):
+    filtered, r_peaks, nni = preproc.ecg_rpeak(ecg_df, SAMPFREQ)
+    np.testing.assert_array_equal(r_peaks, reference[1])
+    np.testing.assert_array_equal(nni, reference[2])
+
+@pytest.mark.parametrize('chunk, n_workers', [(120, 1), (300, 2)])
+def test_chunks(ecg_df, reference, chunk, n_workers):
+    _, r_peaks, nni = preproc.ecg_rpeak(ecg_df, SAMPFREQ, chunk=chunk,
+                                        margin=10, n_workers=n_workers)
+    np.testing.assert_array_equal(r_peaks, reference[1])
+    np.testing.assert_array_equal(nni, reference[2])
+
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_streaming(tmp_path, prefetch):
+    store = str(tmp_path / 'store')
+    patient_ids = synth.synthetic_store(store, 1, DURATION,
+                                        gaps=((100, 3), (700, 1)))
+    with open(patient_ids) as f:
+        patient_id = f.readline().strip()
+    record = preproc.load_data(patient_id, SAMPFREQ, 0, DURATION, 'II',
+                               store, offline=True)
+    ecg_df, r_peaks, nni = preproc.ecg_rpeak(
+        preproc.ecg_dataframe(record, SAMPFREQ), SAMPFREQ)
+    streamed = streaming.stream_rpeaks(patient_id, SAMPFREQ, 0, DURATION,
+                                       'II', store, offline=True, chunk=120,
+                                       margin=10, prefetch=prefetch)
+    np.testing.assert_array_equal(streamed[0], r_peaks)
+    np.testing.assert_array_equal(streamed[1], nni)
+    assert streamed[2] == ecg_df.Time.iloc[0]
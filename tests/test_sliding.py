@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests sliding
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of the sliding window time domain parameters (HRV_sliding.py): every
+window agrees with hrv_results on the NNI of that window.
+"""
+import warnings
+
+import numpy as np
+import pytest
+
+import HRV_calculations as hrvcalc
+import HRV_preprocessing as preproc
+import HRV_sliding as sliding
+from HRV_synthetic import synthetic_nni
+
+RTOL = 1e-9
+
+@pytest.fixture(scope='module')
+def series():
+    # 15 minutes of NNI with ectopic beats removed, as in workflow_patient
+    r_peaks, nni = synthetic_nni(1125, seed=3)
+    return preproc.ecg_ectopic_removal(r_peaks, nni)
+
+@pytest.mark.parametrize('window, step', [(300, 30), (300, 70), (120, 120)])
+def test_hrv_results(series, window, step):
+    r_peaks, nni = series
+    trend = sliding.sliding_time_domain(r_peaks, nni, window, step)
+    assert list(trend.columns) == ['time [min]', *sliding.TIME_PARAMETERS]
+    assert np.allclose(np.diff(trend['time [min]']), step/60)
+
+    windows = [(start*60, start*60 + window) for start in trend['time [min]']]
+    segments = preproc.nni_windows(r_peaks, nni, windows)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')                                         # pyhrv warns for windows shorter than 5 minutes
+        for i, (_, nni_window) in enumerate(segments):
+            hrv_td = hrvcalc.hrv_results(nni_window, 125, engine='fast')[0]
+            for key in sliding.TIME_PARAMETERS:
+                assert trend[key].iloc[i] == pytest.approx(hrv_td[key],
+                                                           rel=RTOL), key
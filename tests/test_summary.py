@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests summary
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of the single-pass cohort summary (HRV_summary.py) against pandas on
+the full table, and of the merge of partial summaries.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import HRV_calculations as hrvcalc
+import HRV_summary as hrvsum
+
+@pytest.fixture
+def table():
+    rng = np.random.default_rng(0)
+    keys = list(hrvcalc.PARAMETERS)[:10]
+    table = pd.DataFrame(rng.lognormal(3, 1, (5000, len(keys))),
+                         columns=keys)
+    table.insert(0, 'time [min]', np.arange(len(table)) % 1440)
+    return table
+
+def test_summarize(tmp_path, table):
+    path = str(tmp_path / 'export.csv')
+    table.to_csv(path)
+    summary = hrvsum.summarize(path, chunk_rows=700)
+    result = summary.result()
+    table = pd.read_csv(path, index_col=0)                                      # As parsed by summarize
+    keys = [key for key in table.columns if key != 'time [min]']
+    np.testing.assert_allclose(result.Mean[keys], table[keys].mean(),
+                               rtol=1e-12)
+    np.testing.assert_allclose(result.Std[keys], table[keys].std(),
+                               rtol=1e-12)
+    np.testing.assert_array_equal(result.Min[keys], table[keys].min())
+    np.testing.assert_array_equal(result.Max[keys], table[keys].max())
+    error = np.abs(result.Q50[keys] / table[keys].quantile(0.5) - 1)
+    assert error.max() <= summary.accuracy
+
+def test_merge(table):
+    full = hrvsum.StreamingSummary()
+    full.update(table)
+    half = hrvsum.StreamingSummary()
+    half.update(table.iloc[:len(table)//3])
+    other = hrvsum.StreamingSummary()
+    other.update(table.iloc[len(table)//3:])
+    merged = half.merge(other).result()
+    result = full.result()
+    np.testing.assert_allclose(merged.Mean, result.Mean, rtol=1e-12)
+    np.testing.assert_allclose(merged.Std, result.Std, rtol=1e-12)
+    assert merged.Q50.equals(result.Q50)
+    assert merged.Count.equals(result.Count)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests trace
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of the instrumentation of the pipeline (HRV_trace.py): the nested
+stages of hrv_results are recorded with the tags of the enclosing stage,
+summary aggregates them, and a disabled tracer leaves no records.
+"""
+import os
+
+import matplotlib
+matplotlib.use('Agg')                                                           # pyhrv creates figures
+import pytest
+
+import HRV_batchmode as workflow
+import HRV_calculations as hrvcalc
+import HRV_synthetic as synth
+import HRV_trace as tracer
+
+NESTED = {'hrv.nni_parameters', 'hrv.nni_differences_parameters',
+          'hrv.hr_parameters', 'hrv.sdnn', 'hrv.sdnn_index', 'hrv.sdann',
+          'hrv.rmssd', 'hrv.sdsd', 'hrv.nn50', 'hrv.triangular_index',
+          'hrv.welch_psd', 'hrv.poincare', 'hrv.sample_entropy', 'hrv.dfa'}
+
+@pytest.fixture
+def records():
+    _, nni = synth.synthetic_nni(1500, ectopic_rate=0, seed=0)
+    tracer.enable()
+    try:
+        with tracer.stage('hrv', patient='30/3000001', window=0,
+                          beats=len(nni)):
+            hrvcalc.hrv_results(nni, 125, engine='fast')
+        yield list(tracer.records())
+    finally:
+        tracer.disable()
+
+def test_nested(records):
+    names = [record['stage'] for record in records]
+    assert set(names) == NESTED | {'hrv'}
+    assert names[-1] == 'hrv'                                                   # Recorded when the stage ends
+    assert all(record['patient'] == '30/3000001' and record['window'] == 0
+               and record['beats'] == 1500 and not record['error']
+               for record in records)                                           # Tags of the enclosing stage
+    assert sum(record['wall'] for record in records[:-1]) <= \
+        records[-1]['wall']
+
+def test_summary(records):
+    stages, patients, slowest = tracer.summary(records, top=3)
+    assert set(stages.index) == NESTED | {'hrv'}
+    assert stages.loc['hrv', 'count'] == 1
+    assert stages.loc['hrv.sdnn', 'wall_total'] == \
+        sum(record['wall'] for record in records
+            if record['stage'] == 'hrv.sdnn')
+    assert stages.wall_total.is_monotonic_decreasing
+    assert list(patients.columns) == ['total', 'hrv']                           # Nested stages are part of 'hrv'
+    assert patients.loc['30/3000001', 'total'] == records[-1]['wall']
+    assert len(slowest) == 3 and slowest.stage.iloc[0] == 'hrv'
+
+def test_workflow(tmp_path):
+    store = str(tmp_path / 'store')
+    with open(synth.synthetic_store(store, 1, 300)) as f:
+        patient_id = f.readline().strip()
+    path = str(tmp_path / 'trace.jsonl')
+    workflow.workflow_patient(patient_id, 125, 'II', 0, 300, store,
+                              offline=True, engine='fast', trace=path)
+    assert tracer.enabled() is None                                             # Only enabled for this patient
+    trace = tracer.read_trace(path)
+    assert {'load', 'rpeak', 'ectopic', 'hrv'} <= set(trace.stage)
+    assert (trace.patient == patient_id).all()
+    stages, patients, _ = tracer.summary(path)
+    assert list(patients.index) == [patient_id]
+    assert stages.loc['hrv', 'count'] == 1
+
+def test_disable(tmp_path):
+    path = str(tmp_path / 'trace.jsonl')
+    tracer.enable(path)
+    with tracer.stage('load', patient='30/3000001'):
+        pass
+    tracer.disable()
+    assert tracer.enabled() is None
+    assert tracer.stage('load') is tracer.stage('rpeak')                        # Shared context manager that does nothing
+    _, nni = synth.synthetic_nni(1500, ectopic_rate=0, seed=0)
+    with tracer.stage('hrv', patient='30/3000001'):
+        hrvcalc.hrv_results(nni, 125, engine='fast')
+    assert tracer.records() == []
+    assert len(tracer.read_trace(path)) == 1                                    # Nothing written after disable
+    assert os.path.isfile(path)
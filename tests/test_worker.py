@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+HRV tests worker
+Created: 10/2021 - 02/2022
+Python v3.8
+Author: M. Verboom
+
+Tests of the long-running worker (HRV_worker.py): the replies of run_job,
+of the socket and of the spool directory contain the HRV parameters of
+workflow_patient.
+"""
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+import HRV_batchmode as workflow
+import HRV_worker as worker
+import HRV_synthetic as synth
+
+DURATION = 600
+
+@pytest.fixture(scope='module')
+def job(tmp_path_factory):
+    store = str(tmp_path_factory.mktemp('worker') / 'store')
+    patient_ids = synth.synthetic_store(store, 1, DURATION)
+    with open(patient_ids) as f:
+        patient_id = f.readline().strip()
+    return {'patient_id': patient_id, 'sampfreq': 125, 'lead': 'II',
+            'starttime': 0, 'endtime': DURATION, 'store': store,
+            'offline': True, 'engine': 'fast',
+            'windows': [[0, 300], [300, 600]],
+            'parameters': ['rmssd', 'sdnn', 'sampen']}
+
+@pytest.fixture(scope='module')
+def reference(job):
+    hrv = workflow.workflow_patient(**dict(
+        job, windows=[tuple(window) for window in job['windows']],
+        retain='results'))['hrv']
+    return json.loads(json.dumps(hrv, default=float))                           # As returned over JSON
+
+def test_run_job(job, reference):
+    reply = json.loads(worker._dumps(worker.run_job(dict(job, id='a'))))
+    assert reply['id'] == 'a'
+    assert reply['hrv'] == reference
+    assert 'error' in worker.run_job(dict(job, unknown=1))
+
+def test_socket(job, reference):
+    with socket.socket() as s:                                                  # Free port for the worker
+        s.bind(('127.0.0.1', 0))
+        address = s.getsockname()
+    thread = threading.Thread(target=worker.serve_socket,
+                              args=(address, None, False), daemon=True)
+    thread.start()
+    for _ in range(100):                                                        # Wait until the worker is ready
+        try:
+            assert worker.request(address, {'command': 'ping'})['status'] \
+                == 'ok'
+            break
+        except OSError:
+            time.sleep(0.05)
+    assert worker.request(address, job, timeout=60)['hrv'] == reference
+    assert worker.request(address, {'command': 'stop'})['status'] == \
+        'stopped'
+    thread.join(10)
+    assert not thread.is_alive()
+
+def test_spool(tmp_path, job, reference):
+    spool = str(tmp_path / 'spool')
+    thread = threading.Thread(target=worker.serve_spool,
+                              args=(spool, None, False, 0.01), daemon=True)
+    thread.start()
+    job_id = worker.submit(spool, job)
+    assert worker.result(spool, job_id, timeout=60)['hrv'] == reference
+    reply = worker.result(spool, worker.submit(spool, {'command': 'stop'}),
+                          timeout=10)
+    assert reply['status'] == 'stopped'
+    thread.join(10)
+    assert not thread.is_alive()